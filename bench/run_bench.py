@@ -0,0 +1,316 @@
+"""Offline benchmark for the controller: local fixture pages, a scripted model, no network.
+
+Serves bench/fixtures on localhost, starts the embedded bridge with start_bridge_server and
+connects a scripted worker that answers every prompt from scenarios.json after a fixed
+think time. Then drives the controller's non-interactive loop (headless Chromium) through
+each scenario and reports steps/sec, controller overhead per step, per-phase latency (from
+the controller's own traces), prompt sizes and peak RSS, compared with bench/baseline.json.
+
+    python bench/run_bench.py                       # run and compare with the baseline
+    python bench/run_bench.py --save-baseline       # record this run as the new baseline
+    python bench/run_bench.py --scenario spa --repeat 5 --think 0
+    python bench/run_bench.py --warm --repeat 1     # attach to `controller.py --serve-browser`
+"""
+import argparse
+import asyncio
+import dataclasses
+import functools
+import http.server
+import json
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+import controller  # noqa: E402
+
+FIXTURES_DIR = BENCH_DIR / 'fixtures'
+SCENARIOS_PATH = BENCH_DIR / 'scenarios.json'
+BASELINE_PATH = BENCH_DIR / 'baseline.json'
+RESULTS_PATH = BENCH_DIR / 'last_run.json'
+
+# A metric regresses when it is worse than the baseline by more than this fraction...
+DEFAULT_TOLERANCE = 0.15
+# ...and by more than its noise floor (timings in ms, sizes in bytes).
+NOISE_FLOOR = {'ms': 2.0, 'bytes': 512, 'mb': 5.0}
+# Phases compared with the baseline (p50); every traced phase is still reported.
+COMPARED_PHASES = ('capture', 'settle', 'encode', 'ask', 'ask_and_execute', 'command')
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve_fixtures():
+    handler = functools.partial(QuietHandler, directory=str(FIXTURES_DIR))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def peak_rss_mb():
+    """Peak resident memory of this process (the controller, not Chromium), or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 2**20, 1)
+        except Exception:
+            return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 2**20 if sys.platform == 'darwin' else rss / 1024, 1)
+
+class ScriptedWorker:
+    """Bridge worker that answers each task's prompts in order from its script.
+
+    Prompts are matched to a task by the "Task: ..." line the controller puts first; once
+    a script runs out the worker answers with exit, so a misbehaving run can't hang.
+    """
+
+    def __init__(self, url: str, think: float):
+        self.url = url
+        self.think = think
+        self.scripts = {}
+        self.prompt_sizes = {}
+        self.ready = asyncio.Event()
+
+    def add_task(self, task: str, replies: list):
+        self.scripts[task] = iter([json.dumps(r) for r in replies])
+        self.prompt_sizes[task] = []
+
+    async def run(self):
+        import websockets
+        async with websockets.connect(self.url, max_size=None) as ws:
+            await ws.send(json.dumps({'type': 'register', 'role': 'worker'}))
+            self.ready.set()
+            async for message in ws:
+                if isinstance(message, bytes):
+                    header = controller.read_frame_header(message)
+                else:
+                    header = json.loads(message)
+                    if 'prompt' not in header:
+                        continue
+                task = header['prompt'].split('\n', 1)[0].removeprefix('Task: ')
+                if task in self.prompt_sizes:
+                    self.prompt_sizes[task].append(len(message))
+                await asyncio.sleep(self.think)
+                reply = next(self.scripts.get(task, iter(())), json.dumps({'action': 'exit', 'args': []}))
+                await ws.send(json.dumps({'type': 'reply', 'id': header.get('id'), 'reply': reply}))
+
+def read_spans(path: Path, run: str) -> list:
+    spans = []
+    if path.exists():
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                span = json.loads(line)
+                if span.get('run') == run:
+                    spans.append(span)
+    return spans
+
+def phase_stats(spans: list) -> dict:
+    by_phase = {}
+    for span in spans:
+        by_phase.setdefault(span['phase'], []).append(span['ms'])
+    return {phase: {'count': len(ms), 'p50_ms': round(percentile(ms, 50), 1), 'p95_ms': round(percentile(ms, 95), 1)}
+            for phase, ms in sorted(by_phase.items())}
+
+async def run_bench(scenarios: list, think: float, repeat: int, concurrency: int, max_steps: int,
+                    warm: bool = False) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix='agent-bench-'))
+    # Keep runs, trajectories, the replay cache and the HTTP cache out of the working tree, and
+    # start every bench from a cold HTTP cache so runs compare like with like.
+    controller.BATCH_RUNS_DIR = workdir / 'runs'
+    controller.TRAJECTORIES_DIR = workdir / 'trajectories'
+    controller.REPLAY_CACHE_PATH = workdir / 'replay_cache.json'
+    controller.HTTP_CACHE_DIR = workdir / 'http_cache'
+    if controller.ROUTING_PROFILE.cache_dir is not None:
+        controller.ROUTING_PROFILE = dataclasses.replace(controller.ROUTING_PROFILE, cache_dir=controller.HTTP_CACHE_DIR)
+    controller.BRIDGE_URL = f"ws://127.0.0.1:{free_port()}"
+    tracer = controller.enable_tracing(workdir / 'traces.jsonl')
+
+    http_server, base_url = serve_fixtures()
+    bridge_server = await controller.start_bridge_server()
+    worker = ScriptedWorker(controller.BRIDGE_URL, think)
+    worker_task = asyncio.create_task(worker.run())
+    await asyncio.wait_for(worker.ready.wait(), 10)
+
+    specs, scenario_of = [], {}
+    for n in range(1, repeat + 1):
+        for scenario in scenarios:
+            task_id = f"{scenario['id']}-{n}"
+            # A unique task per repetition keeps each one on its own script.
+            task = f"{scenario['task']} [bench {task_id}]"
+            worker.add_task(task, scenario['replies'])
+            scenario_of[task_id] = (scenario['id'], task)
+            specs.append({'id': task_id, 'task': task, 'start_url': f"{base_url}/{scenario['fixture']}"})
+
+    started = time.perf_counter()
+    try:
+        outcomes = await controller.run_batch(specs, concurrency, max_steps, headless=True, use_daemon=warm)
+    finally:
+        worker_task.cancel()
+        await controller.stop_bridge_server(bridge_server)
+        http_server.shutdown()
+    wall = time.perf_counter() - started
+    tracer.flush()
+    spans = read_spans(tracer.path, tracer.run)
+
+    results = {}
+    for scenario in scenarios:
+        sid = scenario['id']
+        mine = [o for o in outcomes if scenario_of[o.task_id][0] == sid]
+        tasks = {scenario_of[o.task_id][1] for o in mine}
+        sizes = [size for task in tasks for size in worker.prompt_sizes[task]]
+        steps = sum(o.steps for o in mine)
+        seconds = sum(o.seconds for o in mine)
+        results[sid] = {
+            'runs': len(mine),
+            'done': sum(1 for o in mine if o.status == 'done'),
+            'steps': steps,
+            'seconds': round(seconds, 3),
+            'steps_per_sec': round(steps / seconds, 3) if seconds else 0.0,
+            # Time per step the controller itself spends, without the scripted think time.
+            'overhead_ms_per_step': round((seconds - think * len(sizes)) / steps * 1000, 1) if steps else 0.0,
+            'prompt_bytes': {
+                'mean': round(sum(sizes) / len(sizes)) if sizes else 0,
+                'p95': percentile(sizes, 95) if sizes else 0,
+                'max': max(sizes, default=0),
+            },
+            'phases': phase_stats([s for s in spans if s.get('task') in {o.task_id for o in mine}]),
+        }
+
+    all_sizes = [size for sizes in worker.prompt_sizes.values() for size in sizes]
+    total_steps = sum(o.steps for o in outcomes)
+    total_seconds = sum(o.seconds for o in outcomes)
+    return {
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'settings': {'think': think, 'repeat': repeat, 'concurrency': concurrency, 'warm': warm,
+                     'scenarios': [s['id'] for s in scenarios]},
+        # Seconds from process start; cold launches Chromium, warm attaches to --serve-browser.
+        'startup': dict(controller.startup),
+        'scenarios': results,
+        'overall': {
+            'wall_seconds': round(wall, 3),
+            'steps': total_steps,
+            'steps_per_sec': round(total_steps / total_seconds, 3) if total_seconds else 0.0,
+            'overhead_ms_per_step': round((total_seconds - think * len(all_sizes)) / total_steps * 1000, 1)
+            if total_steps else 0.0,
+            'prompt_bytes_mean': round(sum(all_sizes) / len(all_sizes)) if all_sizes else 0,
+            'phases': phase_stats(spans),
+        },
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def comparable_metrics(report: dict) -> dict:
+    """Flatten a report into {name: (value, unit, higher_is_better)}."""
+    metrics = {}
+    for sid, r in report['scenarios'].items():
+        metrics[f"{sid}.steps_per_sec"] = (r['steps_per_sec'], '', True)
+        metrics[f"{sid}.overhead_ms_per_step"] = (r['overhead_ms_per_step'], 'ms', False)
+        metrics[f"{sid}.prompt_bytes.mean"] = (r['prompt_bytes']['mean'], 'bytes', False)
+        for phase in COMPARED_PHASES:
+            if phase in r['phases']:
+                metrics[f"{sid}.{phase}.p50_ms"] = (r['phases'][phase]['p50_ms'], 'ms', False)
+    if report.get('peak_rss_mb') is not None:
+        metrics['peak_rss_mb'] = (report['peak_rss_mb'], 'mb', False)
+    return metrics
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Print the report next to the baseline; return the names of regressed metrics."""
+    if baseline.get('settings') != report['settings']:
+        print(f"⚠️ Baseline was recorded with different settings: {baseline.get('settings')}")
+    now, before = comparable_metrics(report), comparable_metrics(baseline)
+    regressions = []
+    print(f"\n  {'metric':<36} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, (value, unit, higher_is_better) in now.items():
+        if name not in before:
+            print(f"  {name:<36} {'-':>10} {value:>10} {'new':>8}")
+            continue
+        old = before[name][0]
+        change = (value - old) / old if old else 0.0
+        worse = (value - old) if not higher_is_better else (old - value)
+        flag = ''
+        if old and worse / abs(old) > tolerance and worse > NOISE_FLOOR.get(unit, 0):
+            flag = '  ❌ regression'
+            regressions.append(name)
+        elif old and -worse / abs(old) > tolerance:
+            flag = '  ✅ improved'
+        print(f"  {name:<36} {old:>10} {value:>10} {change:>+8.0%}{flag}")
+    return regressions
+
+def print_report(report: dict):
+    print("\n📊 Benchmark results")
+    print(f"  {'scenario':<14} {'done':>6} {'steps':>6} {'steps/s':>8} {'ovh ms/step':>12} {'prompt B':>9} {'max B':>9}")
+    for sid, r in report['scenarios'].items():
+        print(f"  {sid:<14} {r['done']:>3}/{r['runs']:<2} {r['steps']:>6} {r['steps_per_sec']:>8.2f} "
+              f"{r['overhead_ms_per_step']:>12.1f} {r['prompt_bytes']['mean']:>9} {r['prompt_bytes']['max']:>9}")
+    overall = report['overall']
+    print(f"  {'overall':<14} {'':>6} {overall['steps']:>6} {overall['steps_per_sec']:>8.2f} "
+          f"{overall['overhead_ms_per_step']:>12.1f} {overall['prompt_bytes_mean']:>9}")
+    print(f"\n  {'phase':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9}")
+    for phase, row in overall['phases'].items():
+        print(f"  {phase:<24} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f}")
+    startup = report.get('startup') or {}
+    if startup.get('first_action') is not None:
+        print(f"\n  startup ({startup['mode']}): browser ready {startup['browser_ready']:.2f}s, "
+              f"first action {startup['first_action']:.2f}s after process start")
+    rss = report['peak_rss_mb']
+    print(f"\n  peak RSS (controller process): {rss if rss is not None else 'unknown'} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', help='run only this scenario id (repeatable)')
+    parser.add_argument('--think', type=float, default=0.05, help='scripted model think time per prompt, seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='scenarios run at once')
+    parser.add_argument('--max-steps', type=int, default=10)
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='baseline file to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write this run to --baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative change that counts as a regression (default %(default)s)')
+    parser.add_argument('--warm', action='store_true', help='attach to a running `controller.py --serve-browser`')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on any regression')
+    args = parser.parse_args()
+
+    scenarios = json.loads(SCENARIOS_PATH.read_text(encoding='utf-8'))
+    if args.scenario:
+        unknown = set(args.scenario) - {s['id'] for s in scenarios}
+        if unknown:
+            parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+        scenarios = [s for s in scenarios if s['id'] in args.scenario]
+
+    report = asyncio.run(run_bench(scenarios, args.think, args.repeat, args.concurrency, args.max_steps, args.warm))
+    print_report(report)
+    RESULTS_PATH.write_text(json.dumps(report, indent=2), encoding='utf-8')
+    print(f"\n🧾 Full results: {RESULTS_PATH}")
+
+    baseline_path = Path(args.baseline)
+    regressions = []
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2), encoding='utf-8')
+        print(f"📌 Saved as baseline: {baseline_path}")
+    elif baseline_path.exists():
+        regressions = compare(report, json.loads(baseline_path.read_text(encoding='utf-8')), args.tolerance)
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}" if regressions else "\nNo regressions.")
+    else:
+        print(f"No baseline at {baseline_path}; run with --save-baseline to record one.")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,563 @@
+import argparse
 import asyncio
+import collections
+import contextvars
+import functools
 import os
 import json
 import re
 import base64
+import hashlib
+import struct
+import sys
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from dataclasses import dataclass, replace
 from pathlib import Path
 from datetime import datetime
-from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
-
-async def start_bridge_server(host='localhost', port=8765):
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlsplit
+
+# Start of this process, for the time-to-first-action report.
+PROCESS_STARTED = time.perf_counter()
+
+class PlaywrightTimeoutError(Exception):
+    """Stand-in until playwright is imported; async_playwright() rebinds it to the real class."""
+
+def async_playwright():
+    """playwright's async_playwright(), imported on first use so startup doesn't pay for it."""
+    global PlaywrightTimeoutError
+    from playwright.async_api import async_playwright as start, TimeoutError as timeout_error
+    PlaywrightTimeoutError = timeout_error
+    return start()
+
+@functools.lru_cache(maxsize=None)
+def websockets_error() -> Optional[str]:
+    """None if the websockets package can be imported, otherwise why not. Checked once."""
     try:
-        import websockets
+        import websockets  # noqa: F401
     except Exception as e:
-        print(f"⚠️ websockets package not available; bridge server will not start: {e}")
-        return None
+        return f"websockets package not available: {e}"
+    return None
+
+class BridgeClientConn:
+    """One WebSocket connected to the bridge, with its own bounded outbox and writer task."""
+
+    def __init__(self, ws, name: str):
+        self.ws = ws
+        self.name = name
+        self.role = 'requester'
+        self.outbox = asyncio.Queue(maxsize=BRIDGE_CLIENT_MAX_QUEUE)
+        self.current = None  # job being worked on, for workers
+        self.connected_at = time.monotonic()
+        self.busy_since = None
+        self.busy_total = 0.0
+        self.writer = None
+
+    def busy_time(self) -> float:
+        if self.busy_since is None:
+            return self.busy_total
+        return self.busy_total + time.monotonic() - self.busy_since
+
+class BridgeJob:
+    def __init__(self, job_id: str, requester: BridgeClientConn, message, legacy: bool):
+        self.id = job_id
+        self.requester = requester
+        self.message = message
+        # Legacy prompts had no id and expect the bare reply text back.
+        self.legacy = legacy
+        self.cancelled = False
+        self.chunks_dropped = False
+        self.queued_at = time.monotonic()
+        self.dispatched_at = None
+
+class BridgeBroker:
+    """Routes prompts from requesters to exactly one idle worker and replies back.
+
+    Clients announce themselves with {"type": "register", "role": "requester" | "worker"};
+    unregistered clients are requesters. Prompts wait in a FIFO queue until a worker is
+    idle. Workers may stream a reply as {"type": "chunk", "id", "offset", "text"} messages
+    ending with {"type": "done", "id", "reply"}; chunks are relayed to the requester as-is.
+    Each client has its own bounded outbox, so a slow client never stalls the others; a
+    client whose outbox overflows is disconnected. {"type": "stats"} returns queue depth
+    and worker utilisation.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.queue = collections.deque()
+        self.jobs = {}
+        self.started_at = time.monotonic()
+        self.dispatched = 0
+        self.completed = 0
+        self._seq = 0
 
-    clients = set()
+    def workers(self):
+        return [c for c in self.clients if c.role == 'worker']
 
-    async def safe_send(ws, message):
+    def send(self, conn: BridgeClientConn, message):
         try:
-            await ws.send(message)
-        except websockets.exceptions.ConnectionClosed:
-            pass
-        except Exception as e:
-            print(f"⚠️ Error sending to client: {e}")
+            conn.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            print(f"⚠️ [WS Server] {conn.name} is not keeping up ({BRIDGE_CLIENT_MAX_QUEUE} messages queued); disconnecting it")
+            asyncio.create_task(conn.ws.close(code=1013, reason='outbox full'))
 
-    async def handler(websocket):
-        clients.add(websocket)
-        print(f"[WS Server] Client connected. total clients={len(clients)}")
+    async def _writer(self, conn: BridgeClientConn):
+        import websockets
+        while True:
+            message = await conn.outbox.get()
+            try:
+                await conn.ws.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                return
+            except Exception as e:
+                print(f"⚠️ Error sending to {conn.name}: {e}")
+
+    async def handler(self, websocket):
+        import websockets
+        self._seq += 1
+        conn = BridgeClientConn(websocket, f"client-{self._seq}")
+        conn.writer = asyncio.create_task(self._writer(conn))
+        self.clients.add(conn)
+        print(f"[WS Server] {conn.name} connected. total clients={len(self.clients)}")
         try:
             async for message in websocket:
-
-                for ws in list(clients):
-                    if ws != websocket:
-                        await safe_send(ws, message)
+                self.on_message(conn, message)
+        except websockets.exceptions.ConnectionClosedError as e:
+            print(f"[WS Server] {conn.name} dropped its connection: {e}")
         finally:
-            clients.remove(websocket)
-            print(f"[WS Server] Client disconnected. total clients={len(clients)}")
+            self.clients.discard(conn)
+            conn.writer.cancel()
+            self.on_disconnect(conn)
+            print(f"[WS Server] {conn.name} ({conn.role}) disconnected. total clients={len(self.clients)}")
+
+    def on_message(self, conn: BridgeClientConn, message):
+        if isinstance(message, (bytes, bytearray)):
+            try:
+                header = read_frame_header(message)
+            except Exception as e:
+                print(f"⚠️ [WS Server] bad frame from {conn.name}: {e}")
+                return
+            if header.get('id') is None:
+                # Only text prompts can be legacy; a binary frame can't be given an id after the fact.
+                print(f"⚠️ [WS Server] ignoring binary frame without an id from {conn.name}")
+                return
+            self.submit(conn, header.get('id'), message)
+            return
 
-    server = await websockets.serve(handler, host, port, max_size=None)
+        try:
+            data = json.loads(message)
+        except Exception:
+            data = None
+        if not isinstance(data, dict):
+            if conn.role == 'worker' and conn.current is not None:
+                self.finish(conn, conn.current.id, message)
+            else:
+                self.submit(conn, None, json.dumps({'prompt': message}))
+            return
+        if (conn.role == 'worker' and conn.current is not None and 'type' not in data
+                and 'prompt' not in data and not data.get('__control__')):
+            # Older extensions reply with the bare action object, e.g. {"action": ...}.
+            self.finish(conn, conn.current.id, message)
+            return
+
+        kind = data.get('type')
+        if kind == 'register':
+            conn.role = 'worker' if data.get('role') == 'worker' else 'requester'
+            print(f"[WS Server] {conn.name} registered as {conn.role}")
+            self.dispatch()
+        elif kind == 'reply':
+            self.finish(conn, data.get('id'), data.get('reply'))
+        elif kind == 'chunk':
+            self.relay_chunk(conn, data.get('id'), message)
+        elif kind == 'done':
+            self.finish(conn, data.get('id'), data.get('reply'), kind='done')
+        elif kind == 'cancelled':
+            self.finish(conn, data.get('id'), None)
+        elif kind == 'cancel':
+            self.cancel(data.get('id'))
+        elif kind == 'stats':
+            self.send(conn, json.dumps({'type': 'stats', **self.stats()}))
+        elif data.get('__control__'):
+            for worker in self.workers():
+                self.send(worker, message)
+        elif 'prompt' in data:
+            self.submit(conn, data.get('id'), message)
+        else:
+            print(f"⚠️ [WS Server] ignoring message from {conn.name}: {message[:120]!r}")
+
+    def submit(self, requester: BridgeClientConn, job_id, message):
+        legacy = job_id is None
+        if legacy:
+            job_id = f"legacy-{uuid.uuid4().hex}"
+            data = json.loads(message)
+            data['id'] = job_id
+            message = json.dumps(data)
+        job = BridgeJob(job_id, requester, message, legacy)
+        self.jobs[job_id] = job
+        self.queue.append(job)
+        self.dispatch()
+
+    def dispatch(self):
+        idle = [w for w in self.workers() if w.current is None]
+        # Least busy first, so work spreads evenly across workers.
+        idle.sort(key=lambda w: w.busy_time())
+        while self.queue and idle:
+            job = self.queue.popleft()
+            if job.cancelled:
+                continue
+            worker = idle.pop(0)
+            worker.current = job
+            worker.busy_since = job.dispatched_at = time.monotonic()
+            if _tracer is not None:
+                _tracer.record('bridge.queue_wait', job.dispatched_at - job.queued_at)
+            self.dispatched += 1
+            self.send(worker, job.message)
+        if self.queue:
+            print(f"[WS Server] {len(self.queue)} prompt(s) waiting for a worker")
+
+    def relay_chunk(self, worker: BridgeClientConn, job_id, message):
+        job = self.jobs.get(job_id)
+        if job is None or job.cancelled or job.legacy or worker.current is not job or job.requester not in self.clients:
+            return
+        if job.chunks_dropped:
+            return
+        # Chunks are only a head start; the final 'done' carries the whole reply, so under
+        # back-pressure stop relaying them rather than risk disconnecting the requester.
+        if job.requester.outbox.qsize() >= BRIDGE_CLIENT_MAX_QUEUE // 2:
+            job.chunks_dropped = True
+            print(f"⚠️ [WS Server] {job.requester.name} is behind; not streaming the rest of {job.id[:8]}")
+            return
+        self.send(job.requester, message)
+
+    def finish(self, worker: BridgeClientConn, job_id, reply, kind: str = 'reply'):
+        if reply is not None and not isinstance(reply, str):
+            print(f"⚠️ [WS Server] {worker.name} sent a non-text reply for {job_id!r}; passing it on as JSON")
+            reply = json.dumps(reply, ensure_ascii=False)
+        job = self.jobs.pop(job_id, None)
+        if worker.current is not None and worker.current.id == job_id:
+            worker.current = None
+            worker.busy_total += time.monotonic() - worker.busy_since
+            worker.busy_since = None
+        if job is None:
+            print(f"⚠️ [WS Server] reply for unknown job {job_id!r} from {worker.name}")
+        elif not job.cancelled and reply is not None and job.requester in self.clients:
+            self.completed += 1
+            if _tracer is not None and job.dispatched_at is not None:
+                # Time the worker (the model) spent on it, separate from the controller's round trip.
+                _tracer.record('bridge.worker', time.monotonic() - job.dispatched_at, len(reply.encode('utf-8')))
+            if job.legacy:
+                self.send(job.requester, reply)
+            else:
+                self.send(job.requester, json.dumps({'type': kind, 'id': job.id, 'reply': reply}))
+        self.dispatch()
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.cancelled = True
+        for worker in self.workers():
+            if worker.current is job:
+                # The worker stays busy until it reports back, then the reply is dropped.
+                self.send(worker, json.dumps({'type': 'cancel', 'id': job_id}))
+                return
+        self.jobs.pop(job_id, None)
+
+    def on_disconnect(self, conn: BridgeClientConn):
+        if conn.current is not None:
+            job = conn.current
+            conn.current = None
+            if not job.cancelled:
+                print(f"[WS Server] requeueing {job.id[:8]} from disconnected {conn.name}")
+                self.queue.appendleft(job)
+        for job in list(self.jobs.values()):
+            if job.requester is conn:
+                self.cancel(job.id)
+        self.dispatch()
+
+    def stats(self) -> dict:
+        workers = self.workers()
+        uptime = max(time.monotonic() - self.started_at, 1e-9)
+        connected = sum(time.monotonic() - w.connected_at for w in workers)
+        busy = sum(w.busy_time() for w in workers)
+        return {
+            'queue_depth': sum(1 for j in self.queue if not j.cancelled),
+            'workers': len(workers),
+            'busy_workers': sum(1 for w in workers if w.current is not None),
+            'requesters': len(self.clients) - len(workers),
+            'dispatched': self.dispatched,
+            'completed': self.completed,
+            'utilisation': round(busy / connected, 3) if connected else 0.0,
+            'uptime': round(uptime, 1),
+        }
+
+async def start_bridge_server(host: Optional[str] = None, port: Optional[int] = None):
+    """Serve the bridge broker; host and port default to those of BRIDGE_URL."""
+    url = urlsplit(BRIDGE_URL)
+    host = host or url.hostname
+    port = port or url.port
+    try:
+        import websockets
+    except Exception as e:
+        print(f"⚠️ websockets package not available; bridge server will not start: {e}")
+        return None
+
+    broker = BridgeBroker()
+    server = await websockets.serve(broker.handler, host, port, max_size=None)
+    server.broker = broker
     print(f"[WS Server] listening on ws://{host}:{port}")
     return server
 
 BASE_DIR = Path(__file__).resolve().parent
-COMMANDS_PATH = BASE_DIR / 'commands.txt'
+COMMANDS_PATH = BASE_DIR / 'commands.jsonl'
+# The prompt gets the last HISTORY_RECENT_COMMANDS commands verbatim plus a summary of the
+# older ones (repeats collapsed, at most HISTORY_SUMMARY_LINES lines), so its size stays flat
+# however long the session runs. The full log is still written to disk in batches.
+HISTORY_RECENT_COMMANDS = 20
+HISTORY_SUMMARY_LINES = 25
+HISTORY_SUMMARY_MAX_KEYS = 500
+HISTORY_FLUSH_EVERY = 20
+
+# "interactive" writes a compact index of visible, interactive elements to page.txt;
+# "html" keeps the old behaviour of dumping the full page.content().
+PAGE_SNAPSHOT_MODE = 'interactive'
+SNAPSHOT_MAX_ELEMENTS = 400
+SNAPSHOT_MAX_CHARS = 40000
+REF_SELECTOR_ENGINE = 'agent-ref'
+
+# Artifacts live in memory and are sent straight over the bridge. Point this at a
+# directory (e.g. BASE_DIR) to also write page.txt / screenshot.png there for debugging.
+ARTIFACTS_DEBUG_DIR: Optional[Path] = None
+
+BRIDGE_URL = 'ws://localhost:8765'
+BRIDGE_REQUEST_TIMEOUT = 120.0
+BRIDGE_RECONNECT_MIN_DELAY = 0.5
+BRIDGE_RECONNECT_MAX_DELAY = 30.0
+# Messages that may wait in one bridge client's outbox before it is considered too slow.
+BRIDGE_CLIENT_MAX_QUEUE = 32
+# Ask workers to stream replies so unattended runs can start on the first action while the
+# model is still writing the rest. Workers that can't stream just reply once at the end.
+STREAM_REPLIES = True
+
+# After each action we wait for the page to settle (see SettleDetector), at most SETTLE_TIMEOUT.
+SETTLE_TIMEOUT = 5.0
+SETTLE_NETWORK_IDLE_MS = 300
+SETTLE_DOM_QUIET_MS = 200
+# Long-lived requests that never "finish" and must not hold up settling.
+SETTLE_IGNORED_RESOURCE_TYPES = {'eventsource', 'websocket', 'media'}
+
+# Every browser context routes its requests through a RequestRouter (see ROUTING_PROFILE):
+# resource types and domains the agent never needs are aborted, and static assets are kept
+# in HTTP_CACHE_DIR across runs for as long as their Cache-Control/Expires headers allow (at most
+# HTTP_CACHE_TTL_DAYS), dropped sooner when the cache outgrows HTTP_CACHE_MAX_BYTES (oldest first).
+# Requests carrying cookies or credentials, and responses that vary on them, are never cached.
+HTTP_CACHE_DIR = BASE_DIR / 'http_cache'
+HTTP_CACHE_TTL_DAYS = 7
+HTTP_CACHE_MAX_BYTES = 300 * 1024 * 1024
+HTTP_CACHE_MAX_ENTRY_BYTES = 5 * 1024 * 1024
+
+# `--serve-browser` keeps one browser (reachable over CDP on BROWSER_DAEMON_PORT) and the bridge
+# running; later runs find it through BROWSER_DAEMON_STATE and attach instead of launching.
+BROWSER_DAEMON_PORT = 9222
+BROWSER_DAEMON_STATE = BASE_DIR / 'browser_daemon.json'
+BROWSER_DAEMON_CONNECT_TIMEOUT = 3.0
+
+# Retries after a missing or unusable reply back off exponentially from RETRY_BASE_DELAY.
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# The interactive session's goal; asked for when main() starts.
+task = None
+
+# Successful runs are recorded as trajectories and learned into the replay cache; with
+# --replay, a step whose (task, page fingerprint) is cached runs without asking the model.
+TRAJECTORIES_DIR = BASE_DIR / 'trajectories'
+REPLAY_CACHE_PATH = BASE_DIR / 'replay_cache.json'
+REPLAY_CACHE_MAX_ENTRIES = 500
+REPLAY_CACHE_TTL_DAYS = 30
+
+# Loop breaker: a step starts from a page state (URL + normalised snapshot + screenshot hash).
+# The agent is stopped (or, interactively, control goes back to you) when the same actions are
+# taken from the same state LOOP_REPEAT_LIMIT times, or LOOP_STALL_STEPS steps in a row start
+# from an unchanged state. 0 turns a check off. Trips are appended to LOOP_EVENTS_PATH
+# (runs/<task id>/loop_events.jsonl in batch mode).
+LOOP_REPEAT_LIMIT = 3
+LOOP_STALL_STEPS = 5
+LOOP_EVENTS_PATH = BASE_DIR / 'loop_events.jsonl'
+
+# Batch runs: each task gets runs/<task id>/ for its commands log (and debug artifacts).
+BATCH_RUNS_DIR = BASE_DIR / 'runs'
+BATCH_CONCURRENCY = 2
+BATCH_MAX_STEPS = 30
+
+# Per-step timing: spans for every @traced phase are appended to TRACE_PATH as JSONL and
+# summarised (p50/p95 over the last TRACE_SUMMARY_WINDOW spans per phase) when the run ends.
+# Tracing wraps those functions only once enabled, so with --no-trace they run untouched.
+TRACE_ENABLED = True
+TRACE_PATH = BASE_DIR / 'traces.jsonl'
+TRACE_SUMMARY_WINDOW = 500
+TRACE_FLUSH_EVERY = 50
+
+_TRACEABLE = []
+_tracer = None
+# (task id, step number) of the code currently running; each asyncio task has its own.
+_trace_scope = contextvars.ContextVar('trace_scope', default=None)
+
+def traced(phase: str, size=None, outcome=None):
+    """Mark a function (sync or async) as a traced phase. Nothing changes until enable_tracing().
+
+    `size(result)` gives the span's payload bytes, `outcome(result)` a short result label.
+    """
+    def mark(fn):
+        _TRACEABLE.append((fn.__qualname__, phase, size, outcome))
+        return fn
+    return mark
+
+def _percentile(ordered: list, pct: float) -> float:
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class Tracer:
+    """Collects spans, writes them out in batches and keeps a rolling window per phase."""
+
+    def __init__(self, path: Path, window: int = TRACE_SUMMARY_WINDOW, flush_every: int = TRACE_FLUSH_EVERY):
+        self.path = path
+        self.run = uuid.uuid4().hex[:8]
+        self.window = window
+        self.flush_every = flush_every
+        self.samples = {}
+        self.pending = []
+        # Traced functions also run on worker threads (asyncio.to_thread), so spans can arrive
+        # from several threads at once.
+        self.lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float, size: Optional[int] = None, outcome: Optional[str] = None,
+               error: Optional[str] = None):
+        entry = {'ts': round(time.time(), 3), 'run': self.run, 'phase': phase, 'ms': round(seconds * 1000, 2)}
+        scope = _trace_scope.get()
+        if scope is not None:
+            entry['task'], entry['step'] = scope
+        if size is not None:
+            entry['bytes'] = size
+        if outcome is not None:
+            entry['outcome'] = outcome
+        if error is not None:
+            entry['error'] = error[:200]
+        with self.lock:
+            samples = self.samples.get(phase)
+            if samples is None:
+                samples = self.samples[phase] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+            self.pending.append(entry)
+            full = len(self.pending) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            lines = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in self.pending)
+            self.pending = []
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+            except Exception as e:
+                print(f"⚠️ Could not write traces to {self.path}: {e}")
+
+    def summary(self) -> dict:
+        result = {}
+        with self.lock:
+            snapshot = [(phase, sorted(samples)) for phase, samples in sorted(self.samples.items())]
+        for phase, ordered in snapshot:
+            result[phase] = {
+                'count': len(ordered),
+                'p50_ms': round(_percentile(ordered, 50) * 1000, 1),
+                'p95_ms': round(_percentile(ordered, 95) * 1000, 1),
+                'total_ms': round(sum(ordered) * 1000, 1),
+            }
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        print(f"\n⏱ Trace summary (last {self.window} spans per phase):")
+        print(f"  {'phase':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'total ms':>10}")
+        for phase, row in summary.items():
+            print(f"  {phase:<24} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['total_ms']:>10.1f}")
+
+    def close(self):
+        self.flush()
+        self.print_summary()
+        try:
+            summary_path = self.path.with_suffix('.summary.json')
+            summary_path.write_text(json.dumps({'run': self.run, 'phases': self.summary()}, indent=2), encoding='utf-8')
+        except Exception as e:
+            print(f"⚠️ Could not write trace summary: {e}")
 
-task = input("What is your goal? ")
+def _trace_wrapper(fn, phase: str, size, outcome):
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                _tracer.record(phase, time.perf_counter() - started, outcome='exception', error=str(e))
+                raise
+            _tracer.record(phase, time.perf_counter() - started,
+                           size(result) if size else None, outcome(result) if outcome else None)
+            return result
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                _tracer.record(phase, time.perf_counter() - started, outcome='exception', error=str(e))
+                raise
+            _tracer.record(phase, time.perf_counter() - started,
+                           size(result) if size else None, outcome(result) if outcome else None)
+            return result
+    return wrapper
+
+def enable_tracing(path: Optional[Path] = None) -> Tracer:
+    """Start recording spans for every @traced function. Safe to call more than once."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path or TRACE_PATH)
+        module = sys.modules[__name__]
+        for qualname, phase, size, outcome in _TRACEABLE:
+            owner_name, _, attr = qualname.rpartition('.')
+            owner = getattr(module, owner_name) if owner_name else module
+            setattr(owner, attr, _trace_wrapper(getattr(owner, attr), phase, size, outcome))
+        print(f"⏱ Tracing enabled; spans go to {_tracer.path}")
+    return _tracer
+
+def trace_step(task_id: str, step: int):
+    """Tag the spans that follow (in this asyncio task) with a task id and step number."""
+    if _tracer is not None:
+        _trace_scope.set((task_id, step))
+
+def finish_tracing():
+    if _tracer is not None:
+        _tracer.close()
+
+def _ok_or_error(ok) -> str:
+    return 'ok' if ok else 'error'
+
+# Why the last action in this asyncio task failed, for its entry in the batch's result vector.
+_action_error = contextvars.ContextVar('action_error', default=None)
+
+def _action_failed(message: str):
+    print(message)
+    _action_error.set(message.lstrip('❌❓ ').splitlines()[0][:300])
 
 def parse_selector(raw: str) -> str:
     if "=" not in raw:
@@ -66,6 +579,10 @@ def parse_selector(raw: str) -> str:
     elif sel_type == "attr":
         key, val = value.split("=", 1)
         return f"[{key}='{val}']"
+    elif sel_type == "ref":
+        if not value.isdigit():
+            raise ValueError(f"ref selector expects a numeric handle, got: {value}")
+        return f"{REF_SELECTOR_ENGINE}={int(value)}"
     else:
         raise ValueError(f"Unsupported selector type: {sel_type}")
 
@@ -73,119 +590,1382 @@ async def get_locator(page, raw_selector: str):
     selector = parse_selector(raw_selector)
     return page.locator(selector)
 
-async def capture_artifacts(page):
+def selector_check(raw_selector: str) -> list:
+    """What SELECTOR_CHECK_SCRIPT needs to look a selector up in the page: [kind, value]."""
+    selector = parse_selector(raw_selector)
+    kind = raw_selector.split('=', 1)[0].strip().lower()
+    if kind == 'ref':
+        return ['ref', selector.split('=', 1)[1]]
+    if kind == 'text':
+        return ['text', selector.split('=', 1)[1].strip().strip('"\'')]
+    return ['css', selector]
+
+# Counts the elements each [kind, value] check matches, all in one evaluation. -1 means "can't
+# tell from here" (text present somewhere, a selector only Playwright understands, shadow DOM),
+# in which case the action itself finds out. 0 is only returned when nothing can match.
+SELECTOR_CHECK_SCRIPT = """
+(checks) => {
+  let shadowHosts = null;
+  const hosts = () => {
+    if (shadowHosts === null) shadowHosts = Array.from(document.querySelectorAll('*')).filter(el => el.shadowRoot);
+    return shadowHosts;
+  };
+  const norm = s => (s || '').replace(/\\s+/g, ' ').trim().toLowerCase();
+  return checks.map(([kind, value]) => {
+    try {
+      if (kind === 'ref') {
+        const refs = window.__agentRefs;
+        const el = refs ? refs[Number(value)] : null;
+        return el && el.isConnected ? 1 : 0;
+      }
+      if (kind === 'text') {
+        const needle = norm(value);
+        if (norm(document.body && document.body.textContent).includes(needle)) return -1;
+        for (const el of document.querySelectorAll('input[type=button], input[type=submit], input[type=reset]')) {
+          if (norm(el.value).includes(needle)) return -1;
+        }
+        return hosts().length ? -1 : 0;
+      }
+      const count = document.querySelectorAll(value).length;
+      return count || (hosts().length ? -1 : 0);
+    } catch (e) {
+      return -1;
+    }
+  });
+}
+"""
+
+# Actions that can replace or rework the page. Selectors after one of these in a batch are
+# only looked up when their turn comes, since their elements may not exist yet.
+PAGE_CHANGING_ACTIONS = {'open_url', 'click_element'}
+
+@traced('validate', outcome=lambda errors: 'error' if any(errors) else 'ok')
+async def validate_action_selectors(page, actions: list) -> list:
+    """Look up every selector the batch uses before the page changes, in one page evaluation.
+
+    Returns one error message (or None) per action.
+    """
+    errors = [None] * len(actions)
+    checks, owners = [], []
+    page_may_change = False
+    for i, act in enumerate(actions):
+        name = act.get('action')
+        if name in ('click_element', 'send_keys'):
+            raw = str((act.get('args') or [''])[0])
+            try:
+                check = selector_check(raw)
+            except ValueError as e:
+                errors[i] = f"invalid selector {raw!r}: {e}"
+            else:
+                if not page_may_change:
+                    checks.append(check)
+                    owners.append(i)
+        page_may_change = page_may_change or name in PAGE_CHANGING_ACTIONS
+    if not checks:
+        return errors
+    try:
+        counts = await page.evaluate(SELECTOR_CHECK_SCRIPT, checks)
+    except Exception as e:
+        print(f"⚠️ Could not check selectors up front; each action will find out: {e}")
+        return errors
+    if not isinstance(counts, list) or len(counts) != len(checks):
+        return errors
+    for i, count in zip(owners, counts):
+        raw = actions[i]['args'][0]
+        if count == 0:
+            errors[i] = f"no element matches {raw}"
+        elif count > 1 and actions[i].get('action') == 'send_keys':
+            errors[i] = f"{raw} matches {count} elements; send_keys needs exactly one"
+    return errors
+
+# Resolves ref=N against window.__agentRefs, the element table kept by the last snapshot.
+REF_SELECTOR_ENGINE_SCRIPT = """
+({
+  query(root, selector) {
+    const refs = window.__agentRefs;
+    const el = refs ? refs[Number(selector)] : null;
+    return el && el.isConnected && (root === document || root.contains(el)) ? el : null;
+  },
+  queryAll(root, selector) {
+    const el = this.query(root, selector);
+    return el ? [el] : [];
+  }
+})
+"""
+
+async def register_ref_selector_engine(playwright) -> bool:
+    """Register the ref=N selector engine. Must run before any page is created."""
+    try:
+        await playwright.selectors.register(REF_SELECTOR_ENGINE, REF_SELECTOR_ENGINE_SCRIPT)
+        return True
+    except Exception as e:
+        print(f"⚠️ Could not register {REF_SELECTOR_ENGINE} selector engine; ref= selectors will fail: {e}")
+        return False
+
+SNAPSHOT_SCRIPT = """
+(maxElements) => {
+  const INTERACTIVE_ROLES = new Set(['button', 'link', 'checkbox', 'radio', 'tab', 'menuitem',
+    'menuitemcheckbox', 'menuitemradio', 'option', 'textbox', 'searchbox', 'combobox',
+    'switch', 'slider', 'spinbutton', 'treeitem']);
+  const INTERACTIVE_TAGS = new Set(['a', 'button', 'input', 'select', 'textarea', 'summary', 'option']);
+  const clip = (s, n) => {
+    s = (s || '').replace(/\\s+/g, ' ').trim();
+    return s.length > n ? s.slice(0, n - 1) + '…' : s;
+  };
+  const isInteractive = el => {
+    const tag = el.tagName.toLowerCase();
+    if (INTERACTIVE_TAGS.has(tag)) return !(tag === 'a' && !el.hasAttribute('href') && !el.hasAttribute('onclick'));
+    const role = el.getAttribute('role');
+    if (role && INTERACTIVE_ROLES.has(role)) return true;
+    if (el.isContentEditable && (!el.parentElement || !el.parentElement.isContentEditable)) return true;
+    if (el.hasAttribute('onclick')) return true;
+    const tabindex = el.getAttribute('tabindex');
+    return tabindex !== null && Number(tabindex) >= 0;
+  };
+  const labelFor = el => {
+    const aria = el.getAttribute('aria-label');
+    if (aria) return aria;
+    const labelledby = el.getAttribute('aria-labelledby');
+    if (labelledby) {
+      const txt = labelledby.split(/\\s+/).map(id => document.getElementById(id)).filter(Boolean).map(n => n.innerText).join(' ');
+      if (txt.trim()) return txt;
+    }
+    if (el.labels && el.labels.length) return Array.from(el.labels).map(l => l.innerText).join(' ');
+    const tag = el.tagName.toLowerCase();
+    if (tag === 'input' || tag === 'textarea') {
+      return el.getAttribute('placeholder') || (el.type === 'submit' || el.type === 'button' ? el.value : '') || el.getAttribute('title') || '';
+    }
+    if (tag === 'select') {
+      const opt = el.selectedOptions && el.selectedOptions[0];
+      return opt ? opt.text : '';
+    }
+    return el.innerText || el.getAttribute('title') || el.getAttribute('alt') ||
+      (el.querySelector('img[alt]') || {}).alt || '';
+  };
+
+  const refs = [null];
+  const items = [];
+  let total = 0;
+  const walker = document.createTreeWalker(document.body || document.documentElement, NodeFilter.SHOW_ELEMENT);
+  for (let el = walker.currentNode; el; el = walker.nextNode()) {
+    if (!isInteractive(el)) continue;
+    const rect = el.getBoundingClientRect();
+    if (rect.width <= 0 || rect.height <= 0) continue;
+    const style = getComputedStyle(el);
+    if (style.visibility === 'hidden' || style.display === 'none' || Number(style.opacity) === 0) continue;
+    total++;
+    if (items.length >= maxElements) continue;
+    const ref = refs.length;
+    refs.push(el);
+    const tag = el.tagName.toLowerCase();
+    items.push({
+      ref,
+      tag,
+      role: el.getAttribute('role') || '',
+      type: tag === 'input' ? (el.getAttribute('type') || 'text') : '',
+      label: clip(labelFor(el), 80),
+      id: el.id || '',
+      name: el.getAttribute('name') || '',
+      href: tag === 'a' ? clip(el.getAttribute('href'), 80) : '',
+      value: (tag === 'input' || tag === 'textarea') && el.type !== 'password' ? clip(el.value, 40) : '',
+      box: [Math.round(rect.left + window.scrollX), Math.round(rect.top + window.scrollY),
+            Math.round(rect.width), Math.round(rect.height)],
+    });
+  }
+  window.__agentRefs = refs;
+  return {url: location.href, title: document.title, total, items};
+}
+"""
+
+def format_snapshot(snap: dict, max_chars: int = SNAPSHOT_MAX_CHARS) -> str:
+    """Render the result of SNAPSHOT_SCRIPT as one line per element, capped at max_chars."""
+    items = snap.get('items') or []
+    lines = [
+        f"# url: {snap.get('url', '')}",
+        f"# title: {snap.get('title', '')}",
+        f"# {snap.get('total', len(items))} visible interactive elements; select one with ref=N",
+    ]
+    size = sum(len(l) + 1 for l in lines)
+    shown = 0
+    for item in items:
+        parts = [f"[{item['ref']}]", item['tag']]
+        if item.get('role'):
+            parts.append(f"role={item['role']}")
+        if item.get('type'):
+            parts.append(f"type={item['type']}")
+        if item.get('id'):
+            parts.append(f"id={item['id']}")
+        if item.get('name'):
+            parts.append(f"name={item['name']}")
+        if item.get('label'):
+            parts.append(json.dumps(item['label'], ensure_ascii=False))
+        if item.get('value'):
+            parts.append(f"value={json.dumps(item['value'], ensure_ascii=False)}")
+        if item.get('href'):
+            parts.append(f"href={item['href']}")
+        x, y, w, h = item['box']
+        parts.append(f"@{x},{y} {w}x{h}")
+        line = ' '.join(parts)
+        if size + len(line) + 1 > max_chars:
+            break
+        lines.append(line)
+        size += len(line) + 1
+        shown += 1
+    omitted = snap.get('total', len(items)) - shown
+    if omitted > 0:
+        lines.append(f"# … {omitted} more elements omitted")
+    return '\n'.join(lines) + '\n'
+
+@traced('snapshot', size=len)
+async def snapshot_interactive(page) -> str:
+    """Walk the live DOM once and return a compact index of visible, interactive elements.
+
+    Each element is numbered; ref=N selectors resolve against this snapshot until the next one.
+    """
+    snap = await page.evaluate(SNAPSHOT_SCRIPT, SNAPSHOT_MAX_ELEMENTS)
+    return format_snapshot(snap)
+
+@dataclass
+class ScreenshotPolicy:
+    """How capture_artifacts takes the screenshot.
 
-    screenshot_path = "screenshot.png"
+    max_width downscales the captured region; max_height then crops what is left.
+    webp and downscaling need Chromium (CDP); other browsers fall back to page.screenshot.
+    """
+    full_page: bool = False
+    max_width: Optional[int] = 1280
+    max_height: Optional[int] = 2000
+    format: str = 'jpeg'  # png | jpeg | webp
+    quality: int = 70
+    clip_to_last_element: bool = False
+    clip_margin: int = 200
+    # Send an "unchanged" note instead of a look-alike screenshot. Only useful when the worker
+    # keeps one conversation going; the bridge page opens a fresh chat for every prompt.
+    skip_unchanged: bool = False
+    phash_threshold: int = 4
+
+SCREENSHOT_POLICIES = {
+    'full-png': ScreenshotPolicy(full_page=True, max_width=None, max_height=None, format='png', skip_unchanged=False),
+    'viewport-png': ScreenshotPolicy(format='png'),
+    'viewport-jpeg': ScreenshotPolicy(format='jpeg', quality=70),
+    'viewport-webp': ScreenshotPolicy(format='webp', quality=70),
+    'full-jpeg-capped': ScreenshotPolicy(full_page=True, format='jpeg', quality=60),
+    'element-jpeg': ScreenshotPolicy(format='jpeg', quality=70, clip_to_last_element=True),
+}
+SCREENSHOT_POLICY = SCREENSHOT_POLICIES['viewport-jpeg']
+
+_cdp_sessions = weakref.WeakKeyDictionary()
+
+async def get_cdp_session(page):
+    """Return a cached CDP session for `page`, or None when the browser is not Chromium."""
+    if page in _cdp_sessions:
+        return _cdp_sessions[page]
     try:
-        await page.screenshot(path=screenshot_path, full_page=True)
-        print(f"📸 Screenshot saved: {screenshot_path}")
+        session = await page.context.new_cdp_session(page)
+    except Exception:
+        session = None
+    _cdp_sessions[page] = session
+    return session
+
+def decode_png_grayscale(data: bytes):
+    """Decode an 8-bit RGB/RGBA/gray PNG into (width, height, rows of luminance values).
+
+    Only meant for the tiny thumbnails used by the perceptual hash.
+    """
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("not a PNG")
+    pos = 8
+    idat = []
+    width = height = color_type = None
+    while pos < len(data):
+        length, ctype = struct.unpack_from('>I4s', data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if ctype == b'IHDR':
+            width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+            if depth != 8 or interlace:
+                raise ValueError("unsupported PNG layout")
+        elif ctype == b'IDAT':
+            idat.append(chunk)
+        elif ctype == b'IEND':
+            break
+    channels = {0: 1, 2: 3, 4: 2, 6: 4}[color_type]
+    raw = zlib.decompress(b''.join(idat))
+    stride = width * channels
+    prev = bytearray(stride)
+    rows = []
+    pos = 0
+    for _ in range(height):
+        ftype = raw[pos]
+        line = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        for i in range(stride):
+            a = line[i - channels] if i >= channels else 0
+            b = prev[i]
+            c = prev[i - channels] if i >= channels else 0
+            if ftype == 1:
+                line[i] = (line[i] + a) & 0xFF
+            elif ftype == 2:
+                line[i] = (line[i] + b) & 0xFF
+            elif ftype == 3:
+                line[i] = (line[i] + ((a + b) >> 1)) & 0xFF
+            elif ftype == 4:
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                pred = a if pa <= pb and pa <= pc else (b if pb <= pc else c)
+                line[i] = (line[i] + pred) & 0xFF
+        prev = line
+        if channels >= 3:
+            rows.append([(299 * line[x] + 587 * line[x + 1] + 114 * line[x + 2]) // 1000 for x in range(0, stride, channels)])
+        else:
+            rows.append(list(line[0:stride:channels]))
+    return width, height, rows
+
+def dhash(width: int, height: int, rows) -> int:
+    """64-bit difference hash over a 9x8 grid of block-averaged luminance."""
+    grid = []
+    for gy in range(8):
+        y0, y1 = gy * height // 8, max(gy * height // 8 + 1, (gy + 1) * height // 8)
+        line = []
+        for gx in range(9):
+            x0, x1 = gx * width // 9, max(gx * width // 9 + 1, (gx + 1) * width // 9)
+            cells = [rows[y][x] for y in range(y0, min(y1, height)) for x in range(x0, min(x1, width))]
+            line.append(sum(cells) / len(cells) if cells else 0)
+        grid.append(line)
+    value = 0
+    for line in grid:
+        for x in range(8):
+            value = (value << 1) | (1 if line[x] > line[x + 1] else 0)
+    return value
+
+async def _screenshot_region(page, cdp, policy: ScreenshotPolicy, focus_box):
+    """Return the CSS-pixel region (x, y, width, height) to capture, in page coordinates."""
+    metrics = await cdp.send('Page.getLayoutMetrics')
+    viewport = metrics.get('cssVisualViewport') or metrics['visualViewport']
+    content = metrics.get('cssContentSize') or metrics['contentSize']
+    if policy.clip_to_last_element and focus_box:
+        m = policy.clip_margin
+        x = max(0, focus_box['x'] + viewport['pageX'] - m)
+        y = max(0, focus_box['y'] + viewport['pageY'] - m)
+        return x, y, focus_box['width'] + 2 * m, focus_box['height'] + 2 * m
+    if policy.full_page:
+        return 0, 0, content['width'], content['height']
+    return viewport['pageX'], viewport['pageY'], viewport['clientWidth'], viewport['clientHeight']
+
+@traced('screenshot', size=lambda r: len(r[0]) if r[0] else 0, outcome=lambda r: 'ok' if r[0] else 'skipped')
+async def take_screenshot(page, policy: ScreenshotPolicy, focus_box=None, previous_hash=None):
+    """Capture a screenshot according to `policy`.
+
+    Returns (bytes or None, mime type, perceptual hash or None). The hash is taken on every
+    CDP capture (the loop breaker uses it); bytes is None when policy.skip_unchanged is set
+    and the page looks the same as `previous_hash`.
+    """
+    cdp = await get_cdp_session(page)
+    if cdp is None:
+        fmt = 'jpeg' if policy.format == 'webp' else policy.format
+        kwargs = {'full_page': policy.full_page, 'type': fmt, 'scale': 'css'}
+        if fmt == 'jpeg':
+            kwargs['quality'] = policy.quality
+        if policy.clip_to_last_element and focus_box:
+            m = policy.clip_margin
+            kwargs['clip'] = {'x': max(0, focus_box['x'] - m), 'y': max(0, focus_box['y'] - m),
+                              'width': focus_box['width'] + 2 * m, 'height': focus_box['height'] + 2 * m}
+        return await page.screenshot(**kwargs), f'image/{fmt}', None
+
+    x, y, w, h = await _screenshot_region(page, cdp, policy, focus_box)
+    beyond_viewport = policy.full_page or bool(policy.clip_to_last_element and focus_box)
+    phash = None
+    thumb = await cdp.send('Page.captureScreenshot', {
+        'format': 'png',
+        'clip': {'x': x, 'y': y, 'width': w, 'height': h, 'scale': min(1.0, 36 / max(w, 1))},
+        'captureBeyondViewport': beyond_viewport,
+    })
+    try:
+        phash = dhash(*decode_png_grayscale(base64.b64decode(thumb['data'])))
+    except Exception as e:
+        print(f"⚠️ Perceptual hash failed: {e}")
+    if policy.skip_unchanged and phash is not None and previous_hash is not None and \
+            bin(phash ^ previous_hash).count('1') <= policy.phash_threshold:
+        return None, f'image/{policy.format}', phash
+
+    scale = min(1.0, policy.max_width / w) if policy.max_width and w else 1.0
+    if policy.max_height and h * scale > policy.max_height:
+        h = policy.max_height / scale
+    params = {
+        'format': policy.format,
+        'clip': {'x': x, 'y': y, 'width': w, 'height': h, 'scale': scale},
+        'captureBeyondViewport': beyond_viewport,
+    }
+    if policy.format in ('jpeg', 'webp'):
+        params['quality'] = policy.quality
+    shot = await cdp.send('Page.captureScreenshot', params)
+    return base64.b64decode(shot['data']), f'image/{policy.format}', phash
+
+async def measure_screenshot_policies(page, runs: int = 3, focus_box=None):
+    """Print byte size and median capture latency of every SCREENSHOT_POLICIES entry on `page`."""
+    print(f"\n📏 Screenshot policies on {page.url} (median of {runs} runs)")
+    print(f"  {'policy':<18} {'type':<11} {'bytes':>10} {'ms':>8}")
+    for name, policy in SCREENSHOT_POLICIES.items():
+        measured = ScreenshotPolicy(**{**policy.__dict__, 'skip_unchanged': False})
+        timings = []
+        size, mime = 0, ''
+        try:
+            for _ in range(runs):
+                started = time.perf_counter()
+                shot, mime, _ = await take_screenshot(page, measured, focus_box)
+                timings.append((time.perf_counter() - started) * 1000)
+                size = len(shot)
+        except Exception as e:
+            print(f"  {name:<18} failed: {e}")
+            continue
+        timings.sort()
+        marker = ' (default)' if policy is SCREENSHOT_POLICY else ''
+        print(f"  {name:<18} {mime:<11} {size:>10} {timings[len(timings) // 2]:>8.1f}{marker}")
+    print()
+
+@dataclass
+class PageArtifacts:
+    """What the model gets to see of the page after a step, kept in memory."""
+    url: str = ''
+    page_text: Optional[str] = None
+    screenshot: Optional[bytes] = None
+    screenshot_type: str = 'image/png'
+    screenshot_hash: Optional[int] = None
+    # True when the screenshot was skipped because the page looks the same as last time.
+    screenshot_unchanged: bool = False
+
+@traced('disk.artifacts')
+def save_artifacts_to_disk(artifacts: PageArtifacts, directory: Path):
+    """Debug sink: write artifacts as page.txt / screenshot.png under `directory`."""
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        if artifacts.page_text is not None:
+            tmp_path = directory / 'page.html'
+            tmp_path.write_text(artifacts.page_text, encoding='utf-8')
+            os.replace(tmp_path, directory / 'page.txt')
+        if artifacts.screenshot is not None:
+            ext = artifacts.screenshot_type.split('/')[-1]
+            (directory / f'screenshot.{ext}').write_bytes(artifacts.screenshot)
+        print(f"💾 Debug copy of artifacts written to {directory}")
+    except Exception as e:
+        print(f"⚠️ Could not write debug artifacts to {directory}: {e}")
+
+def artifacts_size(artifacts: Optional[PageArtifacts]) -> int:
+    if artifacts is None:
+        return 0
+    return len((artifacts.page_text or '').encode('utf-8')) + len(artifacts.screenshot or b'')
+
+@traced('capture', size=artifacts_size)
+async def capture_artifacts(page, policy: Optional[ScreenshotPolicy] = None, focus_box=None,
+                            previous_hash=None, debug_dir: Optional[Path] = None) -> PageArtifacts:
+    policy = policy or SCREENSHOT_POLICY
+    artifacts = PageArtifacts(url=page.url)
+
+    try:
+        started = time.perf_counter()
+        shot, mime, phash = await take_screenshot(page, policy, focus_box, previous_hash)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        artifacts.screenshot_type = mime
+        artifacts.screenshot_hash = phash
+        if shot is None:
+            artifacts.screenshot_unchanged = True
+            print(f"📸 Screenshot looks unchanged; sending marker instead ({elapsed_ms:.0f} ms)")
+        else:
+            artifacts.screenshot = shot
+            print(f"📸 Screenshot captured: {mime}, {len(shot)} bytes in {elapsed_ms:.0f} ms")
     except Exception as e:
         print(f"⚠️ Screenshot failed: {e}")
 
-    html_path = "page.html"
-    txt_path = "page.txt"
     try:
-        content = await page.content()
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        os.replace(html_path, txt_path)
-        print(f"📝 Page HTML saved as TXT: {txt_path}")
+        if PAGE_SNAPSHOT_MODE == 'interactive':
+            artifacts.page_text = await snapshot_interactive(page)
+            print(f"📝 Interactive element snapshot captured ({len(artifacts.page_text)} chars)")
+        else:
+            artifacts.page_text = await page.content()
+            print(f"📝 Page HTML captured ({len(artifacts.page_text)} chars)")
+    except Exception as e:
+        print(f"⚠️ Capture page content failed: {e}")
+
+    debug_dir = debug_dir or ARTIFACTS_DEBUG_DIR
+    if debug_dir is not None:
+        save_artifacts_to_disk(artifacts, debug_dir)
+    return artifacts
+
+# Counts DOM mutations in the page so an unchanged page can be recognised without a capture.
+# Form edits (.value, .checked) are properties, not mutations, so input/change events count too.
+MUTATION_COUNTER_SCRIPT = """
+(() => {
+  if (window.__agentMutationCount !== undefined) return;
+  window.__agentMutationCount = 0;
+  window.__agentLastMutation = 0;
+  const bump = () => { window.__agentMutationCount += 1; };
+  window.addEventListener('input', bump, true);
+  window.addEventListener('change', bump, true);
+  const start = () => {
+    new MutationObserver(records => {
+      window.__agentMutationCount += records.length;
+      window.__agentLastMutation = performance.now();
+    })
+      .observe(document.documentElement, { childList: true, subtree: true, attributes: true, characterData: true });
+  };
+  if (document.documentElement) start();
+  else document.addEventListener('DOMContentLoaded', start, { once: true });
+})()
+"""
+
+# Resolves true once the DOM has gone quietMs without a mutation, false if timeoutMs passes first.
+DOM_QUIET_SCRIPT = """
+([quietMs, timeoutMs]) => new Promise(resolve => {
+  const start = performance.now();
+  let last = window.__agentLastMutation !== undefined ? window.__agentLastMutation : start;
+  const obs = new MutationObserver(() => { last = performance.now(); });
+  obs.observe(document.documentElement, { childList: true, subtree: true, attributes: true, characterData: true });
+  const check = () => {
+    const now = performance.now();
+    if (now - last >= quietMs) {
+      obs.disconnect();
+      resolve(true);
+    } else if (now - start >= timeoutMs) {
+      obs.disconnect();
+      resolve(false);
+    } else {
+      setTimeout(check, Math.max(10, Math.min(quietMs - (now - last), timeoutMs - (now - start))));
+    }
+  };
+  check();
+})
+"""
+
+class SettleDetector:
+    """Waits until a page has settled after an action instead of sleeping a fixed time.
+
+    Settled means: no main-frame navigation pending, no tracked request in flight for
+    SETTLE_NETWORK_IDLE_MS, and no DOM mutation for SETTLE_DOM_QUIET_MS. Never waits
+    longer than SETTLE_TIMEOUT.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.inflight = set()
+        self.last_activity = time.monotonic()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        page.on('request', self._on_request)
+        page.on('requestfinished', self._on_request_done)
+        page.on('requestfailed', self._on_request_done)
+
+    def _on_request(self, request):
+        if request.resource_type in SETTLE_IGNORED_RESOURCE_TYPES:
+            return
+        self.inflight.add(request)
+        self.last_activity = time.monotonic()
+        self._idle.clear()
+
+    def _on_request_done(self, request):
+        if request in self.inflight:
+            self.inflight.discard(request)
+            self.last_activity = time.monotonic()
+            if not self.inflight:
+                self._idle.set()
+
+    def navigation_pending(self) -> bool:
+        for request in list(self.inflight):
+            try:
+                if request.is_navigation_request() and request.frame == self.page.main_frame:
+                    return True
+            except Exception:
+                continue
+        return False
+
+    async def wait_network_idle(self, idle_s: float, deadline: float) -> bool:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.inflight:
+                try:
+                    await asyncio.wait_for(self._idle.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return False
+                continue
+            quiet_for = time.monotonic() - self.last_activity
+            if quiet_for >= idle_s:
+                return True
+            await asyncio.sleep(min(idle_s - quiet_for, remaining))
+
+    async def settle(self, timeout: Optional[float] = None) -> bool:
+        timeout = SETTLE_TIMEOUT if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        settled = False
+        while time.monotonic() < deadline:
+            if self.navigation_pending():
+                try:
+                    await self.page.wait_for_load_state('domcontentloaded',
+                                                        timeout=max(1, (deadline - time.monotonic()) * 1000))
+                except Exception:
+                    pass
+            if not await self.wait_network_idle(SETTLE_NETWORK_IDLE_MS / 1000, deadline):
+                break
+            remaining_ms = max(0, (deadline - time.monotonic()) * 1000)
+            try:
+                quiet = await self.page.evaluate(DOM_QUIET_SCRIPT, [SETTLE_DOM_QUIET_MS, remaining_ms])
+            except Exception:
+                # A navigation replaced the document mid-check; go round again.
+                await asyncio.sleep(0.05)
+                continue
+            if quiet and not self.inflight:
+                settled = True
+                break
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if settled:
+            print(f"⏳ Page settled in {elapsed_ms:.0f} ms")
+        else:
+            print(f"⏳ Page still busy after {elapsed_ms:.0f} ms ({len(self.inflight)} request(s) in flight); continuing")
+        return settled
+
+class Backoff:
+    """Exponential retry delay that resets once things work again."""
+
+    def __init__(self, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.cap, self.base * (2 ** self.failures))
+        self.failures += 1
+        return delay
+
+    def reset(self):
+        self.failures = 0
+
+class CaptureManager:
+    """Capture page artifacts lazily, only when a consumer needs them.
+
+    Actions call mark_dirty(); ensure_fresh() runs capture_artifacts only if the page
+    fingerprint (URL, navigation count, DOM mutation counter) changed since the last capture.
+    """
+
+    def __init__(self, page, debug_dir: Optional[Path] = None):
+        self.page = page
+        self.debug_dir = debug_dir
+        self.dirty = True
+        self.last_fingerprint = None
+        self.navigations = 0
+        self.artifacts: Optional[PageArtifacts] = None
+        # Viewport box of the element the last click/send_keys touched, for clipped screenshots.
+        self.focus_box = None
+        self.screenshot_hash = None
+        # Hash of the last screenshot actually sent; "unchanged" is judged against this one.
+        self.sent_screenshot_hash = None
+        self.captures = 0
+        self.skipped = 0
+        self.settler = SettleDetector(page)
+        self.settled = False
+        page.on('framenavigated', self._on_navigated)
+
+    async def install(self):
+        try:
+            await self.page.add_init_script(MUTATION_COUNTER_SCRIPT)
+            await self.page.evaluate(MUTATION_COUNTER_SCRIPT)
+        except Exception as e:
+            print(f"⚠️ Could not install DOM mutation counter: {e}")
+
+    def _on_navigated(self, frame):
+        if frame == self.page.main_frame:
+            self.navigations += 1
+            self.dirty = True
+            self.settled = False
+
+    def mark_dirty(self):
+        if self.dirty:
+            # Another action landed before anyone read the artifacts: that capture is saved.
+            self.skipped += 1
+        self.dirty = True
+        self.settled = False
+
+    @traced('settle')
+    async def settle(self):
+        """Wait for the page to settle after an action (see SettleDetector)."""
+        await self.settler.settle()
+        self.settled = True
+
+    async def fingerprint(self):
+        try:
+            count = await self.page.evaluate(
+                "() => { " + MUTATION_COUNTER_SCRIPT + "; return window.__agentMutationCount; }"
+            )
+        except Exception:
+            return None
+        return (self.page.url, self.navigations, count)
+
+    async def ensure_fresh(self) -> bool:
+        """Capture if the page changed since the last capture. Returns True if a capture ran."""
+        if not self.settled:
+            await self.settle()
+        fp = await self.fingerprint()
+        if fp is not None and fp == self.last_fingerprint:
+            self.dirty = False
+            self.skipped += 1
+            print(f"📸 Page unchanged since last capture; skipping ({self.skipped} captures skipped so far)")
+            return False
+        self.artifacts = await capture_artifacts(self.page, focus_box=self.focus_box,
+                                                 previous_hash=self.sent_screenshot_hash,
+                                                 debug_dir=self.debug_dir)
+        if self.artifacts.screenshot_hash is not None:
+            self.screenshot_hash = self.artifacts.screenshot_hash
+            if self.artifacts.screenshot is not None:
+                self.sent_screenshot_hash = self.artifacts.screenshot_hash
+        self.captures += 1
+        self.dirty = False
+        # Re-read after capturing: the snapshot walk must not count as a page change.
+        self.last_fingerprint = await self.fingerprint() if fp is not None else None
+        return True
+
+    def stats(self) -> dict:
+        return {'captures': self.captures, 'skipped': self.skipped}
+
+@dataclass
+class RoutingProfile:
+    """Which requests a browser context aborts, serves from the on-disk cache, or replays from a HAR.
+
+    With har_path set, requests are answered from that HAR (unknown ones are aborted) and the
+    disk cache is bypassed; with har_update, the HAR is recorded from the live network instead.
+    """
+    block_types: tuple = ('font', 'media')
+    block_domains: tuple = (
+        'doubleclick.net', 'googlesyndication.com', 'googleadservices.com', 'google-analytics.com',
+        'googletagmanager.com', 'adservice.google.com', 'amazon-adsystem.com', 'connect.facebook.net',
+        'hotjar.com', 'clarity.ms', 'segment.io', 'mixpanel.com', 'scorecardresearch.com',
+        'quantserve.com', 'taboola.com', 'outbrain.com', 'criteo.com', 'nr-data.net',
+    )
+    cache_types: tuple = ('stylesheet', 'script', 'image', 'font')
+    cache_dir: Optional[Path] = HTTP_CACHE_DIR
+    har_path: Optional[Path] = None
+    har_update: bool = False
+
+ROUTING_PROFILES = {
+    'default': RoutingProfile(),
+    'cache-only': RoutingProfile(block_types=(), block_domains=()),
+    'off': RoutingProfile(block_types=(), block_domains=(), cache_dir=None),
+}
+ROUTING_PROFILE = ROUTING_PROFILES['default']
+
+# Router of each browser context, so open_url can report what a navigation saved.
+_routers = weakref.WeakKeyDictionary()
+_http_cache_pruned = set()
+
+def prune_http_cache(cache_dir: Path) -> int:
+    """Drop expired entries, then the oldest ones while the cache is over HTTP_CACHE_MAX_BYTES."""
+    if not cache_dir.is_dir():
+        return 0
+    cutoff = time.time() - HTTP_CACHE_TTL_DAYS * 86400
+    entries = []
+    removed = 0
+    for meta in cache_dir.glob('*.json'):
+        body = meta.with_suffix('.bin')
+        try:
+            mtime = meta.stat().st_mtime
+            size = body.stat().st_size if body.exists() else 0
+        except OSError:
+            continue
+        if mtime < cutoff:
+            meta.unlink(missing_ok=True)
+            body.unlink(missing_ok=True)
+            removed += 1
+        else:
+            entries.append((mtime, size, meta, body))
+    total = sum(e[1] for e in entries)
+    for mtime, size, meta, body in sorted(entries, key=lambda e: e[0]):
+        if total <= HTTP_CACHE_MAX_BYTES:
+            break
+        meta.unlink(missing_ok=True)
+        body.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    return removed
+
+_MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)')
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+def http_cache_lifetime(headers: dict) -> Optional[float]:
+    """How many seconds a response may be served from the disk cache, or None if it mustn't be.
+
+    Follows max-age, then Expires, then the usual 10%-of-age heuristic from Last-Modified;
+    a response with none of them is not cached. Capped at HTTP_CACHE_TTL_DAYS.
+    """
+    headers = {k.lower(): v for k, v in headers.items()}
+    cache_control = headers.get('cache-control', '').lower()
+    if any(d in cache_control for d in ('no-store', 'no-cache', 'private')):
+        return None
+    vary = headers.get('vary', '').lower()
+    if '*' in vary or 'cookie' in vary or 'authorization' in vary:
+        return None
+    date = _http_date(headers.get('date')) or time.time()
+    max_age = _MAX_AGE_RE.search(cache_control)
+    if max_age:
+        lifetime = float(max_age.group(1))
+    elif _http_date(headers.get('expires')) is not None:
+        lifetime = _http_date(headers.get('expires')) - date
+    elif _http_date(headers.get('last-modified')) is not None:
+        lifetime = (date - _http_date(headers.get('last-modified'))) / 10
+    else:
+        return None
+    lifetime = min(lifetime, HTTP_CACHE_TTL_DAYS * 86400)
+    return lifetime if lifetime > 0 else None
+
+class RequestRouter:
+    """Routes one browser context's requests according to a RoutingProfile and counts what it saved."""
+
+    def __init__(self, profile: Optional[RoutingProfile] = None):
+        self.profile = profile or ROUTING_PROFILE
+        self.block_types = set(self.profile.block_types)
+        self.cache_types = set(self.profile.cache_types)
+        # The HAR answers (or records) everything itself; the disk cache would only get in its way.
+        self.cache_dir = self.profile.cache_dir if self.profile.har_path is None else None
+        self.totals = collections.Counter()
+        self._host_blocked = {}
+
+    async def install(self, context):
+        profile = self.profile
+        if profile.har_path is not None:
+            await context.route_from_har(str(profile.har_path), update=profile.har_update,
+                                         not_found='fallback' if profile.har_update else 'abort')
+            verb = 'Recording' if profile.har_update else 'Replaying'
+            print(f"📼 {verb} network traffic {'to' if profile.har_update else 'from'} {profile.har_path}")
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            if self.cache_dir not in _http_cache_pruned:
+                _http_cache_pruned.add(self.cache_dir)
+                removed = await asyncio.to_thread(prune_http_cache, self.cache_dir)
+                if removed:
+                    print(f"🧹 Pruned {removed} stale HTTP cache entries")
+        # Routes registered later run first, so this one sees requests before the HAR does.
+        if self.block_types or self.profile.block_domains or self.cache_dir is not None:
+            await context.route('**/*', self._handle)
+        _routers[context] = self
+        return self
+
+    def _is_blocked_host(self, url: str) -> bool:
+        host = urlsplit(url).hostname or ''
+        blocked = self._host_blocked.get(host)
+        if blocked is None:
+            blocked = any(host == d or host.endswith('.' + d) for d in self.profile.block_domains)
+            self._host_blocked[host] = blocked
+        return blocked
+
+    async def _handle(self, route):
+        request = route.request
+        try:
+            if request.resource_type in self.block_types or self._is_blocked_host(request.url):
+                self.totals['blocked'] += 1
+                await route.abort('blockedbyclient')
+                return
+            if (self.cache_dir is None or request.method != 'GET' or request.resource_type not in self.cache_types
+                    or not request.url.startswith(('http://', 'https://'))):
+                await route.fallback()
+                return
+            # Responses to credentialed requests may be personal; keep them out of the shared cache.
+            request_headers = await request.all_headers()
+            if 'cookie' in request_headers or 'authorization' in request_headers:
+                await route.fallback()
+                return
+            key = hashlib.sha1(request.url.encode('utf-8')).hexdigest()
+            cached = await asyncio.to_thread(self._load, key)
+            if cached is not None:
+                meta, body = cached
+                self.totals['cached'] += 1
+                self.totals['bytes_saved'] += len(body)
+                await route.fulfill(status=meta['status'], headers=meta['headers'], body=body)
+                return
+            response = await route.fetch()
+            body = await response.body()
+            lifetime = self._lifetime(response, body)
+            if lifetime is not None:
+                await asyncio.to_thread(self._store, key, request.url, response.status, response.headers,
+                                        body, lifetime)
+                self.totals['stored'] += 1
+            await route.fulfill(response=response, body=body)
+        except Exception:
+            # The page went away or the request failed; let Playwright carry on without us.
+            try:
+                await route.fallback()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _lifetime(response, body: bytes) -> Optional[float]:
+        if response.status != 200 or len(body) > HTTP_CACHE_MAX_ENTRY_BYTES:
+            return None
+        return http_cache_lifetime(response.headers)
+
+    def _load(self, key: str):
+        meta_path = self.cache_dir / f'{key}.json'
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            if time.time() > meta['expires_at']:
+                return None
+            return meta, (self.cache_dir / f'{key}.bin').read_bytes()
+        except Exception:
+            return None
+
+    def _store(self, key: str, url: str, status: int, headers: dict, body: bytes, lifetime: float):
+        # The body is stored decoded, so the encoding and length headers no longer apply; cookies
+        # belong to the session that fetched it, not to whoever is served the copy later.
+        headers = {k: v for k, v in headers.items()
+                   if k.lower() not in ('content-encoding', 'content-length', 'set-cookie')}
+        try:
+            (self.cache_dir / f'{key}.bin').write_bytes(body)
+            # The metadata goes last: an entry only counts once it exists.
+            (self.cache_dir / f'{key}.json').write_text(
+                json.dumps({'url': url, 'status': status, 'headers': headers, 'stored_at': time.time(),
+                            'expires_at': time.time() + lifetime}),
+                encoding='utf-8')
+        except Exception as e:
+            print(f"⚠️ Could not store {url} in the HTTP cache: {e}")
+
+    def stats(self) -> dict:
+        return {'blocked': self.totals['blocked'], 'cached': self.totals['cached'],
+                'stored': self.totals['stored'], 'bytes_saved': self.totals['bytes_saved']}
+
+    def report(self, before: Optional[dict] = None, label: str = '') -> str:
+        now = self.stats()
+        if before is not None:
+            now = {k: now[k] - before.get(k, 0) for k in now}
+        return (f"🚦 {label}{now['blocked']} blocked, {now['cached']} served from cache "
+                f"({now['bytes_saved'] / 1024:.0f} KB saved), {now['stored']} newly cached")
+
+async def install_request_router(context) -> Optional[RequestRouter]:
+    try:
+        return await RequestRouter().install(context)
     except Exception as e:
-        print(f"⚠️ Save page content failed: {e}")
+        print(f"⚠️ Request routing unavailable; loading pages unfiltered: {e}")
+        return None
 
-async def open_url(page, url: str):
+@traced('action.open_url', outcome=_ok_or_error)
+async def open_url(page, url: str) -> bool:
+    router = _routers.get(page.context)
+    before = router.stats() if router is not None else None
     try:
         await page.goto(url)
         print(f"✅ Opened URL: {url}")
+        if router is not None:
+            print(router.report(before))
+        return True
     except PlaywrightTimeoutError as e:
-        print(f"❌ Navigation timeout: {e}")
+        _action_failed(f"❌ Navigation timeout: {e}")
     except Exception as e:
-        print(f"❌ open_url failed: {e}")
-    finally:
-        await capture_artifacts(page)
+        _action_failed(f"❌ open_url failed: {e}")
+    return False
 
-async def click_element(page, raw_selector: str):
+async def remember_focus_box(locator, captures: Optional[CaptureManager]):
+    if captures is None or not SCREENSHOT_POLICY.clip_to_last_element:
+        return
+    try:
+        captures.focus_box = await locator.bounding_box(timeout=1000)
+    except Exception:
+        captures.focus_box = None
+
+@traced('action.click_element', outcome=_ok_or_error)
+async def click_element(page, raw_selector: str, captures: Optional[CaptureManager] = None) -> bool:
     try:
         locator = await get_locator(page, raw_selector)
+        await remember_focus_box(locator.first, captures)
         await locator.first.click()
         print(f"✅ Clicked element: {raw_selector}")
+        return True
     except Exception as e:
-        print(f"❌ Click failed: {e}")
-    finally:
-        await capture_artifacts(page)
+        _action_failed(f"❌ Click failed: {e}")
+        return False
 
-async def send_keys(page, raw_selector: str, text: str):
+@traced('action.send_keys', outcome=_ok_or_error)
+async def send_keys(page, raw_selector: str, text: str, captures: Optional[CaptureManager] = None) -> bool:
     try:
         locator = await get_locator(page, raw_selector)
+        await remember_focus_box(locator, captures)
         await locator.fill(text)
         print(f"✅ Sent keys to {raw_selector}: '{text}'")
+        return True
     except Exception as e:
-        print(f"❌ send_keys failed: {e}")
-    finally:
-        await capture_artifacts(page)
-
-async def ask_copilot_and_get_reply(prompt_text: str):
-    """Connect to local websocket server and send prompt + attachments, return reply text.
-
-    Expects a websocket server at ws://localhost:8765 that accepts a JSON message with
-    keys: 'prompt' (string) and 'attachments' (list of {name,type,data or dataURL}).
+        _action_failed(f"❌ send_keys failed: {e}")
+        return False
+
+# Prompt frames are binary WebSocket messages:
+#   [4-byte big-endian header length][UTF-8 JSON header][segment 0][segment 1]...
+# The header's "attachments" list carries name/type/size for each raw byte segment, in order;
+# "text": true marks segments that hold UTF-8 text rather than binary data.
+FRAME_HEADER_LEN = struct.Struct('>I')
+
+def encode_frame(header: dict, segments: list) -> list:
+    """Return the parts of a binary frame. Segments are not copied; join or send as fragments."""
+    head = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return [FRAME_HEADER_LEN.pack(len(head)), head, *segments]
+
+def read_frame_header(data: bytes) -> dict:
+    """Parse only the JSON header of a frame, leaving the segments untouched."""
+    (head_len,) = FRAME_HEADER_LEN.unpack_from(data, 0)
+    offset = FRAME_HEADER_LEN.size
+    return json.loads(bytes(memoryview(data)[offset:offset + head_len]).decode('utf-8'))
+
+def decode_frame(data: bytes):
+    """Inverse of encode_frame: return (header, [memoryview per attachment])."""
+    view = memoryview(data)
+    header = read_frame_header(view)
+    offset = FRAME_HEADER_LEN.size + FRAME_HEADER_LEN.unpack_from(view, 0)[0]
+    segments = []
+    for att in header.get('attachments', []):
+        size = int(att['size'])
+        segments.append(view[offset:offset + size])
+        offset += size
+    if offset != len(view):
+        raise ValueError(f"Frame length mismatch: header describes {offset} bytes, got {len(view)}")
+    return header, segments
+
+@traced('encode', size=lambda parts: sum(len(p) for p in parts))
+def build_prompt_frame(prompt_text: str, artifacts: Optional[PageArtifacts], history_text: Optional[str],
+                       request_id: Optional[str] = None, stream: bool = False) -> list:
+    attachments = []
+    segments = []
+
+    def add(name, mime, payload: bytes, text: bool):
+        attachments.append({'name': name, 'type': mime, 'size': len(payload), 'text': text})
+        segments.append(payload)
+
+    if artifacts is not None and artifacts.page_text is not None:
+        add('page.txt', 'text/plain', artifacts.page_text.encode('utf-8'), True)
+    elif artifacts is not None:
+        print("Warning: no page snapshot captured; skipping page.txt")
+    screenshot_unchanged = artifacts is not None and artifacts.screenshot_unchanged
+    if artifacts is not None and artifacts.screenshot is not None:
+        ext = artifacts.screenshot_type.split('/')[-1]
+        add(f'screenshot.{ext}', artifacts.screenshot_type, artifacts.screenshot, False)
+    elif screenshot_unchanged:
+        prompt_text += "\n(No new screenshot: the page looks the same as in the previous step. Use page.txt for its current state.)\n"
+    elif artifacts is not None:
+        print("Warning: no screenshot captured; skipping screenshot")
+    if history_text is not None:
+        add('history.txt', 'text/plain', history_text.encode('utf-8'), True)
+
+    header = {'prompt': prompt_text, 'attachments': attachments}
+    if request_id is not None:
+        header['id'] = request_id
+    if screenshot_unchanged:
+        header['screenshot_unchanged'] = True
+    if stream:
+        header['stream'] = True
+    return encode_frame(header, segments)
+
+class BridgeClient:
+    """Long-lived connection from the controller to the WebSocket bridge.
+
+    Every prompt carries a correlation id in its frame header; replies are only accepted
+    as {"type": "reply" | "done", "id": ..., "reply": ...} with a matching id, so stray
+    broadcasts are never mistaken for an answer. Several requests can be in flight at once.
+    Streamed {"type": "chunk"} messages go to the request's on_chunk callback.
     """
-    try:
+
+    def __init__(self, url: Optional[str] = None, request_timeout: Optional[float] = None):
+        self.url = url or BRIDGE_URL
+        self.request_timeout = BRIDGE_REQUEST_TIMEOUT if request_timeout is None else request_timeout
+        self._ws = None
+        self._connected = asyncio.Event()
+        self._pending = {}
+        self._streams = {}
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _run(self):
         import websockets
-    except Exception as e:
-        print(f"❌ websockets package not available: {e}")
-        return None
 
-    base = Path(__file__).resolve().parent
-    page_path = base / 'page.txt'
-    screenshot_path = base / 'screenshot.png'
-    commands_path = base / 'commands.txt'
+        delay = BRIDGE_RECONNECT_MIN_DELAY
+        while not self._closing:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    self._ws = ws
+                    await ws.send(json.dumps({'type': 'register', 'role': 'requester'}))
+                    self._connected.set()
+                    delay = BRIDGE_RECONNECT_MIN_DELAY
+                    print(f"🔌 Connected to bridge at {self.url}")
+                    async for message in ws:
+                        self._on_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self._closing:
+                    print(f"⚠️ Bridge connection failed: {e}")
+            finally:
+                self._ws = None
+                self._connected.clear()
+                self._fail_pending(ConnectionError("bridge connection lost"))
+            if self._closing:
+                break
+            print(f"🔁 Reconnecting to bridge in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            delay = min(BRIDGE_RECONNECT_MAX_DELAY, delay * 2)
 
-    attachments = []
-    if page_path.exists():
-        text_data = page_path.read_text(encoding='utf-8')
-        attachments.append({'name': 'page.txt', 'type': 'text/plain', 'data': text_data})
-    else:
-        print(f"Warning: {page_path} not found; skipping page.txt")
+    def _on_message(self, message):
+        if isinstance(message, (bytes, bytearray)):
+            return  # prompt frames broadcast by other requesters
+        try:
+            data = json.loads(message)
+        except Exception:
+            print(f"⚠️ Ignoring untagged message from bridge: {message[:120]!r}")
+            return
+        if not isinstance(data, dict):
+            return
+        if data.get('type') == 'chunk':
+            on_chunk = self._streams.get(data.get('id'))
+            if on_chunk is not None:
+                try:
+                    on_chunk(int(data.get('offset', 0)), data.get('text', ''))
+                except Exception as e:
+                    print(f"⚠️ Error handling streamed chunk: {e}")
+            return
+        if data.get('type') not in ('reply', 'done'):
+            return
+        fut = self._pending.get(data.get('id'))
+        if fut is None:
+            print(f"⚠️ Ignoring reply for unknown request id {data.get('id')!r}")
+        elif not fut.done():
+            fut.set_result(data.get('reply'))
+
+    def _fail_pending(self, exc):
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    async def request(self, prompt_text: str, artifacts: Optional[PageArtifacts] = None,
+                      history_text: Optional[str] = None, timeout: Optional[float] = None,
+                      request_id: Optional[str] = None, on_chunk=None):
+        """Send one prompt and wait for its reply. Raises asyncio.TimeoutError / ConnectionError.
+
+        With `on_chunk`, the worker is asked to stream and on_chunk(offset, text) is called for
+        every chunk: the reply so far is text[:offset] of the previous one plus `text`.
+        Returns None if the request was cancelled.
+        """
+        self.start()
+        request_id = request_id or uuid.uuid4().hex
+        timeout = self.request_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        # One deadline for connecting and replying, so a request never waits more than `timeout`.
+        deadline = loop.time() + timeout
+        fut = loop.create_future()
+        self._pending[request_id] = fut
+        if on_chunk is not None:
+            self._streams[request_id] = on_chunk
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+            started = time.perf_counter()
+            frame = build_prompt_frame(prompt_text, artifacts, history_text, request_id, stream=on_chunk is not None)
+            frame_size = sum(len(part) for part in frame)
+            print(f"📦 Prompt frame {request_id[:8]}: {frame_size} bytes, encoded in {(time.perf_counter() - started) * 1000:.1f} ms")
+            # Sending the parts as fragments of one message avoids joining them into another copy.
+            await self._ws.send(frame)
+            return await asyncio.wait_for(fut, max(0.0, deadline - loop.time()))
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            await self.cancel(request_id)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+            self._streams.pop(request_id, None)
+
+    async def cancel(self, request_id: str):
+        """Tell the bridge we no longer want the reply for `request_id`; its request() returns None."""
+        fut = self._pending.pop(request_id, None)
+        self._streams.pop(request_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+        ws = self._ws
+        if ws is not None:
+            try:
+                await ws.send(json.dumps({'type': 'cancel', 'id': request_id}))
+            except Exception:
+                pass
 
-    if screenshot_path.exists():
-        b = screenshot_path.read_bytes()
-        b64 = base64.b64encode(b).decode('ascii')
-        data_url = f'data:image/png;base64,{b64}'
-        attachments.append({'name': 'screenshot.png', 'type': 'image/png', 'dataURL': data_url})
-    else:
-        print(f"Warning: {screenshot_path} not found; skipping screenshot.png")
+    async def close(self):
+        self._closing = True
+        self._fail_pending(ConnectionError("bridge client closed"))
+        if self._ws is not None:
+            try:
+                await self._ws.close()
+            except Exception:
+                pass
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
 
-    if commands_path.exists():
-        try:
-            cmds = commands_path.read_text(encoding='utf-8')
-            attachments.append({'name': 'commands.txt', 'type': 'text/plain', 'data': cmds})
-        except Exception as e:
-            print(f"⚠️ Could not read commands.txt: {e}")
-    else:
-        print(f"Notice: {commands_path} not found; skipping commands.txt")
+_bridge_client: Optional[BridgeClient] = None
 
-    message = {'prompt': prompt_text, 'attachments': attachments}
+def get_bridge_client() -> BridgeClient:
+    global _bridge_client
+    if _bridge_client is None:
+        _bridge_client = BridgeClient()
+    return _bridge_client.start()
 
-    try:
+class CommandHistory:
+    """Executed commands, kept in memory for the prompt and appended to a JSONL log.
 
-        async with websockets.connect("ws://localhost:8765", max_size=None) as ws:
-            try:
-                await ws.send(json.dumps(message))
-            except websockets.exceptions.ConnectionClosedError as e:
-                print(f"❌ ask_copilot send failed (connection closed): {e}")
-                return None
+    Only the last `recent` entries are kept verbatim; older ones are folded into per-command
+    counters (capped at HISTORY_SUMMARY_MAX_KEYS), so memory and render() stay bounded.
+    Log lines are written in batches off the event loop; call close() to write the rest.
+    """
 
-            try:
-                reply = await ws.recv()
-                return reply
-            except websockets.exceptions.ConnectionClosedError as e:
-                print(f"❌ ask_copilot recv failed (connection closed): {e}")
-                return None
+    def __init__(self, path: Optional[Path] = None, recent: int = HISTORY_RECENT_COMMANDS):
+        self.path = path or COMMANDS_PATH
+        self.recent = collections.deque(maxlen=recent)
+        self.older = collections.OrderedDict()  # command -> counters, least recently seen first
+        self.older_urls = collections.OrderedDict()
+        self.older_count = 0
+        self.total = 0
+        self._pending = []
+        self._flushing = None
+
+    def record(self, cmd: str, action: Optional[dict] = None, url: Optional[str] = None,
+               result: Optional[str] = None) -> dict:
+        self.total += 1
+        entry = {'n': self.total, 'ts': datetime.utcnow().isoformat() + 'Z', 'command': cmd}
+        if action is not None:
+            entry['action'] = action.get('action')
+            entry['args'] = action.get('args', []) or []
+        if url is not None:
+            entry['url'] = url
+        if result is not None:
+            entry['result'] = result
+        if len(self.recent) == self.recent.maxlen:
+            self._fold(self.recent[0])
+        self.recent.append(entry)
+        self._pending.append(entry)
+        if len(self._pending) >= HISTORY_FLUSH_EVERY:
+            self._schedule_flush()
+        return entry
+
+    def _fold(self, entry: dict):
+        self.older_count += 1
+        stats = self.older.pop(entry['command'], None) or {'count': 0, 'results': {}, 'first': entry['n']}
+        stats['count'] += 1
+        result = entry.get('result', 'ok').split(':', 1)[0]
+        stats['results'][result] = stats['results'].get(result, 0) + 1
+        stats['last'] = entry['n']
+        self.older[entry['command']] = stats
+        if len(self.older) > HISTORY_SUMMARY_MAX_KEYS:
+            self.older.popitem(last=False)
+        if entry.get('url'):
+            self.older_urls[entry['url']] = self.older_urls.pop(entry['url'], 0) + 1
+            if len(self.older_urls) > HISTORY_SUMMARY_LINES:
+                self.older_urls.popitem(last=False)
+
+    def render(self) -> Optional[str]:
+        """The prompt's view of the history: a compact summary of older commands, then the recent ones."""
+        if not self.total:
+            return None
+        lines = []
+        if self.older_count:
+            lines.append(f"Earlier commands #1-#{self.older_count}, repeats collapsed (count, command, results, last seen):")
+            # The most repeated commands are the ones that hint at a loop.
+            top = sorted(self.older.items(), key=lambda kv: (-kv[1]['count'], kv[1]['first']))
+            for cmd, stats in top[:HISTORY_SUMMARY_LINES]:
+                results = ', '.join(f"{n} {r}" for r, n in stats['results'].items())
+                lines.append(f"  {stats['count']}x {cmd}  [{results}]  last #{stats['last']}")
+            if len(top) > HISTORY_SUMMARY_LINES:
+                lines.append(f"  ... and {len(top) - HISTORY_SUMMARY_LINES} other distinct command(s)")
+            if self.older_urls:
+                lines.append("Pages those commands ran on: " + ', '.join(self.older_urls))
+            lines.append("")
+        first = self.recent[0]['n'] if self.recent else self.total
+        lines.append(f"Most recent commands #{first}-#{self.total}, one JSON object per line:")
+        lines.extend(json.dumps(e, ensure_ascii=False) for e in self.recent)
+        return '\n'.join(lines) + '\n'
+
+    def _schedule_flush(self):
+        if self._flushing is not None and not self._flushing.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._take_pending())
+            return
+        self._flushing = loop.create_task(self._flush())
+
+    def _take_pending(self) -> list:
+        pending, self._pending = self._pending, []
+        return pending
+
+    async def _flush(self):
+        while self._pending:
+            await asyncio.to_thread(self._write, self._take_pending())
+
+    @traced('disk.commands_log', size=len)
+    def _write(self, entries: list) -> str:
+        lines = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        except Exception as e:
+            print(f"⚠️ Failed to append to commands log: {e}")
+        return lines
+
+    async def close(self):
+        if self._flushing is not None:
+            await self._flushing
+        if self._pending:
+            await asyncio.to_thread(self._write, self._take_pending())
+
+_command_history: Optional[CommandHistory] = None
+
+def get_command_history() -> CommandHistory:
+    """History of the interactive session (COMMANDS_PATH), for callers that don't pass their own."""
+    global _command_history
+    if _command_history is None:
+        _command_history = CommandHistory()
+    return _command_history
+
+@traced('ask', size=lambda reply: len(reply.encode('utf-8')) if reply else 0,
+        outcome=lambda reply: 'ok' if reply else 'no_reply')
+async def ask_copilot_and_get_reply(prompt_text: str, artifacts: Optional[PageArtifacts] = None,
+                                    client: Optional[BridgeClient] = None,
+                                    history: Optional[CommandHistory] = None):
+    """Send prompt + attachments over the controller's bridge connection, return reply text.
+
+    Expects a websocket server at BRIDGE_URL. The prompt goes out as one binary frame
+    (see encode_frame) whose header holds 'id', 'prompt' and the attachment descriptors,
+    followed by the raw page text, screenshot and command history bytes.
+    """
+    if websockets_error():
+        print(f"❌ {websockets_error()}")
+        return None
+
+    client = client or get_bridge_client()
+    try:
+        return await client.request(prompt_text, artifacts, (history or get_command_history()).render())
+    except asyncio.TimeoutError:
+        print(f"❌ ask_copilot timed out after {client.request_timeout:g}s")
+        return None
     except Exception as e:
         print(f"❌ ask_copilot failed: {e}")
         return None
 
+def page_txt_hint() -> str:
+    if PAGE_SNAPSHOT_MODE == 'interactive':
+        return ("page.txt lists the visible interactive elements of the current page, one per line, as "
+                "[N] tag role/type id name \"label\" @x,y WxH. Prefer ref=N selectors from the latest page.txt; "
+                "they are only valid until the next snapshot.")
+    return "When choosing element identifiers (id, name, class) consult the .txt file which contains the page HTML."
+
 def format_instructions_for_copilot(task: str) -> str:
     """Return a detailed instruction string to send to Copilot describing available commands
     and required response format.
@@ -194,22 +1974,32 @@ def format_instructions_for_copilot(task: str) -> str:
         f"Task: {task}\n\n"
         "You are an automation assistant that replies with the next action(s) to take. "
         "Determine if the task is complete; if so, respond with the 'exit' action.\n"
-        "Please prevent infinite loops by checking the previously executed commands in commands.txt.\n"
+        "Please prevent infinite loops by checking the previously executed commands in history.txt (older commands summarised with repeat counts, the most recent listed one JSON object per line).\n"
         "Only use the allowed commands listed below. Respond ONLY with a raw JSON object (not a quoted JSON string) using one of these shapes:\n"
         "1) Single action: {\"action\": \"open_url\", \"args\": [\"http://example.com\"] }\n"
         "2) Multiple actions: {\"actions\": [{\"action\": \"click_element\", \"args\": [\"id=submitBtn\"]}, {\"action\": \"send_keys\", \"args\": [\"name=username\", \"myuser\"] }] }\n\n"
         "Allowed actions and arg formats:\n"
         "- open_url(url) => args: [url]\n"
-        "- click_element(selector) => args: [selector] where selector is type=value (id=..., name=..., class=..., tag=..., text=..., attr=key=value)\n"
+        "- click_element(selector) => args: [selector] where selector is type=value (ref=..., id=..., name=..., class=..., tag=..., text=..., attr=key=value)\n"
         "- send_keys(selector, text) => args: [selector, text]\n"
         "- exit => args: [] (closes the controller when task is FINISHED)\n"
         "- break_loop => args: [] (stop automated polling temporarily)\n"
         "- noop => args: [] (no operation; can be used to wait)\n\n"
-        "When choosing element identifiers (id, name, class) consult the .txt file which contains the page HTML. "
+        f"{page_txt_hint()} "
         "Do not include any explanatory text outside the JSON object. If your system for some reason wraps the JSON object as a string, return the raw object instead (the controller can attempt a secondary parse but raw JSON is preferred).\n"
     )
     return instructions
 
+# Actions Copilot may reply with, and the args each one needs (see format_instructions_for_copilot).
+ALLOWED_ACTIONS = {
+    'open_url': ('url',),
+    'click_element': ('selector',),
+    'send_keys': ('selector', 'text'),
+    'exit': (),
+    'break_loop': (),
+    'noop': (),
+}
+
 def action_json_to_command(action: dict) -> str:
     """Convert action JSON (with 'action' and 'args') into our command string format."""
     name = action.get('action')
@@ -231,6 +2021,442 @@ def action_json_to_command(action: dict) -> str:
     else:
         return ''
 
+# How Copilot's replies were used this session: parsed as-is ('clean'), parsed after repairs
+# ('repaired'), answered with a correction prompt ('reasked'), or still unusable after it ('failed').
+reply_stats = collections.Counter()
+
+_FENCE_RE = re.compile(r"```[A-Za-z]*[ \t]*\n?(.*?)```", re.S)
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+_SMART_QUOTES = str.maketrans({'\u201c': '"', '\u201d': '"', '\u201e': '"', '\u2033': '"',
+                               '\u2018': "'", '\u2019': "'"})
+
+def _first_action_object(text: str):
+    """The first JSON object in `text` that looks like a reply ('action' or 'actions'), else None."""
+    decoder = json.JSONDecoder()
+    start = text.find('{')
+    while start != -1:
+        try:
+            data, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and ('action' in data or 'actions' in data):
+            return data
+        start = text.find('{', start + 1)
+    return None
+
+def repair_copilot_reply(reply: str):
+    """Pull the action object out of a noisy reply.
+
+    Handles ```json fences, prose around the JSON, trailing commas and smart quotes.
+    Returns the parsed object, or None if nothing usable was found.
+    """
+    fenced = _FENCE_RE.search(reply)
+    candidates = [fenced.group(1), reply] if fenced else [reply]
+    for text in candidates:
+        data = _first_action_object(text)
+        if data is None:
+            data = _first_action_object(_TRAILING_COMMA_RE.sub(r'\1', text.translate(_SMART_QUOTES)))
+        if data is not None:
+            return data
+    return None
+
+def validate_actions(actions: list) -> Optional[str]:
+    """Check every action against ALLOWED_ACTIONS; returns an error message naming the first bad one."""
+    if not actions:
+        return "Reply has an empty 'actions' list."
+    for i, act in enumerate(actions, start=1):
+        if not isinstance(act, dict):
+            return f"Action {i} is not an object: {act!r}"
+        name = act.get('action')
+        if name not in ALLOWED_ACTIONS:
+            return f"Action {i} has unknown action {name!r}; allowed: {', '.join(ALLOWED_ACTIONS)}"
+        args = act.get('args', [])
+        if args is None:
+            args = []
+        if not isinstance(args, list):
+            return f"Action {i} ({name}): 'args' must be a list, got {args!r}"
+        needed = ALLOWED_ACTIONS[name]
+        if len(args) < len(needed):
+            return f"Action {i} ({name}) needs args [{', '.join(needed)}], got {args!r}"
+        bad = [a for a in args[:len(needed)] if not isinstance(a, (str, int, float))]
+        if bad:
+            return f"Action {i} ({name}): args must be strings, got {bad[0]!r}"
+    return None
+
+@traced('parse', outcome=lambda r: 'error' if r[1] else 'ok')
+def parse_copilot_reply(reply: str):
+    """Turn Copilot's reply text into a list of action dicts.
+
+    Bare JSON is the fast path; anything else goes through repair_copilot_reply.
+    Returns (actions, None) on success or (None, error message) when the reply can't be used.
+    """
+    repaired = False
+    try:
+        data = json.loads(reply)
+        if isinstance(data, str):
+            reply = data
+            data = json.loads(data)
+    except Exception as e:
+        data = repair_copilot_reply(reply)
+        if data is None:
+            return None, f"Could not parse Copilot reply as JSON: {e}\nRaw reply:\n{reply}"
+        repaired = True
+
+    if not isinstance(data, dict):
+        return None, f"Copilot reply is not a JSON object as expected. Raw parsed value: {repr(data)}"
+
+    if 'actions' in data and isinstance(data['actions'], list):
+        actions = data['actions']
+    elif 'action' in data:
+        actions = [data]
+    else:
+        return None, f"Unrecognized reply schema from Copilot: {data}"
+    error = validate_actions(actions)
+    if error:
+        return None, error
+    if repaired:
+        print("🩹 Repaired Copilot's reply (it wasn't bare JSON)")
+    reply_stats['repaired' if repaired else 'clean'] += 1
+    return actions, None
+
+def format_correction_prompt(prompt_text: str, reply: str, error: str) -> str:
+    """A short follow-up asking Copilot to fix an unusable reply. It carries no attachments."""
+    first_line = prompt_text.split('\n', 1)[0]
+    task_line = first_line + "\n\n" if first_line.startswith('Task: ') else ''
+    if len(reply) > 500:
+        reply = reply[:500] + '...'
+    allowed = '; '.join(f"{name}({', '.join(args)})" for name, args in ALLOWED_ACTIONS.items())
+    return (
+        f"{task_line}"
+        "Your previous reply could not be used.\n"
+        f"Problem: {error.splitlines()[0]}\n"
+        f"Your reply was:\n{reply}\n\n"
+        "Send the same answer again as ONE raw JSON object and nothing else: "
+        "{\"action\": ..., \"args\": [...]} or {\"actions\": [...]}. "
+        f"Allowed actions and their args: {allowed}.\n"
+    )
+
+@traced('ask.correction', outcome=lambda r: 'error' if r[1] else 'ok')
+async def ask_copilot_to_correct(prompt_text: str, reply: str, error: str,
+                                 client: Optional[BridgeClient] = None):
+    """Re-ask once with a correction prompt, without re-sending page.txt, the screenshot or history.
+
+    Returns (actions, error) like parse_copilot_reply.
+    """
+    client = client or get_bridge_client()
+    reply_stats['reasked'] += 1
+    print("🔁 Asking Copilot to correct its reply (no attachments re-sent)...")
+    try:
+        corrected = await client.request(format_correction_prompt(prompt_text, reply, error), None, None)
+    except Exception as e:
+        corrected = None
+        print(f"❌ Correction request failed: {e}")
+    if not corrected:
+        reply_stats['failed'] += 1
+        return None, error
+    actions, new_error = parse_copilot_reply(corrected)
+    if new_error:
+        reply_stats['failed'] += 1
+    return actions, new_error
+
+def reply_stats_line() -> str:
+    return (f"🧩 Copilot replies: {reply_stats['clean']} clean, {reply_stats['repaired']} repaired, "
+            f"{reply_stats['reasked']} re-asked ({reply_stats['failed']} still unusable)")
+
+class StreamingActionParser:
+    """Pulls complete actions out of a reply that is still being written.
+
+    Feed it each streamed chunk; it scans only the new characters and returns every
+    element of the top-level "actions" array whose closing brace has arrived. If a chunk
+    rewrites text that was already scanned, the reply is rescanned from the start and
+    actions already returned are not returned again. Once an element fails to parse,
+    nothing more is returned and the caller falls back to the final reply.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.emitted = 0
+        self.broken = False
+        self._reset()
+
+    def _reset(self):
+        self.pos = 0
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_string = None
+        self.item_start = None
+        self.seen = 0
+
+    def feed(self, offset: int, chunk: str) -> list:
+        if offset < self.pos:
+            self._reset()
+        self.text = self.text[:offset] + chunk
+        return self._scan()
+
+    def _scan(self) -> list:
+        found = []
+        text = self.text
+        for i in range(self.pos, len(text)):
+            c = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == '\\':
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+                    self.last_string = text[self.string_start + 1:i]
+            elif c == '"':
+                self.in_string = True
+                self.string_start = i
+            elif c == '{':
+                if self.stack == ['{', 'actions']:
+                    self.item_start = i
+                self.stack.append('{')
+            elif c == '[':
+                self.stack.append('actions' if self.stack == ['{'] and self.last_string == 'actions' else '[')
+            elif c in '}]' and self.stack:
+                self.stack.pop()
+                if c == '}' and self.stack == ['{', 'actions'] and self.item_start is not None:
+                    self.seen += 1
+                    if self.seen > self.emitted and not self.broken:
+                        try:
+                            action = json.loads(text[self.item_start:i + 1])
+                        except ValueError:
+                            action = None
+                        if isinstance(action, dict):
+                            found.append(action)
+                            self.emitted += 1
+                        else:
+                            self.broken = True
+                    self.item_start = None
+        self.pos = len(text)
+        return found
+
+async def execute_actions(page, actions: list, captures: Optional[CaptureManager] = None,
+                          history: Optional[CommandHistory] = None, stop_on_error: bool = False):
+    """Run Copilot actions in order, recording each one's result in `history`.
+
+    Returns 'exit' as soon as one of them asks to exit, 'error' if any action failed
+    (immediately, with stop_on_error), otherwise None. See execute_action_batch.
+    """
+    outcome, _ = await execute_action_batch(page, actions, captures, history, stop_on_error)
+    return outcome
+
+async def execute_action_batch(page, actions: list, captures: Optional[CaptureManager] = None,
+                               history: Optional[CommandHistory] = None, stop_on_error: bool = False):
+    """Run a parsed plan as one batch.
+
+    The selectors it needs before the page changes are looked up together first; if one of
+    them can't resolve, nothing runs. Otherwise the actions run back to back and the page
+    settles once at the end. Returns (outcome, results): outcome as for execute_actions, and
+    per action a dict with its 'action', 'args', 'status' (ok | error | skipped | exit) and
+    'detail'. Every result is also recorded in `history`, so the next prompt sees it.
+    """
+    if not actions:
+        return None, []
+    history = history or get_command_history()
+    results = [{'action': act.get('action'), 'args': act.get('args') or [], 'status': 'skipped', 'detail': None}
+               for act in actions]
+    urls = [page.url] * len(actions)
+
+    errors = await validate_action_selectors(page, actions)
+    bad = next((i for i, error in enumerate(errors) if error), None)
+    outcome = None
+    if bad is not None:
+        print(f"⛔ Not running this batch: action {bad + 1} can't run ({errors[bad]})")
+        for i, error in enumerate(errors):
+            results[i]['status'] = 'error' if error else 'skipped'
+            results[i]['detail'] = error or f"action {bad + 1} can't run"
+        outcome = 'error'
+    else:
+        failed = False
+        ran = False
+        for i, act in enumerate(actions):
+            cmdstr = action_json_to_command(act) or act.get('action')
+            print(f"▶ Executing Copilot action: {cmdstr}")
+            res = await run_action(page, act, captures)
+            ran = True
+            note_first_action()
+            urls[i] = page.url
+            if res == 'error':
+                results[i]['status'] = 'error'
+                results[i]['detail'] = _action_error.get()
+                failed = True
+                if stop_on_error:
+                    print("⛔ Action failed; skipping the rest of this batch")
+                    outcome = 'error'
+                    break
+            elif res == 'exit':
+                results[i]['status'] = 'exit'
+                outcome = 'exit'
+                break
+            else:
+                results[i]['status'] = 'ok'
+        else:
+            outcome = 'error' if failed else None
+        for result in results[i + 1:]:
+            result['detail'] = f"action {i + 1} ended the batch"
+        if ran and captures is not None and outcome != 'exit':
+            await captures.settle()
+
+    for act, result, url in zip(actions, results, urls):
+        cmdstr = action_json_to_command(act) or act.get('action')
+        status = result['status'] if result['detail'] is None else f"{result['status']}: {result['detail']}"
+        history.record(cmdstr, act, url, status)
+    return outcome, results
+
+@traced('ask_and_execute', outcome=lambda r: 'error' if r[2] else (r[0] or 'ok'))
+async def ask_copilot_and_execute_streaming(page, prompt_text: str, artifacts: Optional[PageArtifacts] = None,
+                                            client: Optional[BridgeClient] = None,
+                                            captures: Optional[CaptureManager] = None,
+                                            history: Optional[CommandHistory] = None):
+    """Ask Copilot for the next actions and run each one as soon as it has streamed in.
+
+    The first action starts while the model is still writing the rest. Each streamed action
+    runs as a batch of one: its selector is checked and the page settles before the next.
+    When an action fails or asks to exit, the rest of the reply is cancelled. Whatever was
+    not streamed (all of it, for workers that don't stream) runs as one execute_action_batch.
+
+    Returns (result, actions, error): result as from execute_actions, the actions that were
+    handled (break_loop included, so callers can honour it), and an error message when
+    the reply couldn't be used at all.
+    """
+    if websockets_error():
+        return None, [], websockets_error()
+
+    client = client or get_bridge_client()
+    history = history or get_command_history()
+    parser = StreamingActionParser()
+    ready = asyncio.Queue()
+    request_id = uuid.uuid4().hex
+
+    def on_chunk(offset, text):
+        for action in parser.feed(offset, text):
+            ready.put_nowait(action)
+
+    request = asyncio.create_task(client.request(prompt_text, artifacts, history.render(),
+                                                 request_id=request_id, on_chunk=on_chunk))
+    handled = []
+    result = None
+
+    async def run(action):
+        handled.append(action)
+        if action.get('action') == 'break_loop':
+            return None
+        return await execute_actions(page, [action], captures, history, stop_on_error=True)
+
+    try:
+        while result is None and not (request.done() and ready.empty()):
+            next_action = asyncio.ensure_future(ready.get())
+            await asyncio.wait({next_action, request}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_action.done():
+                next_action.cancel()
+                continue
+            if not request.done():
+                print(f"⚡ Action {len(handled) + 1} is complete; running it while Copilot keeps writing")
+            result = await run(next_action.result())
+    finally:
+        if result is not None or not request.done():
+            # The remaining actions assumed this one went through; don't wait for them.
+            await client.cancel(request_id)
+            await asyncio.gather(request, return_exceptions=True)
+    if result is not None:
+        if result == 'error':
+            print("🛑 Cancelled the rest of Copilot's reply")
+        return result, handled, None
+
+    try:
+        reply = request.result()
+    except asyncio.TimeoutError:
+        print(f"❌ ask_copilot timed out after {client.request_timeout:g}s")
+        reply = None
+    except Exception as e:
+        print(f"❌ ask_copilot failed: {e}")
+        reply = None
+    if not reply:
+        return (None, handled, None) if handled else (None, [], "No reply from Copilot.")
+
+    actions, error = parse_copilot_reply(reply)
+    if error:
+        if handled:
+            print(f"⚠️ Final reply could not be parsed; keeping the {len(handled)} action(s) already run")
+            return None, handled, None
+        print(f"⚠️ {error}")
+        actions, error = await ask_copilot_to_correct(prompt_text, reply, error, client)
+        if error:
+            return None, [], error
+    if actions[:len(handled)] != handled:
+        print("⚠️ Final reply differs from what was streamed; running only the actions not yet executed")
+    rest = actions[len(handled):]
+    handled.extend(rest)
+    result = await execute_actions(page, [a for a in rest if a.get('action') != 'break_loop'],
+                                   captures, history, stop_on_error=True)
+    return result, handled, None
+
+# Console lines, read by one long-lived daemon thread (see ainput). A line nobody is waiting
+# for stays queued for the next prompt; EOF (or a read error) stays at the head for good.
+_console_lines = collections.deque()
+_console_lock = threading.Lock()
+_console_thread = None
+# (loop, asyncio.Event) of the prompt currently waiting for a line.
+_console_wakeup = None
+
+def _read_console():
+    while True:
+        try:
+            line = sys.stdin.readline()
+        except Exception as e:
+            item = e
+        else:
+            item = line.rstrip('\r\n') if line else EOFError()
+        with _console_lock:
+            _console_lines.append(item)
+            wakeup = _console_wakeup
+        if wakeup is not None:
+            try:
+                wakeup[0].call_soon_threadsafe(wakeup[1].set)
+            except RuntimeError:
+                pass  # that loop has closed; the line waits for the next prompt
+        if isinstance(item, BaseException):
+            return
+
+async def ainput(prompt: str = '') -> str:
+    """input() that doesn't freeze the event loop.
+
+    Lines are read on one daemon thread, so the bridge keeps serving its clients while we
+    wait, and a pending prompt never keeps the process alive at shutdown. Cancelling the
+    wait loses nothing: the next line goes to whichever prompt asks next.
+    """
+    global _console_thread, _console_wakeup
+    if prompt:
+        print(prompt, end='', flush=True)
+    event = asyncio.Event()
+    with _console_lock:
+        if _console_thread is None:
+            _console_thread = threading.Thread(target=_read_console, name='console-input', daemon=True)
+            _console_thread.start()
+        _console_wakeup = (asyncio.get_running_loop(), event)
+    try:
+        while True:
+            with _console_lock:
+                if _console_lines:
+                    item = _console_lines[0]
+                    if not isinstance(item, BaseException):
+                        _console_lines.popleft()
+                    break
+                event.clear()
+            await event.wait()
+    finally:
+        with _console_lock:
+            if _console_wakeup is not None and _console_wakeup[1] is event:
+                _console_wakeup = None
+    if isinstance(item, BaseException):
+        raise item
+    return item
+
 async def handle_exit_request(browser, page) -> bool:
     """Ask the user if there's anything else to do when an exit is requested.
 
@@ -240,9 +2466,9 @@ async def handle_exit_request(browser, page) -> bool:
     """
     global task
     while True:
-        ans = input("Exit requested. Is there anything else to be done? (y = yes, n = no): ").strip().lower()
+        ans = (await ainput("Exit requested. Is there anything else to be done? (y = yes, n = no): ")).strip().lower()
         if ans in ('y', 'yes'):
-            new_task = input("Enter the additional high-level task (leave blank to keep previous): ").strip()
+            new_task = (await ainput("Enter the additional high-level task (leave blank to keep previous): ")).strip()
             if new_task:
                 task = new_task
             print("Resuming automation with updated task.")
@@ -263,82 +2489,577 @@ def print_available_commands():
     print("  send_keys(type=value, text=yourtext)")
     print("  ask_copilot    -> Ask Copilot what to do next")
     print("  autoconfirm on|off -> when on, Copilot suggestions are executed automatically")
+    print("  measure_screenshots -> compare screenshot policies (bytes / latency) on the current page")
+    print("  trace_summary  -> p50/p95 latency per phase so far")
     print("  exit")
-    print("🔍 Selector types: id, class, name, tag, text, attr")
+    print("🔍 Selector types: ref, id, class, name, tag, text, attr")
     print("    Examples:")
+    print("      click_element(ref=12)")
     print("      click_element(id=submitBtn)")
     print("      send_keys(name=username, text=David123)")
     print("      click_element(attr=data-test=login-button)\n")
 
-async def process_command(page, cmd: str):
+def command_to_action(cmd: str) -> Optional[dict]:
+    """Parse a typed manual command (e.g. `send_keys(id=q, text=hello)`) into an action dict.
 
+    Returns None when the command isn't recognised. Copilot's actions never go through this.
+    """
+    if cmd.startswith("open_url(") and cmd.endswith(")"):
+        return {'action': 'open_url', 'args': [cmd[len("open_url("):-1]]}
+    if cmd.startswith("click_element(") and cmd.endswith(")"):
+        return {'action': 'click_element', 'args': [cmd[len("click_element("):-1]]}
+    if cmd.startswith("send_keys(") and cmd.endswith(")"):
+        inner = cmd[len("send_keys("):-1]
+        if ',' not in inner:
+            return {'action': 'send_keys', 'args': [inner.strip()]}
+        sel, txt = inner.split(',', 1)
+        txt = txt.strip()
+        if txt.startswith('text='):
+            txt = txt.split('=', 1)[1]
+        return {'action': 'send_keys', 'args': [sel.strip(), txt]}
+    if cmd in ('exit', 'break_loop', 'noop'):
+        return {'action': cmd, 'args': []}
+    return None
+
+@traced('command', outcome=lambda r: r or 'ok')
+async def run_action(page, action: dict, captures: Optional[CaptureManager] = None):
+    """Run one action dict. Artifacts are not captured here; the page is marked dirty
+    on `captures` and captured later by whoever needs the artifacts.
+
+    Returns 'exit' / 'break_loop' for those actions and 'error' when the action failed.
+    """
+    name = action.get('action')
+    args = action.get('args') or []
+    _action_error.set(None)
     try:
-        if cmd.startswith("open_url(") and cmd.endswith(")"):
-            url = cmd[len("open_url("):-1]
-            await open_url(page, url)
+        if name == 'open_url' and len(args) >= 1:
+            ok = await open_url(page, str(args[0]))
+        elif name == 'click_element' and len(args) >= 1:
+            ok = await click_element(page, str(args[0]), captures)
+        elif name == 'send_keys' and len(args) >= 2:
+            ok = await send_keys(page, str(args[0]), str(args[1]), captures)
+        elif name == 'send_keys':
+            _action_failed("❌ send_keys format: send_keys(type=value, text=yourtext)")
+            return 'error'
+        elif name in ('exit', 'break_loop'):
+            return name
+        elif name == 'noop':
+            return None
+        else:
+            _action_failed(f"❓ Unknown command: {action_json_to_command(action) or name}")
+            return 'error'
+        return None if ok else 'error'
+    finally:
+        if captures is not None:
+            captures.mark_dirty()
 
-        elif cmd.startswith("click_element(") and cmd.endswith(")"):
-            raw = cmd[len("click_element("):-1]
-            await click_element(page, raw)
+async def process_command(page, cmd: str, captures: Optional[CaptureManager] = None):
+    """Run one typed manual command; see run_action for the return value."""
+    action = command_to_action(cmd)
+    if action is None:
+        print(f"❓ Unknown command: {cmd}")
+        return 'error'
+    return await run_action(page, action, captures)
 
-        elif cmd.startswith("send_keys(") and cmd.endswith(")"):
-            inner = cmd[len("send_keys("):-1]
+_SNAPSHOT_BOX_RE = re.compile(r' @-?\d+,-?\d+ \d+x\d+$', re.M)
 
-            if ',' in inner:
-                sel_part, rest = inner.split(',', 1)
-                sel = sel_part.strip()
-                txt = rest.strip()
+def page_state_fingerprint(artifacts: Optional[PageArtifacts]) -> Optional[str]:
+    """Stable hash of what the model sees of a page, comparable across runs.
 
-                if txt.startswith('text='):
-                    txt = txt.split('=', 1)[1]
-            else:
+    Element boxes are dropped from the interactive snapshot so small layout shifts
+    don't count as a different page.
+    """
+    if artifacts is None or artifacts.page_text is None:
+        return None
+    text = artifacts.page_text
+    if PAGE_SNAPSHOT_MODE == 'interactive':
+        text = _SNAPSHOT_BOX_RE.sub('', text)
+    return hashlib.sha1(f"{artifacts.url}\n{text}".encode('utf-8')).hexdigest()
+
+def loop_state(fingerprint: Optional[str], screenshot_hash: Optional[int]) -> Optional[str]:
+    """The page state the loop breaker compares: page fingerprint plus perceptual screenshot hash."""
+    if fingerprint is None:
+        return None
+    return f"{fingerprint}:{screenshot_hash if screenshot_hash is not None else '-'}"
 
-                parts = [x.strip() for x in inner.split(",")]
-                sel = next((p for p in parts if "=" in p and not p.startswith("text=")), None)
-                txt = next((p for p in parts if p.startswith("text=")), None)
-                if txt:
-                    txt = txt.split('=', 1)[1]
+class LoopBreaker:
+    """Notices the agent going round in circles, so the controller stops instead of asking again.
 
-            if sel and txt is not None:
-                await send_keys(page, sel, txt)
-            else:
-                print("❌ send_keys format: send_keys(type=value, text=yourtext)")
+    Call check(state) before asking the model and record(state, actions) after running what it
+    suggested. Both return a trip event (a dict, also written to `events_path`) or None.
+    """
+
+    def __init__(self, task: str, task_id: str = 'session', events_path: Optional[Path] = None,
+                 repeat_limit: Optional[int] = None, stall_steps: Optional[int] = None):
+        self.task = task
+        self.task_id = task_id
+        self.events_path = events_path or LOOP_EVENTS_PATH
+        self.repeat_limit = LOOP_REPEAT_LIMIT if repeat_limit is None else repeat_limit
+        self.stall_steps = LOOP_STALL_STEPS if stall_steps is None else stall_steps
+        self.trips = 0
+        self.reset()
+
+    def reset(self):
+        self.transitions = collections.Counter()
+        self.last_state = None
+        self.steps_in_state = 0
+        self.step = 0
+
+    def check(self, state: Optional[str]) -> Optional[dict]:
+        if state is None or not self.stall_steps:
+            return None
+        if state == self.last_state and self.steps_in_state >= self.stall_steps:
+            return self._trip('stall', state, None, self.steps_in_state, self.stall_steps)
+        return None
 
-        elif cmd == "exit":
-            return "exit"
+    def record(self, state: Optional[str], actions: list) -> Optional[dict]:
+        if state is None:
+            return None
+        self.step += 1
+        self.steps_in_state = self.steps_in_state + 1 if state == self.last_state else 1
+        self.last_state = state
+        key = (state, json.dumps(actions, sort_keys=True))
+        self.transitions[key] += 1
+        count = self.transitions[key]
+        if self.repeat_limit and count >= self.repeat_limit:
+            return self._trip('repeat', state, actions, count, self.repeat_limit)
+        return None
+
+    def _trip(self, kind: str, state: str, actions: Optional[list], count: int, threshold: int) -> dict:
+        self.trips += 1
+        event = {
+            'ts': datetime.utcnow().isoformat() + 'Z',
+            'task_id': self.task_id,
+            'task': self.task,
+            'kind': kind,
+            'step': self.step,
+            'state': state,
+            'actions': actions,
+            'count': count,
+            'threshold': threshold,
+        }
+        if kind == 'repeat':
+            print(f"🔁 Loop breaker: the same action(s) ran {count}x from the same page state: {json.dumps(actions)}")
+        else:
+            print(f"🔁 Loop breaker: the page hasn't changed for {count} steps")
+        try:
+            with open(self.events_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+        except Exception as e:
+            print(f"⚠️ Could not log loop breaker event: {e}")
+        # Start counting afresh, so whoever takes over gets a full allowance.
+        self.reset()
+        return event
+
+class TrajectoryRecorder:
+    """Structured record of one run: task, and per step the page fingerprint, actions and result."""
+
+    def __init__(self, task: str):
+        self.task = task
+        self.started = datetime.utcnow().isoformat() + 'Z'
+        self.steps = []
+
+    def record_step(self, fingerprint: Optional[str], url: str, actions: list, result: Optional[str], source: str):
+        self.steps.append({
+            'fingerprint': fingerprint,
+            'url': url,
+            'actions': actions,
+            'result': result or 'ok',
+            'source': source,  # model | cache
+        })
+
+    def save(self, outcome: str, path: Optional[Path] = None) -> Optional[Path]:
+        if path is None:
+            slug = re.sub(r'[^A-Za-z0-9]+', '-', self.task.lower()).strip('-')[:40] or 'task'
+            path = TRAJECTORIES_DIR / f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{slug}.json"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = {'task': self.task, 'started': self.started, 'outcome': outcome, 'steps': self.steps}
+            path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding='utf-8')
+            return path
+        except Exception as e:
+            print(f"⚠️ Could not save trajectory: {e}")
+            return None
 
-        elif cmd == 'break_loop':
+class ReplayCache:
+    """On-disk map of (task, page fingerprint) -> actions, learned from successful runs.
 
-            return 'break_loop'
+    Bounded to max_entries with least-recently-used eviction; entries unused for ttl_days
+    expire. A cached step whose actions fail is invalidated. Hits only mark the cache dirty;
+    flush() writes them out when the run ends.
+    """
 
+    def __init__(self, path: Optional[Path] = None, max_entries: int = REPLAY_CACHE_MAX_ENTRIES,
+                 ttl_days: float = REPLAY_CACHE_TTL_DAYS):
+        self.path = path or REPLAY_CACHE_PATH
+        self.max_entries = max_entries
+        self.ttl = ttl_days * 86400
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        try:
+            if self.path.exists():
+                data = json.loads(self.path.read_text(encoding='utf-8'))
+                for entry in sorted(data.get('entries', []), key=lambda e: e.get('last_used', 0)):
+                    self.entries[entry['key']] = entry
+        except Exception as e:
+            print(f"⚠️ Could not load replay cache {self.path}; starting empty: {e}")
+
+    @staticmethod
+    def key(task: str, fingerprint: str) -> str:
+        return hashlib.sha1(f"{' '.join(task.lower().split())}\0{fingerprint}".encode('utf-8')).hexdigest()
+
+    def lookup(self, task: str, fingerprint: Optional[str]) -> Optional[list]:
+        entry = self.entries.get(self.key(task, fingerprint)) if fingerprint else None
+        if entry is not None and time.time() - entry.get('last_used', 0) > self.ttl:
+            self.entries.pop(entry['key'], None)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry['last_used'] = time.time()
+        entry['hits'] = entry.get('hits', 0) + 1
+        self.entries.move_to_end(entry['key'])
+        self.dirty = True
+        return entry['actions']
+
+    def put(self, task: str, fingerprint: str, actions: list):
+        key = self.key(task, fingerprint)
+        self.entries[key] = {'key': key, 'task': task, 'fingerprint': fingerprint, 'actions': actions,
+                             'last_used': time.time(), 'hits': 0}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def add_trajectory(self, trajectory: TrajectoryRecorder) -> int:
+        """Learn every clean step of a successful run. Returns the number of steps stored."""
+        stored = 0
+        for step in trajectory.steps:
+            if step['fingerprint'] and step['result'] != 'error' and step['actions']:
+                self.put(trajectory.task, step['fingerprint'], step['actions'])
+                stored += 1
+        self.save()
+        return stored
+
+    def invalidate(self, task: Optional[str] = None, fingerprint: Optional[str] = None) -> int:
+        """Drop one step, every step of a task, or (with no arguments) everything."""
+        if task is not None and fingerprint is not None:
+            doomed = [self.key(task, fingerprint)]
+        elif task is not None:
+            norm = ' '.join(task.lower().split())
+            doomed = [k for k, e in self.entries.items() if ' '.join(e['task'].lower().split()) == norm]
         else:
-            print(f"❓ Unknown command: {cmd}")
-    finally:
+            doomed = list(self.entries)
+        removed = sum(1 for k in doomed if self.entries.pop(k, None) is not None)
+        if removed:
+            self.save()
+        return removed
 
+    def save(self):
         try:
-            await capture_artifacts(page)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps({'entries': list(self.entries.values())}), encoding='utf-8')
+            os.replace(tmp, self.path)
+            self.dirty = False
         except Exception as e:
-            print(f"⚠️ capture_artifacts failed: {e}")
+            print(f"⚠️ Could not save replay cache: {e}")
+
+    def flush(self):
+        """Save if lookups changed anything since the last save."""
+        if self.dirty:
+            self.save()
 
-def append_command_to_log(cmd: str):
+async def stop_bridge_server(bridge_server):
+    if bridge_server:
+        try:
+            bridge_server.close()
+            await bridge_server.wait_closed()
+            print("[WS Server] stopped")
+        except Exception as e:
+            print(f"⚠️ Error shutting down WS server: {e}")
+
+@dataclass
+class TaskOutcome:
+    task_id: str
+    task: str
+    status: str = 'max_steps'  # done | stopped | loop | max_steps | error
+    steps: int = 0
+    actions: int = 0
+    replayed_steps: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+def finish_trajectory(trajectory: TrajectoryRecorder, cache: Optional[ReplayCache], outcome: str,
+                      path: Optional[Path] = None):
+    """Save the run's trajectory; successful runs are also learned into the replay cache."""
+    saved = trajectory.save(outcome, path)
+    if saved:
+        print(f"🗂 Trajectory saved: {saved}")
+    if outcome == 'done' and cache is not None:
+        learned = cache.add_trajectory(trajectory)
+        print(f"🧠 Learned {learned} step(s) into the replay cache ({len(cache.entries)} entries)")
+    elif cache is not None:
+        cache.flush()
+
+def load_tasks(path) -> list:
+    """Read a JSONL batch: one {"id": ..., "task": ..., "start_url": ...} object or bare string per line."""
+    tasks = []
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                item = line
+            if isinstance(item, str):
+                item = {'task': item}
+            item.setdefault('id', f"task-{n}")
+            tasks.append(item)
+    return tasks
+
+async def run_unattended_task(browser, spec: dict, client: BridgeClient,
+                              max_steps: int = BATCH_MAX_STEPS, runs_dir: Optional[Path] = None,
+                              cache: Optional[ReplayCache] = None, replay: bool = False) -> TaskOutcome:
+    """Drive one task to completion in its own browser context, executing suggestions without approval.
+
+    With `replay`, steps found in `cache` are executed without asking the model.
+    """
+    outcome = TaskOutcome(task_id=str(spec['id']), task=spec['task'])
+    started = time.perf_counter()
+    task_dir = (runs_dir or BATCH_RUNS_DIR) / re.sub(r'[^A-Za-z0-9_.-]', '_', outcome.task_id)
+    task_dir.mkdir(parents=True, exist_ok=True)
+    commands_path = task_dir / 'commands.jsonl'
+    commands_path.write_text('', encoding='utf-8')
+    history = CommandHistory(commands_path)
+
+    print(f"🚀 [{outcome.task_id}] starting: {outcome.task}")
+    trajectory = TrajectoryRecorder(outcome.task)
+    context = await browser.new_context()
+    router = await install_request_router(context)
     try:
-        timestamp = datetime.utcnow().isoformat() + 'Z'
-        with open(COMMANDS_PATH, 'a', encoding='utf-8') as f:
-            f.write(f"[{timestamp}] {cmd}\n")
+        page = await context.new_page()
+        captures = CaptureManager(page, debug_dir=task_dir if ARTIFACTS_DEBUG_DIR is not None else None)
+        await captures.install()
+        if spec.get('start_url'):
+            await open_url(page, spec['start_url'])
+            captures.mark_dirty()
+
+        inst = format_instructions_for_copilot(outcome.task)
+        retry = Backoff()
+        replayed_fp = None
+        breaker = LoopBreaker(outcome.task, outcome.task_id, task_dir / 'loop_events.jsonl')
+        while outcome.steps < max_steps:
+            outcome.steps += 1
+            trace_step(outcome.task_id, outcome.steps)
+            await captures.ensure_fresh()
+            fingerprint = page_state_fingerprint(captures.artifacts)
+            state = loop_state(fingerprint, captures.screenshot_hash)
+            if breaker.check(state):
+                outcome.status = 'loop'
+                break
+            # Never replay the same page twice in a row: if the cached actions didn't change
+            # the page, the model has to look at it.
+            actions = cache.lookup(outcome.task, fingerprint) if replay and cache and fingerprint != replayed_fp else None
+            source = 'model'
+            if actions is not None:
+                source = 'cache'
+                replayed_fp = fingerprint
+                outcome.replayed_steps += 1
+                print(f"♻️ [{outcome.task_id}] Replaying {len(actions)} cached action(s) for this page")
+            elif STREAM_REPLIES:
+                result, actions, error = await ask_copilot_and_execute_streaming(
+                    page, inst, captures.artifacts, client, captures, history)
+                if error:
+                    delay = retry.next_delay()
+                    print(f"❌ [{outcome.task_id}] {error}\nRetrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                retry.reset()
+            else:
+                reply = await ask_copilot_and_get_reply(inst, captures.artifacts, client, history)
+                if not reply:
+                    delay = retry.next_delay()
+                    print(f"❌ [{outcome.task_id}] No reply from Copilot. Retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                actions, error = parse_copilot_reply(reply)
+                if error:
+                    print(f"⚠️ [{outcome.task_id}] {error}")
+                    actions, error = await ask_copilot_to_correct(inst, reply, error, client)
+                if error:
+                    delay = retry.next_delay()
+                    print(f"❌ [{outcome.task_id}] {error}\nRetrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                retry.reset()
+
+            stop = any(a.get('action') == 'break_loop' for a in actions)
+            actions = [a for a in actions if a.get('action') != 'break_loop']
+            outcome.actions += sum(1 for a in actions if action_json_to_command(a))
+            if source == 'cache' or not STREAM_REPLIES:
+                result = await execute_actions(page, actions, captures, history, stop_on_error=(source == 'cache'))
+            trajectory.record_step(fingerprint, page.url, actions, result, source)
+            if result == 'error' and source == 'cache' and cache is not None:
+                print(f"♻️ [{outcome.task_id}] Cached actions failed; invalidating that step")
+                cache.invalidate(outcome.task, fingerprint)
+            if result == 'exit':
+                outcome.status = 'done'
+                break
+            if stop:
+                outcome.status = 'stopped'
+                break
+            if breaker.record(state, actions):
+                outcome.status = 'loop'
+                break
     except Exception as e:
-        print(f"⚠️ Failed to append to commands log: {e}")
-
-async def main():
+        outcome.status = 'error'
+        outcome.error = str(e)
+        print(f"❌ [{outcome.task_id}] failed: {e}")
+    finally:
+        try:
+            await context.close()
+        except Exception:
+            pass
+        await history.close()
+        outcome.seconds = round(time.perf_counter() - started, 3)
+    finish_trajectory(trajectory, cache, outcome.status, task_dir / 'trajectory.json')
+    if router is not None:
+        print(router.report(label=f"[{outcome.task_id}] requests: "))
+    print(f"🏁 [{outcome.task_id}] {outcome.status} after {outcome.steps} step(s), {outcome.seconds:.1f}s")
+    return outcome
+
+# How this process got its browser and how long the first action took; see note_first_action.
+startup = {'mode': None, 'browser_ready': None, 'first_action': None}
+
+@traced('startup.browser', outcome=lambda r: 'warm' if r[1] else 'cold')
+async def acquire_browser(p, headless: bool = False, use_daemon: bool = True):
+    """Attach to the warm browser from `--serve-browser` if one is running, else launch Chromium.
+
+    Returns (browser, warm). Closing an attached browser only disconnects from it (and closes
+    the contexts this process opened); the daemon keeps running.
+    """
+    browser = None
+    if use_daemon and BROWSER_DAEMON_STATE.exists():
+        try:
+            state = json.loads(BROWSER_DAEMON_STATE.read_text(encoding='utf-8'))
+            browser = await p.chromium.connect_over_cdp(state['cdp_url'], timeout=BROWSER_DAEMON_CONNECT_TIMEOUT * 1000)
+            print(f"🔥 Attached to the warm browser at {state['cdp_url']} (bridge at {state.get('bridge_url', BRIDGE_URL)})")
+        except Exception as e:
+            print(f"⚠️ Warm browser not reachable ({e}); launching a new one")
+    warm = browser is not None
+    if not warm:
+        browser = await p.chromium.launch(headless=headless)
+    startup['mode'] = 'warm' if warm else 'cold'
+    startup['browser_ready'] = round(time.perf_counter() - PROCESS_STARTED, 3)
+    return browser, warm
+
+def note_first_action():
+    """Report once how long this process took to run its first action."""
+    if startup['first_action'] is not None:
+        return
+    startup['first_action'] = round(time.perf_counter() - PROCESS_STARTED, 3)
+    how = f"{startup['mode']} browser ready at {startup['browser_ready']:.2f}s" if startup['mode'] else "no browser launch recorded"
+    print(f"⏱ First action {startup['first_action']:.2f}s after start ({how})")
+
+async def serve_browser(headless: bool = False):
+    """Keep a browser and the bridge running until interrupted, for later runs to attach to."""
     async with async_playwright() as p:
-
         bridge_server = None
         try:
             bridge_server = await start_bridge_server()
         except Exception as e:
-            print(f"⚠️ Failed to start embedded bridge server: {e}")
+            print(f"⚠️ Failed to start the bridge (is one already running?): {e}")
+        browser = await p.chromium.launch(headless=headless, args=[f'--remote-debugging-port={BROWSER_DAEMON_PORT}'])
+        state = {'cdp_url': f'http://127.0.0.1:{BROWSER_DAEMON_PORT}', 'bridge_url': BRIDGE_URL,
+                 'pid': os.getpid(), 'started': datetime.utcnow().isoformat() + 'Z'}
+        BROWSER_DAEMON_STATE.write_text(json.dumps(state, indent=2), encoding='utf-8')
+        print(f"🔥 Warm browser ready at {state['cdp_url']}; new runs will attach to it. Ctrl+C to stop.")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            BROWSER_DAEMON_STATE.unlink(missing_ok=True)
+            try:
+                await browser.close()
+            except Exception:
+                pass
+            await stop_bridge_server(bridge_server)
+
+async def run_batch(tasks: list, concurrency: int = BATCH_CONCURRENCY, max_steps: int = BATCH_MAX_STEPS,
+                    results_path: Optional[Path] = None, headless: bool = False, replay: bool = False,
+                    use_daemon: bool = True) -> list:
+    """Run `tasks` concurrently, each in its own context of one shared browser.
+
+    Returns a TaskOutcome per task (in input order); also appends them to `results_path` as JSONL.
+    """
+    async with async_playwright() as p:
+        await register_ref_selector_engine(p)
+
+        browser, warm = await acquire_browser(p, headless, use_daemon)
+        bridge_server = None
+        if not warm:
+            try:
+                bridge_server = await start_bridge_server()
+            except Exception as e:
+                print(f"⚠️ Failed to start embedded bridge server (using an existing one?): {e}")
+
+        client = BridgeClient().start()
+        limit = asyncio.Semaphore(max(1, concurrency))
+        cache = ReplayCache()
+
+        async def run_one(spec):
+            async with limit:
+                outcome = await run_unattended_task(browser, spec, client, max_steps, cache=cache, replay=replay)
+            if results_path is not None:
+                with open(results_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(outcome.__dict__) + '\n')
+            return outcome
+
+        try:
+            outcomes = await asyncio.gather(*(run_one(spec) for spec in tasks))
+        finally:
+            try:
+                await browser.close()
+            except Exception:
+                pass
+            await client.close()
+            await stop_bridge_server(bridge_server)
+
+    done = sum(1 for o in outcomes if o.status == 'done')
+    print(f"📊 Batch finished: {done}/{len(outcomes)} done")
+    print(reply_stats_line())
+    if replay:
+        cache.flush()
+        print(f"♻️ Replay cache: {cache.hits} hit(s), {cache.misses} miss(es)")
+    return outcomes
+
+async def main(goal: Optional[str] = None, autoconfirm: Optional[bool] = None, replay: bool = False,
+               headless: bool = False, use_daemon: bool = True):
+    global task
+    if goal:
+        task = goal
+    if task is None:
+        task = (await ainput("What is your goal? ")).strip()
+
+    async with async_playwright() as p:
+
+        await register_ref_selector_engine(p)
+
+        browser, warm = await acquire_browser(p, headless, use_daemon)
+        bridge_server = None
+        if not warm:
+            try:
+                bridge_server = await start_bridge_server()
+            except Exception as e:
+                print(f"⚠️ Failed to start embedded bridge server: {e}")
+
+        bridge_client = BridgeClient().start()
 
-        browser = await p.chromium.launch(headless=False)
         page = await browser.new_page()
+        router = await install_request_router(page.context)
 
         try:
             COMMANDS_PATH.write_text('', encoding='utf-8')
@@ -346,67 +3067,113 @@ async def main():
         except Exception as e:
             print(f"⚠️ Could not clear commands log at session start: {e}")
 
-        try:
-            await capture_artifacts(page)
-        except Exception as e:
-            print(f"⚠️ Initial capture failed: {e}")
+        captures = CaptureManager(page)
+        await captures.install()
+        cache = ReplayCache()
+        trajectory = TrajectoryRecorder(task)
+        replayed_fp = None
+        breaker = LoopBreaker(task)
+
+        def hand_back_on_loop(trip):
+            nonlocal automated
+            if trip:
+                automated = False
+                print("✋ Handing control back to you instead of asking Copilot again. "
+                      "Type commands, or 'auto' to let Copilot continue.")
+
+        async def run_suggested(actions, source, fingerprint, state):
+            result = await execute_actions(page, actions, captures, stop_on_error=(source == 'cache'))
+            trajectory.record_step(fingerprint, page.url, actions, result, source)
+            if result == 'error' and source == 'cache':
+                print("♻️ Cached actions failed; invalidating that step")
+                cache.invalidate(task, fingerprint)
+            if result != 'exit':
+                hand_back_on_loop(breaker.record(state, actions))
+            return result
+
+        async def finish_and_ask() -> bool:
+            nonlocal trajectory
+            finish_trajectory(trajectory, cache, 'done')
+            if not await handle_exit_request(browser, page):
+                return False
+            trajectory = TrajectoryRecorder(task)
+            return True
+
         print("🎮 Barebones Web Controller with Copilot integration")
         print_available_commands()
 
         print("🤖 Starting automated Copilot loop. Type 'manual' to enter manual command mode, or 'exit' to quit.")
         automated = True
+        retry = Backoff()
 
-        while True:
-            ans = input("Enable autoconfirm (auto-execute Copilot suggestions) at startup? (y/n): ").strip().lower()
+        while autoconfirm is None:
+            ans = (await ainput("Enable autoconfirm (auto-execute Copilot suggestions) at startup? (y/n): ")).strip().lower()
             if ans in ('y', 'yes'):
                 autoconfirm = True
-                break
             elif ans in ('n', 'no'):
                 autoconfirm = False
-                break
             else:
                 print("Please enter 'y' or 'n'.")
+        step = 0
         while True:
+            step += 1
+            trace_step('session', step)
             if automated:
                 inst = format_instructions_for_copilot(task)
-                print("\n🛰 Asking Copilot what to do next...")
-                reply = await ask_copilot_and_get_reply(inst)
-                if not reply:
-                    print("❌ No reply from Copilot. Retrying in 3 seconds...")
-                    await asyncio.sleep(3)
-                    continue
-
                 try:
-                    data = json.loads(reply)
+                    await captures.ensure_fresh()
                 except Exception as e:
-                    print(f"❌ Could not parse Copilot reply as JSON: {e}\nRaw reply:\n{reply}")
-                    await asyncio.sleep(2)
+                    print(f"⚠️ capture_artifacts failed: {e}")
+                fingerprint = page_state_fingerprint(captures.artifacts)
+                state = loop_state(fingerprint, captures.screenshot_hash)
+                if breaker.check(state):
+                    hand_back_on_loop(True)
                     continue
-
-                if isinstance(data, str):
-                    try:
-                        data2 = json.loads(data)
-                        data = data2
-                    except Exception:
-                        print("❌ Copilot reply was a JSON string but secondary parse failed.\nRaw inner string:\n" + data)
-                        await asyncio.sleep(2)
+                actions = cache.lookup(task, fingerprint) if replay and fingerprint != replayed_fp else None
+                source = 'model'
+                if actions is not None:
+                    source = 'cache'
+                    replayed_fp = fingerprint
+                    print(f"\n♻️ This page is in the replay cache; reusing {len(actions)} action(s) without asking Copilot.")
+                elif autoconfirm and STREAM_REPLIES:
+                    print("\n🛰 Asking Copilot what to do next (⚡ autoconfirm: actions run as they stream in)...")
+                    result, actions, error = await ask_copilot_and_execute_streaming(
+                        page, inst, captures.artifacts, bridge_client, captures)
+                    if error:
+                        delay = retry.next_delay()
+                        print(f"❌ {error}\nRetrying in {delay:.1f}s...")
+                        await asyncio.sleep(delay)
                         continue
-
-                actions = []
-
-                if not isinstance(data, dict):
-                    print(f"❌ Copilot reply is not a JSON object as expected. Raw parsed value: {repr(data)}")
-                    await asyncio.sleep(2)
+                    retry.reset()
+                    trajectory.record_step(fingerprint, page.url, actions, result, source)
+                    if any(a.get('action') == 'break_loop' for a in actions):
+                        print("🛑 Copilot requested to break the automated loop. Stopping automated polling.")
+                        automated = False
+                    if result == 'exit':
+                        if not await finish_and_ask():
+                            return
+                    else:
+                        hand_back_on_loop(breaker.record(state, actions))
                     continue
-
-                if 'actions' in data and isinstance(data['actions'], list):
-                    actions = data['actions']
-                elif 'action' in data:
-                    actions = [data]
                 else:
-                    print(f"❌ Unrecognized reply schema from Copilot: {data}")
-                    await asyncio.sleep(2)
-                    continue
+                    print("\n🛰 Asking Copilot what to do next...")
+                    reply = await ask_copilot_and_get_reply(inst, captures.artifacts, bridge_client)
+                    if not reply:
+                        delay = retry.next_delay()
+                        print(f"❌ No reply from Copilot. Retrying in {delay:.1f}s...")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    actions, error = parse_copilot_reply(reply)
+                    if error:
+                        print(f"⚠️ {error}")
+                        actions, error = await ask_copilot_to_correct(inst, reply, error, bridge_client)
+                    if error:
+                        delay = retry.next_delay()
+                        print(f"❌ {error}\nRetrying in {delay:.1f}s...")
+                        await asyncio.sleep(delay)
+                        continue
+                    retry.reset()
 
                 print("\n🔎 Copilot suggested the following action(s):")
                 for i, act in enumerate(actions, start=1):
@@ -422,43 +3189,18 @@ async def main():
 
                 if autoconfirm:
                     print("⚡ Autoconfirm is ON — executing Copilot actions automatically.")
-                    for act in actions:
-                        cmdstr = action_json_to_command(act)
-                        if not cmdstr:
-                            print(f"⚠️ Skipping unsupported or empty action: {act}")
-                            continue
-                        print(f"▶ Executing Copilot action: {cmdstr}")
-
-                        append_command_to_log(cmdstr)
-                        res = await process_command(page, cmdstr)
-                        if res == 'exit':
-                                cont = await handle_exit_request(browser, page)
-                                if not cont:
-                                    return
-                    await asyncio.sleep(1)
+                    if await run_suggested(actions, source, fingerprint, state) == 'exit' and not await finish_and_ask():
+                        return
                     continue
 
                 while True:
-                    choice = input("Approve and execute these actions? (y = yes, n = no, m = manual, a = toggle autoconfirm, e = exit): ").strip().lower()
+                    choice = (await ainput("Approve and execute these actions? (y = yes, n = no, m = manual, a = toggle autoconfirm, e = exit): ")).strip().lower()
                     if choice == 'y':
-                        for act in actions:
-                            cmdstr = action_json_to_command(act)
-                            if not cmdstr:
-                                print(f"⚠️ Skipping unsupported or empty action: {act}")
-                                continue
-                            print(f"▶ Executing Copilot action: {cmdstr}")
-                            append_command_to_log(cmdstr)
-                            res = await process_command(page, cmdstr)
-                            if res == 'exit':
-                                    cont = await handle_exit_request(browser, page)
-                                    if not cont:
-                                        return
-
-                        await asyncio.sleep(1)
+                        if await run_suggested(actions, source, fingerprint, state) == 'exit' and not await finish_and_ask():
+                            return
                         break
                     elif choice == 'n':
-                        print("⛔ Copilot suggestion rejected. Asking again in 1 second...")
-                        await asyncio.sleep(1)
+                        print("⛔ Copilot suggestion rejected. Asking again...")
                         break
                     elif choice == 'm':
                         automated = False
@@ -473,15 +3215,17 @@ async def main():
                     elif choice == 'e' or choice == 'exit':
                             cont = await handle_exit_request(browser, page)
                             if not cont:
+                                finish_trajectory(trajectory, cache, 'aborted')
                                 return
                     else:
                         print("Please enter y, n, m, a, or e.")
 
             else:
 
-                cmd = input("Manual command (or 'auto' to resume): ").strip()
+                cmd = (await ainput("Manual command (or 'auto' to resume): ")).strip()
                 if cmd == 'auto':
                     automated = True
+                    breaker.reset()
                     print("🔁 Resuming automated Copilot loop...")
                     continue
 
@@ -492,22 +3236,141 @@ async def main():
                         print(f"🔁 Autoconfirm set to {autoconfirm}")
                         continue
 
-                append_command_to_log(cmd)
-                if await process_command(page, cmd) == "exit":
+                if cmd == 'measure_screenshots':
+                    await measure_screenshot_policies(page, focus_box=captures.focus_box)
+                    continue
+
+                if cmd == 'trace_summary':
+                    if _tracer is not None:
+                        _tracer.print_summary()
+                    else:
+                        print("Tracing is off (started with --no-trace).")
+                    continue
+
+                result = await process_command(page, cmd, captures)
+                get_command_history().record(cmd, url=page.url, result=result or 'ok')
+                if result == "exit":
                     break
 
+        stats = captures.stats()
+        print(f"📊 Artifact captures: {stats['captures']} taken, {stats['skipped']} skipped")
+        print(reply_stats_line())
+        if router is not None:
+            print(router.report(label="Requests this session: "))
+        cache.flush()
+        await get_command_history().close()
+
         try:
             await browser.close()
         except Exception:
             pass
 
-        if bridge_server:
-            try:
-                bridge_server.close()
-                await bridge_server.wait_closed()
-                print("[WS Server] stopped")
-            except Exception as e:
-                print(f"⚠️ Error shutting down WS server: {e}")
+        await bridge_client.close()
+        await stop_bridge_server(bridge_server)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive a browser with Copilot suggestions.")
+    parser.add_argument('--config', metavar='CONFIG.json',
+                        help="JSON file with defaults for any option below (keys use underscores, e.g. max_steps)")
+    parser.add_argument('--task', help="goal for this session (skips the goal prompt)")
+    parser.add_argument('--start-url', help="page to open before the first step (--non-interactive only)")
+    parser.add_argument('--autoconfirm', dest='autoconfirm', action='store_true', default=None,
+                        help="execute Copilot suggestions without asking")
+    parser.add_argument('--no-autoconfirm', dest='autoconfirm', action='store_false',
+                        help="ask before executing Copilot suggestions")
+    parser.add_argument('--non-interactive', action='store_true', default=None,
+                        help="run --task unattended and never read from the console")
+    parser.add_argument('--batch', metavar='TASKS.jsonl', help="run every task in the file unattended")
+    parser.add_argument('--concurrency', type=int, help=f"tasks run at once in --batch mode (default {BATCH_CONCURRENCY})")
+    parser.add_argument('--max-steps', type=int, help=f"model turns per unattended task (default {BATCH_MAX_STEPS})")
+    parser.add_argument('--results', metavar='RESULTS.jsonl', help="append per-task outcomes here in unattended modes")
+    parser.add_argument('--replay', action='store_true', default=None,
+                        help="reuse actions from earlier successful runs of the same task instead of asking Copilot")
+    parser.add_argument('--clear-replay-cache', action='store_true',
+                        help="forget cached steps (only --task's, if given) and exit")
+    parser.add_argument('--trace', metavar='TRACES.jsonl',
+                        help=f"write per-step timing spans here (default {TRACE_PATH.name})")
+    parser.add_argument('--no-trace', dest='trace', action='store_false', help="turn timing spans off entirely")
+    parser.add_argument('--routing', choices=sorted(ROUTING_PROFILES),
+                        help="what to block and cache: default (block fonts, media, ads and analytics; cache static "
+                             "assets), cache-only, or off")
+    parser.add_argument('--loop-repeat', type=int,
+                        help=f"stop after the same actions run this often on an unchanged page (default {LOOP_REPEAT_LIMIT}; 0 = off)")
+    parser.add_argument('--loop-stall', type=int,
+                        help=f"stop after this many steps without the page changing (default {LOOP_STALL_STEPS}; 0 = off)")
+    parser.add_argument('--headless', action='store_true', default=None, help="run the browser without a window")
+    parser.add_argument('--serve-browser', action='store_true', default=None,
+                        help="keep a warm browser and the bridge running for later runs to attach to (Ctrl+C stops it)")
+    parser.add_argument('--cold', action='store_true', default=None,
+                        help="launch a new browser even if a --serve-browser one is running")
+    parser.add_argument('--har', metavar='TRAFFIC.har', help="answer every request from this HAR, offline")
+    parser.add_argument('--record-har', metavar='TRAFFIC.har', help="record the session's traffic to this HAR")
+    args = parser.parse_args(argv)
+
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config = json.load(f)
+        for key, value in config.items():
+            key = key.replace('-', '_')
+            if not hasattr(args, key) or key == 'config':
+                parser.error(f"unknown option in {args.config}: {key}")
+            if getattr(args, key) is None:
+                setattr(args, key, value)
+
+    if args.concurrency is None:
+        args.concurrency = BATCH_CONCURRENCY
+    if args.max_steps is None:
+        args.max_steps = BATCH_MAX_STEPS
+    args.replay = bool(args.replay)
+    args.headless = bool(args.headless)
+    args.cold = bool(args.cold)
+    if args.har and args.record_har:
+        parser.error("--har replays a HAR and --record-har records one; pick one")
+    if args.trace is None:
+        args.trace = TRACE_ENABLED
+    if args.non_interactive:
+        if not args.task:
+            parser.error("--non-interactive needs --task (or 'task' in --config)")
+        if args.autoconfirm is False:
+            parser.error("--non-interactive executes suggestions without approval; drop --no-autoconfirm")
+    return args
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    results_path = Path(args.results) if args.results else None
+
+    if args.trace and not args.clear_replay_cache:
+        enable_tracing(Path(args.trace) if isinstance(args.trace, str) else None)
+
+    if args.loop_repeat is not None:
+        LOOP_REPEAT_LIMIT = args.loop_repeat
+    if args.loop_stall is not None:
+        LOOP_STALL_STEPS = args.loop_stall
+    if args.routing:
+        ROUTING_PROFILE = ROUTING_PROFILES[args.routing]
+    if args.har or args.record_har:
+        ROUTING_PROFILE = replace(ROUTING_PROFILE, har_path=Path(args.har or args.record_har),
+                                  har_update=bool(args.record_har))
+
+    if args.clear_replay_cache:
+        removed = ReplayCache().invalidate(args.task)
+        print(f"🧹 Removed {removed} cached step(s)")
+    elif args.serve_browser:
+        try:
+            asyncio.run(serve_browser(args.headless))
+        except KeyboardInterrupt:
+            print("🔥 Warm browser stopped")
+    elif args.batch:
+        asyncio.run(run_batch(load_tasks(args.batch), args.concurrency, args.max_steps, results_path,
+                              headless=args.headless, replay=args.replay, use_daemon=not args.cold))
+    elif args.non_interactive:
+        spec = {'id': 'session', 'task': args.task}
+        if args.start_url:
+            spec['start_url'] = args.start_url
+        outcomes = asyncio.run(run_batch([spec], 1, args.max_steps, results_path, headless=args.headless,
+                                         replay=args.replay, use_daemon=not args.cold))
+        finish_tracing()
+        sys.exit(0 if outcomes and outcomes[0].status == 'done' else 1)
+    else:
+        asyncio.run(main(args.task, args.autoconfirm, args.replay, args.headless, use_daemon=not args.cold))
+    finish_tracing()
\ No newline at end of file
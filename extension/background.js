@@ -15,7 +15,7 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
 
   const attachments = msg.attachments || (msg.attachment ? [msg.attachment] : []);
 
-  runCopilotFlow(msg.prompt, attachments)
+  runCopilotFlow(msg.prompt, attachments, msg.stream ? msg.id : null, msg.requestKey || null)
     .then(reply => {
       bglog('runCopilotFlow resolved:', reply);
       sendResponse({ reply });
@@ -28,6 +28,82 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
   return true; 
 });
 
+// Where the chat lives. To try the extension against the stand-in composer (test.html,
+// served over http), run in the service worker console:
+//   chrome.storage.local.set({ copilotUrl: 'http://localhost:8000/test.html' })
+const DEFAULT_COPILOT_URL = 'https://copilot.microsoft.com/';
+let copilotUrl = DEFAULT_COPILOT_URL;
+chrome.storage.local.get('copilotUrl', items => {
+  if (items && items.copilotUrl) copilotUrl = items.copilotUrl;
+  warnIfNoHostAccess();
+});
+
+// localhost access is an optional permission; the bridge page has a button that requests it.
+function warnIfNoHostAccess() {
+  if (copilotUrl === DEFAULT_COPILOT_URL) return;
+  const u = new URL(copilotUrl);
+  chrome.permissions.contains({ origins: [`${u.protocol}//${u.hostname}/*`] }, has => {
+    if (!has) bglog(`No access to ${u.hostname} yet; click "Allow local Copilot stand-in" on the bridge page`);
+  });
+}
+chrome.storage.onChanged.addListener(changes => {
+  if (!changes.copilotUrl) return;
+  copilotUrl = changes.copilotUrl.newValue || DEFAULT_COPILOT_URL;
+  warnIfNoHostAccess();
+  // The spare tab is loading the old URL.
+  if (spareTabId !== null) {
+    chrome.tabs.remove(spareTabId).catch(() => {});
+    spareTabId = null;
+  }
+});
+
+// Match patterns ignore ports, so the stand-in matches whatever port it is served on.
+function copilotUrlPattern() {
+  const u = new URL(copilotUrl);
+  return `${u.protocol}//${u.hostname}${u.pathname}*`;
+}
+
+// Attachments already in each tab's chat (name -> content hash). Every chat starts in a fresh
+// tab, so this only skips files that the same conversation has already been given.
+const attachedByTab = new Map();
+chrome.tabs.onRemoved.addListener(tabId => {
+  attachedByTab.delete(tabId);
+  if (tabId === spareTabId) spareTabId = null;
+});
+
+// Every bridge request runs in a Copilot tab of its own (request key -> tab id), so bridge
+// pages working in parallel never type into the same composer or close each other's chat.
+// One spare tab is kept loading for the next request; every request starts a fresh chat anyway.
+const tabByRequest = new Map();
+let spareTabId = null;
+
+async function claimRequestTab(key) {
+  let tab = null;
+  if (spareTabId !== null) {
+    const id = spareTabId;
+    spareTabId = null;
+    tab = await chrome.tabs.get(id).catch(() => null);
+  }
+  if (!tab) tab = await chrome.tabs.create({ url: copilotUrl, active: false });
+  tabByRequest.set(key, tab.id);
+  bglog('claimRequestTab:', key, '->', tab.id);
+  return tab;
+}
+
+// Closes the tab of request `key` (only that one) and makes sure a spare is loading.
+async function releaseRequestTab(key) {
+  const tabId = tabByRequest.get(key);
+  if (tabId === undefined) return false;
+  tabByRequest.delete(key);
+  bglog('releaseRequestTab:', key, 'closing tab', tabId);
+  await chrome.tabs.remove(tabId).catch(() => {});
+  if (spareTabId === null) {
+    const spare = await chrome.tabs.create({ url: copilotUrl, active: false });
+    spareTabId = spare.id;
+  }
+  return true;
+}
+
 let _lastOpenRequestTs = 0;
 let _openInProgress = false;
 const OPEN_COOLDOWN_MS = 5000; 
@@ -55,15 +131,24 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
 
     bglog('openNewCopilot requested — closing existing copilot tabs and opening/focusing fresh one');
 
-    if (force) {
+    if (force && msg.requestKey) {
+      releaseRequestTab(msg.requestKey).then(closed => {
+        clearTimeout(clearOpenFlagTimer);
+        _openInProgress = false;
+        sendResponse({ ok: true, closed, forced: true });
+      });
+    } else if (force) {
 
-      chrome.tabs.query({ url: 'https://copilot.microsoft.com/*' }, tabs => {
+      chrome.tabs.query({ url: copilotUrlPattern() }, tabs => {
+        // Tabs that belong to a running request are left alone.
+        const owned = new Set(tabByRequest.values());
+        tabs = (tabs || []).filter(t => !owned.has(t.id) && t.id !== spareTabId);
         if (tabs && tabs.length) {
           const ids = tabs.map(t => t.id).filter(Boolean);
           bglog('force: closing Copilot website tabs', ids);
           chrome.tabs.remove(ids, () => {
             bglog('force: closed Copilot website tabs, opening fresh Copilot site tab');
-            chrome.tabs.create({ url: 'https://copilot.microsoft.com/' }, newTab => {
+            chrome.tabs.create({ url: copilotUrl }, newTab => {
               clearTimeout(clearOpenFlagTimer);
               _openInProgress = false;
               sendResponse({ ok: true, opened: true, tabId: newTab.id, forced: true });
@@ -71,7 +156,7 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
           });
         } else {
           bglog('force: no existing Copilot site tabs, opening Copilot site');
-          chrome.tabs.create({ url: 'https://copilot.microsoft.com/' }, newTab => {
+          chrome.tabs.create({ url: copilotUrl }, newTab => {
             clearTimeout(clearOpenFlagTimer);
             _openInProgress = false;
             sendResponse({ ok: true, opened: true, tabId: newTab.id, forced: true });
@@ -91,10 +176,10 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
           return;
         }
 
-        chrome.tabs.query({ url: 'https://copilot.microsoft.com/*' }, tabs => {
+        chrome.tabs.query({ url: copilotUrlPattern() }, tabs => {
           if (tabs && tabs.length) {
             const ids = tabs.map(t => t.id).filter(Boolean);
-            bglog('closing copilot.microsoft.com tabs', ids);
+            bglog('closing Copilot site tabs', ids);
             chrome.tabs.remove(ids, () => {
               bglog('closed old tabs, opening new extension tab');
               chrome.tabs.create({ url: chrome.runtime.getURL('copilot-shell.html') }, newTab => {
@@ -119,10 +204,12 @@ chrome.runtime.onMessage.addListener((msg, sender, sendResponse) => {
   }
 });
 
-async function runCopilotFlow(prompt, attachments) {
+// With a requestKey (bridge requests) the prompt gets a tab of its own, which stays open until
+// the bridge page asks for it to be closed; without one (the popup) it shares the first tab.
+async function runCopilotFlow(prompt, attachments, streamId = null, requestKey = null) {
   bglog('→ start runCopilotFlow for prompt:', prompt);
 
-  const tab = await findOrCreateTab();
+  const tab = requestKey ? await claimRequestTab(requestKey) : await findOrCreateTab();
   bglog('→ using tab:', tab.id, tab.url);
 
   await waitForLoad(tab.id);
@@ -132,49 +219,53 @@ async function runCopilotFlow(prompt, attachments) {
   bglog('→ textarea ready');
 
   if (attachments && attachments.length) {
-    for (const att of attachments) {
-      if (!att) continue;
-      bglog('→ attaching file to Copilot composer:', att.name);
+    const inChat = attachedByTab.get(tab.id) || new Map();
+    const fresh = [];
+    for (const raw of attachments) {
+      const att = raw && toTransportAttachment(raw);
+      if (!att || !att.name) {
+        bglog('→ attachment missing expected fields, skipping', raw);
+        continue;
+      }
+      if (att.hash && inChat.get(att.name) === att.hash) {
+        bglog('→ attachment identical to the one already in this chat, skipping:', att.name);
+        continue;
+      }
+      fresh.push(att);
+    }
+    if (fresh.length) {
+      bglog('→ attaching files to Copilot composer:', fresh.map(a => a.name));
       try {
-
-        if (att.dataURL) {
-          await injectFileIntoPage(tab.id, att);
-        } else if (att.data && att.type && att.name) {
-
-          const dataURL = `data:${att.type};charset=utf-8,` + encodeURIComponent(att.data);
-          await injectFileIntoPage(tab.id, { name: att.name, type: att.type, dataURL });
-        } else {
-          bglog('→ attachment missing expected fields, skipping', att);
-          continue;
-        }
-        bglog('→ attachment injected');
+        const result = await injectAttachments(tab.id, fresh);
+        bglog('→ attachments injected', result);
+        for (const att of fresh) if (att.hash) inChat.set(att.name, att.hash);
+        attachedByTab.set(tab.id, inChat);
       } catch (err) {
         bglog('→ attachment injection failed:', err);
-
       }
-
-      await new Promise(r => setTimeout(r, 500));
     }
   }
 
   await sendPrompt(tab.id, prompt);
   bglog('→ prompt injected');
 
-  const reply = await waitForResponse(tab.id, 30000, 700);
+  const reply = await waitForResponse(tab.id, 30000, 700, streamId);
   bglog('→ response received');
   return reply;
 }
 
 function findOrCreateTab() {
   return new Promise(resolve => {
-    chrome.tabs.query({ url: 'https://copilot.microsoft.com/*' }, tabs => {
+    chrome.tabs.query({ url: copilotUrlPattern() }, tabs => {
+      const owned = new Set(tabByRequest.values());
+      tabs = tabs.filter(t => !owned.has(t.id) && t.id !== spareTabId);
       if (tabs.length) {
         bglog('findOrCreateTab: found existing tab', tabs[0].id);
         return resolve(tabs[0]);
       }
       bglog('findOrCreateTab: creating new tab');
       chrome.tabs.create(
-        { url: 'https://copilot.microsoft.com/', active: false },
+        { url: copilotUrl, active: false },
         newTab => {
           bglog('findOrCreateTab: new tab opened', newTab.id);
           resolve(newTab);
@@ -320,116 +411,116 @@ async function sendPrompt(tabId, prompt) {
   });
 }
 
-async function injectFileIntoPage(tabId, attachment) {
-
-  return chrome.scripting.executeScript({
+// Puts every attachment into the composer with one scripting call. Text goes over as a
+// string and becomes a File directly; binary goes over as base64 and is decoded natively.
+// Resolves once the composer shows a preview for each file (not on a timer), or with
+// ok:false after `timeout` ms; the prompt is sent either way.
+async function injectAttachments(tabId, attachments, timeout = 10000) {
+  const [injection] = await chrome.scripting.executeScript({
     target: { tabId },
-    func: (att, timeout) => {
-      return new Promise((resolve, reject) => {
+    func: async (atts, timeout) => {
+      const started = Date.now();
+
+      const decodeBase64 = async (b64, type) => {
+        if (typeof Uint8Array.fromBase64 === 'function') return Uint8Array.fromBase64(b64);
         try {
+          return await (await fetch(`data:${type};base64,${b64}`)).blob();
+        } catch (e) {
+          // The page's CSP may refuse data: URLs; fall back to decoding by hand.
+          const bin = atob(b64);
+          const u8 = new Uint8Array(bin.length);
+          for (let i = 0; i < bin.length; i++) u8[i] = bin.charCodeAt(i);
+          return u8;
+        }
+      };
 
-          const parts = att.dataURL.split(',');
-          const meta = parts[0];
-          const isBase64 = meta.indexOf('base64') !== -1;
-          const matches = /data:([^;]+)(;base64)?/.exec(meta);
-          const mime = matches ? matches[1] : att.type || 'application/octet-stream';
-          const raw = parts[1];
-          let binStr;
-          if (isBase64) {
-            binStr = atob(raw);
-          } else {
-            binStr = decodeURIComponent(raw);
-          }
-          const len = binStr.length;
-          const u8 = new Uint8Array(len);
-          for (let i = 0; i < len; i++) u8[i] = binStr.charCodeAt(i);
-          const blob = new Blob([u8], { type: mime });
-          const file = new File([blob], att.name, { type: mime });
-
-          const inputFile = document.querySelector('input[type=file]');
-          if (inputFile) {
-            try {
-
-              const dt = new DataTransfer();
-              dt.items.add(file);
-              inputFile.files = dt.files;
-
-              inputFile.dispatchEvent(new Event('change', { bubbles: true }));
-            } catch (e) {
-
-              console.warn('input[type=file] assign failed, falling back to drag/drop', e);
-              const dt2 = new DataTransfer();
-              dt2.items.add(file);
-
-              const selectors = [
-                'textarea[placeholder="Message Copilot"]',
-                '[role="textbox"]',
-                '.composer'
-              ];
-              let target = null;
-              for (const s of selectors) {
-                const el = document.querySelector(s);
-                if (el) { target = el; break; }
-              }
-              if (!target) target = document.body;
-              const rect = target.getBoundingClientRect();
-              const x = rect.left + rect.width / 2;
-              const y = rect.top + rect.height / 2;
-              const dragOver = new DragEvent('dragover', { bubbles: true, cancelable: true, dataTransfer: dt2, clientX: x, clientY: y });
-              const drop = new DragEvent('drop', { bubbles: true, cancelable: true, dataTransfer: dt2, clientX: x, clientY: y });
-              target.dispatchEvent(dragOver);
-              setTimeout(() => target.dispatchEvent(drop), 50);
-            }
-          } else {
+      const files = await Promise.all(atts.map(async att => {
+        const type = att.type || 'application/octet-stream';
+        const body = typeof att.text === 'string' ? att.text : await decodeBase64(att.base64 || '', type);
+        return new File([body], att.name, { type });
+      }));
+
+      const composer = document.querySelector('textarea[placeholder="Message Copilot"]') || document.querySelector('[role="textbox"]') || document.querySelector('.composer');
+      const area = (composer && (composer.closest('form') || composer.closest('.composer') || composer.parentElement)) || document.body;
+      const previewSelector = '[aria-label*="attachment" i], [data-testid*="attachment" i], .attachment-preview, .file-name, img';
+      const previewCount = () => area.querySelectorAll(previewSelector).length;
+      const baseline = previewCount();
+      const areaText = () => area.textContent || '';
+
+      // Ready when the composer has one more preview per file, or shows every file's name.
+      const waitForPreviews = (expected, names) => new Promise(resolve => {
+        const ready = () => previewCount() >= baseline + expected || names.every(n => areaText().includes(n));
+        if (ready()) return resolve(true);
+        const obs = new MutationObserver(() => {
+          if (ready()) { obs.disconnect(); clearTimeout(timer); resolve(true); }
+        });
+        obs.observe(document.body, { childList: true, subtree: true, characterData: true, attributes: true });
+        const timer = setTimeout(() => { obs.disconnect(); resolve(false); }, Math.max(0, timeout - (Date.now() - started)));
+      });
+
+      const drop = group => {
+        const dt = new DataTransfer();
+        group.forEach(f => dt.items.add(f));
+        const target = composer || document.body;
+        const rect = target.getBoundingClientRect();
+        const at = { bubbles: true, cancelable: true, dataTransfer: dt, clientX: rect.left + rect.width / 2, clientY: rect.top + rect.height / 2 };
+        target.dispatchEvent(new DragEvent('dragenter', at));
+        target.dispatchEvent(new DragEvent('dragover', at));
+        target.dispatchEvent(new DragEvent('drop', at));
+      };
 
+      const input = document.querySelector('input[type=file]');
+      // An input without `multiple` only keeps one file per change, so those go one at a time.
+      const groups = input && !input.multiple ? files.map(f => [f]) : [files];
+      let expected = 0;
+      let ok = true;
+      for (const group of groups) {
+        expected += group.length;
+        if (input) {
+          try {
             const dt = new DataTransfer();
-            dt.items.add(file);
-            const selectors = [
-              'textarea[placeholder="Message Copilot"]',
-              '[role="textbox"]',
-              '.composer'
-            ];
-            let target = null;
-            for (const s of selectors) {
-              const el = document.querySelector(s);
-              if (el) { target = el; break; }
-            }
-            if (!target) target = document.body;
-            const rect = target.getBoundingClientRect();
-            const x = rect.left + rect.width / 2;
-            const y = rect.top + rect.height / 2;
-            const dragOver = new DragEvent('dragover', { bubbles: true, cancelable: true, dataTransfer: dt, clientX: x, clientY: y });
-            const drop = new DragEvent('drop', { bubbles: true, cancelable: true, dataTransfer: dt, clientX: x, clientY: y });
-            target.dispatchEvent(dragOver);
-            setTimeout(() => target.dispatchEvent(drop), 50);
+            group.forEach(f => dt.items.add(f));
+            input.files = dt.files;
+            input.dispatchEvent(new Event('change', { bubbles: true }));
+          } catch (e) {
+            console.warn('input[type=file] assign failed, falling back to drag/drop', e);
+            drop(group);
           }
-
-          const start = Date.now();
-          const check = () => {
-
-            const maybe = document.querySelector('img') || document.querySelector('[aria-label*="attachment"]') || document.querySelector('.attachment-preview') || document.querySelector('.file-name');
-            if (maybe) return resolve(true);
-            if (Date.now() - start > timeout) return reject('Timeout waiting for attachment preview');
-            setTimeout(check, 200);
-          };
-          check();
-        } catch (err) {
-          reject(err?.toString?.() || String(err));
+        } else {
+          drop(group);
         }
-      });
+        ok = (await waitForPreviews(expected, files.slice(0, expected).map(f => f.name))) && ok;
+      }
+      return { ok, files: files.length, bytes: files.reduce((n, f) => n + f.size, 0), ms: Date.now() - started };
     },
-    args: [attachment, 5000]
-  }).then(results => {
-
-    return true;
+    args: [attachments, timeout]
   });
+  return injection.result;
 }
 
-async function waitForResponse(tabId, timeout = 30000, settleTime = 700) {
+// chrome.runtime and chrome.scripting pass JSON, so attachments travel as { name, type, text }
+// or { name, type, base64, hash }. Older senders' `data` and data-URL fields are converted here.
+function toTransportAttachment(att) {
+  if (typeof att.text === 'string' || typeof att.base64 === 'string') return att;
+  if (typeof att.data === 'string') return { name: att.name, type: att.type, text: att.data, hash: att.hash };
+  if (typeof att.dataURL === 'string') {
+    const comma = att.dataURL.indexOf(',');
+    const meta = att.dataURL.slice(0, comma);
+    const body = att.dataURL.slice(comma + 1);
+    return /;base64/.test(meta)
+      ? { name: att.name, type: att.type, base64: body, hash: att.hash }
+      : { name: att.name, type: att.type, text: decodeURIComponent(body), hash: att.hash };
+  }
+  return null;
+}
+
+// With a streamId, the reply so far is also sent to the bridge page as
+// {action:'copilotChunk', id, text} while the model is still writing it.
+async function waitForResponse(tabId, timeout = 30000, settleTime = 700, streamId = null) {
   bglog('waitForResponse: injecting observer script');
   const [injection] = await chrome.scripting.executeScript({
     target: { tabId },
-    func: (timeout, settleTime) => {
+    func: (timeout, settleTime, streamId, chunkInterval) => {
       return new Promise((resolve, reject) => {
 
         const selector = '.group\\/ai-message-item p';
@@ -440,6 +531,7 @@ async function waitForResponse(tabId, timeout = 30000, settleTime = 700) {
           obs.disconnect();
           clearTimeout(timeoutId);
           clearTimeout(settleId);
+          clearTimeout(chunkId);
         };
 
         timeoutId = setTimeout(() => {
@@ -455,6 +547,22 @@ async function waitForResponse(tabId, timeout = 30000, settleTime = 700) {
         };
 
         let lastText = assembleText();
+        let lastChunkAt = 0;
+        let chunkId;
+
+        const sendChunk = () => {
+          lastChunkAt = Date.now();
+          try { chrome.runtime.sendMessage({ action: 'copilotChunk', id: streamId, text: lastText }); } catch (e) {}
+        };
+
+        // At most one chunk per chunkInterval; the last change always goes out.
+        const streamChunk = () => {
+          if (!streamId) return;
+          clearTimeout(chunkId);
+          const wait = chunkInterval - (Date.now() - lastChunkAt);
+          if (wait <= 0) sendChunk();
+          else chunkId = setTimeout(sendChunk, wait);
+        };
 
         const report = () => {
           const text = assembleText();
@@ -466,6 +574,7 @@ async function waitForResponse(tabId, timeout = 30000, settleTime = 700) {
           const text = assembleText();
           if (text !== lastText) {
             lastText = text;
+            streamChunk();
             clearTimeout(settleId);
             settleId = setTimeout(report, settleTime);
           }
@@ -480,7 +589,7 @@ async function waitForResponse(tabId, timeout = 30000, settleTime = 700) {
         scheduleIfChanged();
       });
     },
-    args: [timeout, settleTime]
+    args: [timeout, settleTime, streamId, 150]
   });
 
   bglog('waitForResponse: script resolved, returning reply');
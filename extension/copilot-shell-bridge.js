@@ -5,6 +5,12 @@ let reconnectDelay = 1000;
 const MAX_RECONNECT_DELAY = 30000;
 let reconnectTimer = null;
 let manualClose = false;
+// Request ids the controller no longer wants a reply for.
+const cancelledIds = new Set();
+// Reply text already streamed per request id, so each chunk only carries what changed.
+const streamedText = new Map();
+// Names the Copilot tab of each request, for requests the controller sent without an id.
+let localRequests = 0;
 
 function sendOrQueueRaw(text) {
   if (ws && ws.readyState === WebSocket.OPEN) {
@@ -24,6 +30,76 @@ function sendOrQueue(obj) {
   sendOrQueueRaw(text);
 }
 
+// Prompts from the controller arrive as binary frames:
+// [4-byte big-endian header length][UTF-8 JSON header][raw attachment bytes, in header order]
+function decodeFrame(buffer) {
+  const view = new DataView(buffer);
+  const headLen = view.getUint32(0);
+  let offset = 4;
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset, headLen)));
+  offset += headLen;
+  const segments = [];
+  for (const att of header.attachments || []) {
+    segments.push(new Uint8Array(buffer, offset, att.size));
+    offset += att.size;
+  }
+  return { header, segments };
+}
+
+async function sha256Hex(bytes) {
+  const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', bytes));
+  return Array.from(digest, b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function bytesToBase64(bytes, type) {
+  return new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = () => resolve(reader.result.slice(reader.result.indexOf(',') + 1));
+    reader.onerror = () => reject(reader.error);
+    reader.readAsDataURL(new Blob([bytes], { type }));
+  });
+}
+
+// Base64 of recent binary attachments by content hash: an unchanged screenshot isn't re-encoded.
+const encodedByHash = new Map();
+const ENCODED_CACHE_SIZE = 4;
+
+// chrome.runtime messages are JSON-serialised, so text segments travel on as strings and
+// binary ones as base64. Each carries a content hash so the Copilot tab can skip a file its
+// chat already has.
+async function frameToPayload(buffer) {
+  const { header, segments } = decodeFrame(buffer);
+  const decoder = new TextDecoder();
+  const attachments = await Promise.all((header.attachments || []).map(async (att, i) => {
+    const hash = await sha256Hex(segments[i]);
+    if (att.text) return { name: att.name, type: att.type, text: decoder.decode(segments[i]), hash };
+    let base64 = encodedByHash.get(hash);
+    if (base64 === undefined) {
+      base64 = await bytesToBase64(segments[i], att.type);
+      encodedByHash.set(hash, base64);
+      if (encodedByHash.size > ENCODED_CACHE_SIZE) encodedByHash.delete(encodedByHash.keys().next().value);
+    }
+    return { name: att.name, type: att.type, base64, hash };
+  }));
+  return { ...header, attachments };
+}
+
+// The reply observer in the Copilot tab reports the whole reply so far; forward only the
+// part that changed as {type:'chunk', id, offset, text}. The reply so far is the previous
+// text cut at `offset` plus `text`.
+chrome.runtime.onMessage.addListener(msg => {
+  if (!msg || msg.action !== 'copilotChunk' || !streamedText.has(msg.id)) return;
+  if (cancelledIds.has(msg.id)) return;
+  const prev = streamedText.get(msg.id);
+  const text = msg.text || '';
+  let offset = 0;
+  const max = Math.min(prev.length, text.length);
+  while (offset < max && prev.charCodeAt(offset) === text.charCodeAt(offset)) offset++;
+  if (offset === prev.length && offset === text.length) return;
+  streamedText.set(msg.id, text);
+  sendOrQueue({ type: 'chunk', id: msg.id, offset, text: text.slice(offset) });
+});
+
 function flushQueue() {
   while (sendQueue.length && ws && ws.readyState === WebSocket.OPEN) {
     const msg = sendQueue.shift();
@@ -44,25 +120,43 @@ function scheduleReconnect() {
 
 function createWebSocket() {
   ws = new WebSocket(WS_URL);
+  ws.binaryType = 'arraybuffer';
 
   updateUiState('connecting');
 
   ws.onopen = () => {
     console.log('[Bridge] WebSocket connected');
     reconnectDelay = 1000; 
+    // Tell the bridge this tab runs prompts; it will hand us one prompt at a time.
+    try { ws.send(JSON.stringify({ type: 'register', role: 'worker' })); } catch (e) {}
     flushQueue();
     updateUiState('connected');
   };
 
-  ws.onmessage = event => {
+  ws.onmessage = async event => {
     let msg = event.data;
     let payload = null;
-    try {
-      payload = JSON.parse(msg);
-    } catch (e) {
+    if (msg instanceof ArrayBuffer) {
+      try {
+        payload = await frameToPayload(msg);
+      } catch (e) {
+        console.error('[Bridge] could not decode binary frame', e);
+        return;
+      }
+    } else {
+      try {
+        payload = JSON.parse(msg);
+      } catch (e) {
+
+        payload = { prompt: msg };
+      }
+    }
 
-      payload = { prompt: msg };
+    if (payload && payload.type === 'cancel') {
+      if (payload.id) cancelledIds.add(payload.id);
+      return;
     }
+    if (payload && (payload.type === 'reply' || payload.type === 'stats')) return;
 
     if (payload && payload.__control__) {
       if (payload.__control__ === 'open_new_copilot') {
@@ -75,18 +169,32 @@ function createWebSocket() {
       }
     }
 
-    chrome.runtime.sendMessage({ action: 'runCopilot', prompt: payload.prompt, attachments: payload.attachments }, response => {
+    const stream = !!(payload.stream && payload.id);
+    if (stream) streamedText.set(payload.id, '');
+    const requestKey = payload.id || `local-${Date.now()}-${++localRequests}`;
+    chrome.runtime.sendMessage({ action: 'runCopilot', prompt: payload.prompt, attachments: payload.attachments, id: payload.id, stream, requestKey }, response => {
+      if (stream) streamedText.delete(payload.id);
 
       try {
         const replyText = (response && typeof response.reply !== 'undefined') ? response.reply : '';
-        sendOrQueue(replyText);
+        if (payload.id) {
+          if (cancelledIds.delete(payload.id)) {
+            console.warn('[Bridge] dropping reply for cancelled request', payload.id);
+            sendOrQueue({ type: 'cancelled', id: payload.id });
+          } else {
+            sendOrQueue({ type: stream ? 'done' : 'reply', id: payload.id, reply: replyText });
+          }
+        } else {
+          sendOrQueue(replyText);
+        }
       } catch (err) {
         console.error('[Bridge] failed to send reply over ws, queued instead', err);
         try { sendOrQueue(JSON.stringify({ reply: String(err) })); } catch (e2) {}
       }
 
+      // Close this request's Copilot tab (and only that one) so the next prompt starts a fresh chat.
       try {
-        chrome.runtime.sendMessage({ action: 'openNewCopilot', force: true }, resp => {  });
+        chrome.runtime.sendMessage({ action: 'openNewCopilot', force: true, requestKey }, resp => {  });
       } catch (e) { console.error('[Bridge] failed to request reopen', e); }
     });
   };
@@ -68,6 +68,38 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
+  // A copilotUrl on localhost (the test.html stand-in) needs an optional host permission, and
+  // chrome.permissions.request only works from a click, so offer a button while it's missing.
+  const grantBtn = document.getElementById('grantCopilotHost');
+
+  function refreshGrant() {
+    chrome.storage.local.get('copilotUrl', items => {
+      const url = items && items.copilotUrl;
+      if (!url) {
+        grantBtn.hidden = true;
+        return;
+      }
+      const u = new URL(url);
+      const origin = `${u.protocol}//${u.hostname}/*`;
+      grantBtn.dataset.origin = origin;
+      chrome.permissions.contains({ origins: [origin] }, has => { grantBtn.hidden = has; });
+    });
+  }
+
+  grantBtn.addEventListener('click', () => {
+    const origin = grantBtn.dataset.origin;
+    chrome.permissions.request({ origins: [origin] }, granted => {
+      if (chrome.runtime.lastError) log('Permission request failed: ' + chrome.runtime.lastError.message, 'error');
+      else log(granted ? `Access to ${origin} granted` : `Access to ${origin} declined`, granted ? 'action' : 'error');
+      refreshGrant();
+    });
+  });
+
+  chrome.storage.onChanged.addListener(changes => {
+    if (changes.copilotUrl) refreshGrant();
+  });
+  refreshGrant();
+
   window.addEventListener('message', ev => {
     if (!ev.data || typeof ev.data !== 'object') return;
     const d = ev.data;
@@ -0,0 +1,132 @@
+"""The bridge broker end to end: the embedded server, BridgeClient as requester and
+tools/standin_worker.py as the Copilot tabs."""
+import asyncio
+import json
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('websockets')
+import websockets  # noqa: E402
+
+import controller  # noqa: E402
+
+WORKER = Path(__file__).resolve().parent.parent / 'tools' / 'standin_worker.py'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def start_workers(url: str, tmp_path, replies: list, workers: int = 1, think: float = 0.0, *extra):
+    script = tmp_path / 'replies.txt'
+    script.write_text('\n'.join(replies) + '\n', encoding='utf-8')
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, str(WORKER), '--url', url, '--workers', str(workers), '--think', str(think),
+        '--script', str(script), *extra, stdout=asyncio.subprocess.DEVNULL)
+    return proc
+
+
+async def wait_for(predicate, timeout: float = 10.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError('condition not met in time')
+        await asyncio.sleep(0.02)
+
+
+def run_bridge_test(tmp_path, scenario):
+    async def main():
+        port = free_port()
+        url = f"ws://127.0.0.1:{port}"
+        server = await controller.start_bridge_server('127.0.0.1', port)
+        client = controller.BridgeClient(url, request_timeout=15).start()
+        procs = []
+        try:
+            await scenario(server.broker, client, url, procs)
+        finally:
+            for proc in procs:
+                proc.kill()
+                await proc.wait()
+            await client.close()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(main())
+
+
+def test_prompts_spread_across_workers(tmp_path):
+    async def scenario(broker, client, url, procs):
+        procs.append(await start_workers(url, tmp_path, ['{"action": "noop", "args": []}'], 2, 0.3))
+        await wait_for(lambda: len(broker.workers()) == 2)
+        replies = await asyncio.gather(*(client.request(f"Task: {i}") for i in range(4)))
+        assert replies == ['{"action": "noop", "args": []}'] * 4
+        stats = broker.stats()
+        assert stats['dispatched'] == 4 and stats['completed'] == 4 and stats['queue_depth'] == 0
+        # Each worker took one of the first two prompts while the other was busy.
+        assert all(w.busy_total > 0 for w in broker.workers())
+
+    run_bridge_test(tmp_path, scenario)
+
+
+def test_streamed_reply_arrives_in_chunks(tmp_path):
+    reply = json.dumps({'actions': [{'action': 'noop', 'args': []}, {'action': 'exit', 'args': []}]})
+
+    async def scenario(broker, client, url, procs):
+        procs.append(await start_workers(url, tmp_path, [reply], 1, 0.0,
+                                         '--stream', '--chunk-size', '7', '--chunk-delay', '0.01'))
+        await wait_for(lambda: len(broker.workers()) == 1)
+        parser = controller.StreamingActionParser()
+        streamed = []
+        final = await client.request('Task: stream', on_chunk=lambda o, t: streamed.extend(parser.feed(o, t)))
+        assert final == reply
+        assert streamed == json.loads(reply)['actions']
+
+    run_bridge_test(tmp_path, scenario)
+
+
+def test_cancelled_prompt_frees_the_worker(tmp_path):
+    async def scenario(broker, client, url, procs):
+        procs.append(await start_workers(url, tmp_path, ['{"action": "noop", "args": []}'], 1, 0.5))
+        await wait_for(lambda: len(broker.workers()) == 1)
+        first = asyncio.create_task(client.request('Task: slow', request_id='slow'))
+        await wait_for(lambda: broker.stats()['busy_workers'] == 1)
+        await client.cancel('slow')
+        assert await first is None
+        # The worker reports back "cancelled" and is handed the next prompt.
+        assert await client.request('Task: next') == '{"action": "noop", "args": []}'
+        assert broker.stats()['completed'] == 1
+
+    run_bridge_test(tmp_path, scenario)
+
+
+def test_prompt_of_a_vanished_worker_is_requeued(tmp_path):
+    async def scenario(broker, client, url, procs):
+        # A worker that takes the prompt and then disconnects without answering.
+        async with websockets.connect(url) as flaky:
+            await flaky.send(json.dumps({'type': 'register', 'role': 'worker'}))
+            await wait_for(lambda: len(broker.workers()) == 1)
+            request = asyncio.create_task(client.request('Task: survive'))
+            await flaky.recv()
+        procs.append(await start_workers(url, tmp_path, ['{"action": "exit", "args": []}']))
+        assert await request == '{"action": "exit", "args": []}'
+        assert broker.stats()['dispatched'] == 2
+
+    run_bridge_test(tmp_path, scenario)
+
+
+def test_bare_action_object_from_a_worker_is_its_reply(tmp_path):
+    async def scenario(broker, client, url, procs):
+        async with websockets.connect(url) as old:
+            await old.send(json.dumps({'type': 'register', 'role': 'worker'}))
+            await wait_for(lambda: len(broker.workers()) == 1)
+            request = asyncio.create_task(client.request('Task: old extension'))
+            await old.recv()
+            await old.send(json.dumps({'action': 'noop', 'args': []}))
+            assert json.loads(await request) == {'action': 'noop', 'args': []}
+            assert broker.stats()['busy_workers'] == 0
+
+    run_bridge_test(tmp_path, scenario)
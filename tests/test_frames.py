@@ -0,0 +1,39 @@
+import pytest
+
+from controller import PageArtifacts, build_prompt_frame, decode_frame, encode_frame, read_frame_header
+
+
+def test_round_trip_keeps_header_and_segments():
+    segments = [b'page text \xe2\x9c\x93', bytes(range(256)) * 40, b'']
+    header = {'id': 'abc', 'prompt': 'Task: tést', 'attachments': [
+        {'name': 'page.txt', 'type': 'text/plain', 'size': len(segments[0]), 'text': True},
+        {'name': 'screenshot.jpeg', 'type': 'image/jpeg', 'size': len(segments[1]), 'text': False},
+        {'name': 'history.txt', 'type': 'text/plain', 'size': 0, 'text': True},
+    ]}
+    frame = b''.join(encode_frame(header, segments))
+    assert read_frame_header(frame) == header
+    decoded_header, decoded = decode_frame(frame)
+    assert decoded_header == header
+    assert [bytes(s) for s in decoded] == segments
+
+
+def test_segments_are_not_copied():
+    shot = bytearray(b'\xff' * 1000)
+    parts = encode_frame({'attachments': [{'size': len(shot)}]}, [shot])
+    assert parts[-1] is shot
+
+
+def test_length_mismatch_is_rejected():
+    frame = b''.join(encode_frame({'attachments': [{'size': 4}]}, [b'abcd']))
+    with pytest.raises(ValueError):
+        decode_frame(frame + b'extra')
+
+
+def test_prompt_frame_carries_artifacts_in_order():
+    artifacts = PageArtifacts(url='http://x/', page_text='[1] button Go', screenshot=b'\x89PNG',
+                              screenshot_type='image/png')
+    frame = b''.join(build_prompt_frame('Task: go', artifacts, 'history', request_id='r1', stream=True))
+    header, segments = decode_frame(frame)
+    assert header['id'] == 'r1' and header['stream'] is True
+    assert [a['name'] for a in header['attachments']] == ['page.txt', 'screenshot.png', 'history.txt']
+    assert [bytes(s) for s in segments] == [b'[1] button Go', b'\x89PNG', b'history']
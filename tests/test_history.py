@@ -0,0 +1,55 @@
+import json
+
+import controller
+from controller import CommandHistory
+
+
+def make_history(tmp_path, n: int, distinct: int = 7) -> CommandHistory:
+    history = CommandHistory(tmp_path / 'commands.jsonl', recent=5)
+    for i in range(n):
+        cmd = f"click_element(id=b{i % distinct})"
+        history.record(cmd, {'action': 'click_element', 'args': [f"id=b{i % distinct}"]},
+                       f"http://x/{i % 3}", 'ok' if i % 4 else 'error: no element matches')
+    return history
+
+
+def test_empty_history_renders_nothing(tmp_path):
+    assert CommandHistory(tmp_path / 'c.jsonl').render() is None
+
+
+def test_recent_commands_are_verbatim(tmp_path):
+    lines = make_history(tmp_path, 3).render().splitlines()
+    assert lines[0] == 'Most recent commands #1-#3, one JSON object per line:'
+    assert [json.loads(line)['n'] for line in lines[1:]] == [1, 2, 3]
+
+
+def test_older_commands_are_collapsed(tmp_path):
+    text = make_history(tmp_path, 40).render()
+    assert 'Earlier commands #1-#35' in text
+    assert 'Most recent commands #36-#40' in text
+    # Results are counted by status, without the detail after the colon.
+    assert '5x click_element(id=b0)  [' in text and 'error]' in text
+    assert 'Pages those commands ran on: ' in text
+
+
+def test_render_size_stays_flat(tmp_path, monkeypatch):
+    monkeypatch.setattr(controller, 'HISTORY_FLUSH_EVERY', 10 ** 9)
+    small = len(make_history(tmp_path, 200, distinct=1000).render())
+    large = len(make_history(tmp_path, 5000, distinct=1000).render())
+    assert large < small * 1.2
+    lines = make_history(tmp_path, 5000, distinct=1000).render().splitlines()
+    assert len(lines) <= controller.HISTORY_SUMMARY_LINES + 5 + 5
+
+
+def test_summary_keys_are_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(controller, 'HISTORY_FLUSH_EVERY', 10 ** 9)
+    history = make_history(tmp_path, controller.HISTORY_SUMMARY_MAX_KEYS * 3,
+                           distinct=controller.HISTORY_SUMMARY_MAX_KEYS * 3)
+    assert len(history.older) == controller.HISTORY_SUMMARY_MAX_KEYS
+
+
+def test_log_gets_every_entry(tmp_path):
+    history = make_history(tmp_path, 45)
+    history._write(history._take_pending())
+    logged = (tmp_path / 'commands.jsonl').read_text(encoding='utf-8').splitlines()
+    assert [json.loads(line)['n'] for line in logged] == list(range(1, 46))
@@ -0,0 +1,61 @@
+import pytest
+
+from controller import parse_copilot_reply, repair_copilot_reply, validate_actions
+
+CLICK = {'action': 'click_element', 'args': ['id=go']}
+
+
+@pytest.mark.parametrize('reply', [
+    '{"action": "click_element", "args": ["id=go"]}',
+    '"{\\"action\\": \\"click_element\\", \\"args\\": [\\"id=go\\"]}"',
+    '{"actions": [{"action": "click_element", "args": ["id=go"]}]}',
+])
+def test_bare_json(reply):
+    assert parse_copilot_reply(reply) == ([CLICK], None)
+
+
+@pytest.mark.parametrize('reply', [
+    '```json\n{"action": "click_element", "args": ["id=go"]}\n```',
+    'Sure! Here is the next step:\n{"action": "click_element", "args": ["id=go"]}\nLet me know.',
+    '{"action": "click_element", "args": ["id=go",],}',
+    '{“action”: “click_element”, “args”: [“id=go”]}',
+    'I looked at {the page} first. {"action": "click_element", "args": ["id=go"]}',
+])
+def test_noisy_replies_are_repaired(reply):
+    assert parse_copilot_reply(reply) == ([CLICK], None)
+
+
+def test_repair_prefers_the_fenced_block():
+    reply = 'Not this: {"action": "exit", "args": []}\n```json\n{"action": "noop", "args": []}\n```'
+    assert repair_copilot_reply(reply) == {'action': 'noop', 'args': []}
+
+
+def test_repair_gives_up_without_an_action_object():
+    assert repair_copilot_reply('I am not sure what to do next. {"note": 1}') is None
+
+
+@pytest.mark.parametrize('reply, fragment', [
+    ('no json here', 'Could not parse'),
+    ('[1, 2]', 'not a JSON object'),
+    ('{"thought": "hmm"}', 'Unrecognized reply schema'),
+    ('{"actions": []}', 'empty'),
+    ('{"action": "scroll", "args": []}', "unknown action 'scroll'"),
+])
+def test_unusable_replies_report_why(reply, fragment):
+    actions, error = parse_copilot_reply(reply)
+    assert actions is None
+    assert fragment in error
+
+
+@pytest.mark.parametrize('actions, fragment', [
+    ([CLICK, 'exit'], 'Action 2 is not an object'),
+    ([{'action': 'send_keys', 'args': ['id=q']}], 'needs args [selector, text]'),
+    ([{'action': 'click_element', 'args': 'id=go'}], "'args' must be a list"),
+    ([{'action': 'click_element', 'args': [{'id': 'go'}]}], 'args must be strings'),
+])
+def test_validate_actions_names_the_first_bad_action(actions, fragment):
+    assert fragment in validate_actions(actions)
+
+
+def test_validate_actions_accepts_missing_args_for_argless_actions():
+    assert validate_actions([{'action': 'exit'}, {'action': 'noop', 'args': None}]) is None
@@ -0,0 +1,62 @@
+import json
+import random
+
+import pytest
+
+from controller import StreamingActionParser
+
+REPLY = json.dumps({'actions': [
+    {'action': 'open_url', 'args': ['https://example.com/?q={a}']},
+    {'action': 'send_keys', 'args': ['id=q', 'say "hi", then [press] {enter}\\n']},
+    {'action': 'click_element', 'args': ['text="Search"']},
+    {'action': 'exit', 'args': []},
+]})
+ACTIONS = json.loads(REPLY)['actions']
+
+
+def feed_in_chunks(reply: str, cuts: list) -> list:
+    parser = StreamingActionParser()
+    found = []
+    offset = 0
+    for cut in cuts + [len(reply)]:
+        found.extend(parser.feed(offset, reply[offset:cut]))
+        offset = cut
+    return found
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_any_chunk_split_yields_every_action_once(seed):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(REPLY)), rng.randint(1, 40)))
+    assert feed_in_chunks(REPLY, cuts) == ACTIONS
+
+
+def test_one_character_at_a_time():
+    assert feed_in_chunks(REPLY, list(range(1, len(REPLY)))) == ACTIONS
+
+
+def test_action_is_returned_as_soon_as_its_brace_closes():
+    parser = StreamingActionParser()
+    end = REPLY.index(']}') + 2
+    assert parser.feed(0, REPLY[:end]) == ACTIONS[:1]
+    assert parser.feed(end, REPLY[end:]) == ACTIONS[1:]
+
+
+def test_rewritten_text_is_rescanned_without_repeating_actions():
+    parser = StreamingActionParser()
+    end = REPLY.index(']}') + 2
+    assert parser.feed(0, REPLY[:end + 5]) == ACTIONS[:1]
+    # The worker resends the reply from the start, e.g. after the page re-rendered it.
+    assert parser.feed(0, REPLY) == ACTIONS[1:]
+
+
+def test_single_action_reply_yields_nothing():
+    parser = StreamingActionParser()
+    assert parser.feed(0, json.dumps({'action': 'exit', 'args': []})) == []
+
+
+def test_unparseable_element_stops_the_stream():
+    parser = StreamingActionParser()
+    reply = '{"actions": [{"action": "exit", "args": []}, {"action": open}, {"action": "noop", "args": []}]}'
+    assert parser.feed(0, reply) == [{'action': 'exit', 'args': []}]
+    assert parser.broken
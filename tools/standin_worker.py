@@ -0,0 +1,101 @@
+"""Local stand-in for the Copilot extension tab, for exercising the bridge without a browser.
+
+Registers one or more "worker" connections with the bridge and answers every prompt with
+the next reply from a script (one reply per line, cycled), after a configurable think time.
+With --stream, prompts that ask for it get the reply in small chunks, like a model writing
+it, followed by a final "done" message.
+
+    python tools/standin_worker.py --workers 2 --think 1.5 --script replies.txt
+    python tools/standin_worker.py --stream --chunk-size 12 --chunk-delay 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+
+import websockets
+
+DEFAULT_REPLY = json.dumps({'action': 'noop', 'args': []})
+
+def read_frame_header(data: bytes) -> dict:
+    (head_len,) = struct.unpack_from('>I', data, 0)
+    return json.loads(bytes(data[4:4 + head_len]).decode('utf-8'))
+
+async def stream_reply(ws, job_id, reply: str, chunk_size: int, chunk_delay: float, cancelled: set) -> bool:
+    """Send `reply` as chunks, then "done". Returns False if the job was cancelled midway."""
+    for offset in range(0, len(reply), chunk_size):
+        if job_id in cancelled:
+            return False
+        await ws.send(json.dumps({'type': 'chunk', 'id': job_id, 'offset': offset,
+                                  'text': reply[offset:offset + chunk_size]}))
+        await asyncio.sleep(chunk_delay)
+    if job_id in cancelled:
+        return False
+    await ws.send(json.dumps({'type': 'done', 'id': job_id, 'reply': reply}))
+    return True
+
+async def run_worker(n: int, url: str, think: float, replies, stream: bool = False,
+                     chunk_size: int = 16, chunk_delay: float = 0.1):
+    cancelled = set()
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({'type': 'register', 'role': 'worker'}))
+        print(f"[worker {n}] registered with {url}")
+        jobs = asyncio.Queue()
+
+        async def answer():
+            while True:
+                header = await jobs.get()
+                job_id = header.get('id')
+                await asyncio.sleep(think)
+                reply = next(replies)
+                if job_id not in cancelled:
+                    if stream and header.get('stream'):
+                        if await stream_reply(ws, job_id, reply, chunk_size, chunk_delay, cancelled):
+                            continue
+                    else:
+                        await ws.send(json.dumps({'type': 'reply', 'id': job_id, 'reply': reply}))
+                        continue
+                print(f"[worker {n}] {str(job_id)[:8]} cancelled")
+                cancelled.discard(job_id)
+                await ws.send(json.dumps({'type': 'cancelled', 'id': job_id}))
+
+        # Answer on a separate task so cancels are still read while a reply is being written.
+        answering = asyncio.create_task(answer())
+        async for message in ws:
+            if isinstance(message, bytes):
+                header = read_frame_header(message)
+            else:
+                header = json.loads(message)
+                if header.get('type') == 'cancel':
+                    cancelled.add(header.get('id'))
+                    continue
+                if 'prompt' not in header:
+                    continue
+            job_id = header.get('id')
+            sizes = ', '.join(f"{a['name']}={a.get('size', '?')}" for a in header.get('attachments', []))
+            print(f"[worker {n}] prompt {str(job_id)[:8]} ({sizes or 'no attachments'})")
+            jobs.put_nowait(header)
+        answering.cancel()
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='ws://localhost:8765')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--think', type=float, default=0.5, help='seconds to wait before replying')
+    parser.add_argument('--script', help='file with one reply per line (default: a noop action)')
+    parser.add_argument('--stream', action='store_true', help='stream replies in chunks when the prompt asks for it')
+    parser.add_argument('--chunk-size', type=int, default=16, help='characters per streamed chunk')
+    parser.add_argument('--chunk-delay', type=float, default=0.1, help='seconds between streamed chunks')
+    args = parser.parse_args()
+
+    lines = [DEFAULT_REPLY]
+    if args.script:
+        with open(args.script, encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()] or lines
+    replies = itertools.cycle(lines)
+    await asyncio.gather(*(run_worker(i + 1, args.url, args.think, replies, args.stream, args.chunk_size, args.chunk_delay)
+                           for i in range(args.workers)))
+
+if __name__ == '__main__':
+    asyncio.run(main())